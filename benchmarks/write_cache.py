@@ -0,0 +1,78 @@
+# @package      hubzero-simtool
+# @file         write_cache.py
+# @copyright    Copyright (c) 2019-2021 The Regents of the University of California.
+# @license      http://opensource.org/licenses/MIT MIT
+# @trademark    HUBzero is a registered trademark of The Regents of the University of California.
+#
+"""Time FileDataStore.write_cache for each link mode on large synthetic outputs.
+
+   python benchmarks/write_cache.py --directory /path/on/filesystem --size 1G --files 4
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from simtool.datastore import FileDataStore
+from simtool.__main__ import _getSize
+
+CHUNKSIZE = 16*1024*1024
+
+
+def makeOutputs(runDirectory,outputSize,outputFiles):
+   os.makedirs(os.path.join(runDirectory,'outputs'))
+   savedOutputFiles = []
+   fileSize = outputSize // outputFiles
+   for fileIndex in range(outputFiles):
+      savedOutputFile = os.path.join('outputs','output%d.dat' % (fileIndex))
+      with open(os.path.join(runDirectory,savedOutputFile),'wb') as fp:
+         remaining = fileSize
+         while remaining > 0:
+            chunk = min(remaining,CHUNKSIZE)
+            fp.write(os.urandom(chunk))
+            remaining -= chunk
+      savedOutputFiles.append(savedOutputFile)
+   with open(os.path.join(runDirectory,'benchmark.ipynb'),'w') as fp:
+      fp.write('{}')
+
+   return ['benchmark.ipynb'],savedOutputFiles
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="benchmark FileDataStore.write_cache link modes")
+   parser.add_argument('--directory',help="directory for the run and cache, default is a temporary directory")
+   parser.add_argument('--size',type=_getSize,default=_getSize('256M'),help="total bytes of outputs, default 256M")
+   parser.add_argument('--files',type=int,default=4,help="number of output files, default 4")
+   parser.add_argument('--repeat',type=int,default=3,help="writes per link mode, default 3")
+   args = parser.parse_args(argv)
+
+   benchmarkDirectory = tempfile.mkdtemp(prefix='simtool_benchmark_',dir=args.directory)
+   try:
+      runDirectory = os.path.join(benchmarkDirectory,'run')
+      prerunFiles,savedOutputFiles = makeOutputs(runDirectory,args.size,args.files)
+      FileDataStore.CACHEINDEX = False
+
+      print("%d bytes in %d files" % (args.size,args.files))
+      print("%-10s %10s %10s" % ('MODE','SECONDS','MB/S'))
+      for linkMode in ['hardlink','reflink','copy']:
+         elapsed = []
+         for repeat in range(args.repeat):
+            cacheLocationRoot = os.path.join(benchmarkDirectory,'cache')
+            ds = FileDataStore('benchmark','r0',{'mode':linkMode,'repeat':repeat},
+                               cacheLocationRoot=cacheLocationRoot,linkMode=linkMode)
+            start = time.perf_counter()
+            ds.write_cache(runDirectory,prerunFiles,savedOutputFiles)
+            elapsed.append(time.perf_counter() - start)
+            shutil.rmtree(cacheLocationRoot)
+         best = min(elapsed)
+         print("%-10s %10.4f %10.1f" % (linkMode,best,args.size/best/1024**2))
+   finally:
+      shutil.rmtree(benchmarkDirectory,ignore_errors=True)
+
+   return 0
+
+
+if __name__ == '__main__':
+   sys.exit(main())
@@ -0,0 +1,65 @@
+# @package      hubzero-simtool
+# @file         ws_cache.py
+# @copyright    Copyright (c) 2019-2021 The Regents of the University of California.
+# @license      http://opensource.org/licenses/MIT MIT
+# @trademark    HUBzero is a registered trademark of The Regents of the University of California.
+#
+"""Time WSDataStore.write_cache and read_cache against the stand-in cache server.
+
+   python benchmarks/ws_cache.py --size 1G --files 16
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+from simtool.datastore import WSDataStore
+from simtool.cacheserver import CacheServer
+from simtool.__main__ import _getSize
+
+from write_cache import makeOutputs
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="benchmark WSDataStore uploads and downloads")
+   parser.add_argument('--directory',help="directory for the run and server, default is a temporary directory")
+   parser.add_argument('--size',type=_getSize,default=_getSize('256M'),help="total bytes of outputs, default 256M")
+   parser.add_argument('--files',type=int,default=16,help="number of output files, default 16")
+   args = parser.parse_args(argv)
+
+   benchmarkDirectory = tempfile.mkdtemp(prefix='simtool_benchmark_',dir=args.directory)
+   server = CacheServer(os.path.join(benchmarkDirectory,'server'))
+   threading.Thread(target=server.serve_forever,daemon=True).start()
+   try:
+      runDirectory = os.path.join(benchmarkDirectory,'run')
+      prerunFiles,savedOutputFiles = makeOutputs(runDirectory,args.size,args.files)
+
+      print("%d bytes in %d files" % (args.size,args.files))
+      print("%-24s %10s %10s" % ('OPERATION','SECONDS','MB/S'))
+# chunked first, the files are then already held by the server
+      for operation,chunkedUpload in [('upload chunked',True),('upload unchanged',True),('upload multipart',False)]:
+         WSDataStore.CHUNKEDUPLOAD = chunkedUpload
+         ds = WSDataStore('benchmark','r0',{'operation':operation},server.getURL())
+         start = time.perf_counter()
+         ds.write_cache(runDirectory,prerunFiles,savedOutputFiles)
+         elapsed = time.perf_counter() - start
+         print("%-24s %10.4f %10.1f" % (operation,elapsed,args.size/elapsed/1024**2))
+
+      outputDirectory = os.path.join(benchmarkDirectory,'out')
+      start = time.perf_counter()
+      ds.read_cache(outputDirectory)
+      elapsed = time.perf_counter() - start
+      print("%-24s %10.4f %10.1f" % ('download',elapsed,args.size/elapsed/1024**2))
+   finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(benchmarkDirectory,ignore_errors=True)
+
+   return 0
+
+
+if __name__ == '__main__':
+   sys.exit(main())
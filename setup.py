@@ -10,7 +10,7 @@ with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
 requirements = ['ipython', 'pint', 'numpy', 'papermill', 'jsonpickle', 
-                'mendeleev', 'pillow', 'scrapbook', 'joblib']
+                'mendeleev', 'pillow', 'scrapbook']
 
 test_requirements = [
     # TODO: put package test requirements here
@@ -31,6 +31,14 @@ setup(
                  'simtool'},
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        'zstd': ['zstandard'],
+    },
+    entry_points={
+        'console_scripts': [
+            'simtool=simtool.__main__:main',
+        ],
+    },
     license="MIT license",
     zip_safe=False,
     keywords='simtool',
@@ -10,5 +10,6 @@ from .utils import getGetSimToolNameRevisionFromEnvironment, findInstalledSimToo
 from .utils import findInstalledSimToolNotebooks as findSimTools
 from .utils import parse, getValidatedInputs, getParamsFromDictionary
 from .utils import findSimToolNotebook, getSimToolInputs, getSimToolOutputs
+from .utils import loadParameterFile, resolveSimTools
 from .run import Run, DB 
 from .experiment import Experiment, set_experiment, get_experiment
@@ -0,0 +1,104 @@
+# @package      hubzero-simtool
+# @file         __main__.py
+# @copyright    Copyright (c) 2019-2021 The Regents of the University of California.
+# @license      http://opensource.org/licenses/MIT MIT
+# @trademark    HUBzero is a registered trademark of The Regents of the University of California.
+#
+import sys
+import argparse
+
+from .utils import writeSimToolManifest
+from .datastore import FileDataStore
+from .cacheindex import CacheIndex
+
+
+def _manifest(args):
+   exitCode = 0
+   for notebookPath in args.notebooks:
+      try:
+         manifestPath = writeSimToolManifest(notebookPath)
+      except (OSError,ValueError) as err:
+         print("%s: %s" % (notebookPath,err),file=sys.stderr)
+         exitCode = 1
+      else:
+         print(manifestPath)
+
+   return exitCode
+
+
+def _cacheStats(args):
+   cacheIndex = CacheIndex(args.root or FileDataStore.USERCACHELOCATIONROOT)
+   totalEntries = 0
+   totalSize    = 0
+   print("%-30s %-10s %8s %8s %14s" % ('SIMTOOL','REVISION','ENTRIES','FILES','BYTES'))
+   for stats in cacheIndex.getStats(args.simtool):
+      print("%-30s %-10s %8d %8d %14d" % (stats['simToolName'],stats['simToolRevision'],
+                                          stats['entries'],stats['files'],stats['size']))
+      totalEntries += stats['entries']
+      totalSize    += stats['size']
+   print("%d entries, %d bytes" % (totalEntries,totalSize))
+
+   return 0
+
+
+def _getSize(value):
+   # bytes with an optional K, M, G or T suffix
+   multipliers = {'K':1024,'M':1024**2,'G':1024**3,'T':1024**4}
+   value = value.strip().upper().rstrip('B')
+   try:
+      if value and value[-1] in multipliers:
+         return int(float(value[:-1])*multipliers[value[-1]])
+      return int(value)
+   except ValueError:
+      raise argparse.ArgumentTypeError("invalid size: %s" % (value))
+
+
+def _cacheGC(args):
+   cacheLocationRoot = args.root or FileDataStore.USERCACHELOCATIONROOT
+   if args.quota is None and args.simtool_quota is None and \
+      FileDataStore.CACHEQUOTA is None and FileDataStore.SIMTOOLCACHEQUOTA is None:
+      print("No quota set, use --quota or --simtool-quota",file=sys.stderr)
+      return 1
+   evictedEntries,evictedSize = FileDataStore.enforceQuota(cacheLocationRoot,
+                                                           quota=args.quota,
+                                                           simToolQuota=args.simtool_quota,
+                                                           policy=args.policy)
+   print("Evicted %d entries, %d bytes" % (evictedEntries,evictedSize))
+
+   return 0
+
+
+def main(argv=None):
+   """Entry point for the simtool command."""
+   parser = argparse.ArgumentParser(prog='simtool',description="sim2L utilities")
+   subparsers = parser.add_subparsers(dest='command')
+   subparsers.required = True
+
+   manifestParser = subparsers.add_parser('manifest',
+                                          help="write the manifest of sim2L notebooks at install or publish time")
+   manifestParser.add_argument('notebooks',nargs='+',metavar='NOTEBOOK',help="sim2L notebook")
+   manifestParser.set_defaults(function=_manifest)
+
+   cacheParser = subparsers.add_parser('cache',help="manage the local results cache")
+   cacheSubparsers = cacheParser.add_subparsers(dest='cacheCommand')
+   cacheSubparsers.required = True
+
+   cacheStatsParser = cacheSubparsers.add_parser('stats',help="report cache usage per sim2L revision")
+   cacheStatsParser.add_argument('--root',help="cache root, default is %s" % (FileDataStore.USERCACHELOCATIONROOT))
+   cacheStatsParser.add_argument('--simtool',help="only report this sim2L")
+   cacheStatsParser.set_defaults(function=_cacheStats)
+
+   cacheGCParser = cacheSubparsers.add_parser('gc',help="evict cache entries to bring the cache within quota")
+   cacheGCParser.add_argument('--root',help="cache root, default is %s" % (FileDataStore.USERCACHELOCATIONROOT))
+   cacheGCParser.add_argument('--quota',type=_getSize,help="bytes allowed in the cache root, e.g. 10G")
+   cacheGCParser.add_argument('--simtool-quota',type=_getSize,help="bytes allowed for each sim2L")
+   cacheGCParser.add_argument('--policy',choices=['LRU','LFU'],help="eviction policy, default is %s" % (FileDataStore.EVICTIONPOLICY))
+   cacheGCParser.set_defaults(function=_cacheGC)
+
+   args = parser.parse_args(argv)
+
+   return args.function(args)
+
+
+if __name__ == '__main__':
+   sys.exit(main())
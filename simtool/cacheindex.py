@@ -0,0 +1,297 @@
+# @package      hubzero-simtool
+# @file         cacheindex.py
+# @copyright    Copyright (c) 2019-2021 The Regents of the University of California.
+# @license      http://opensource.org/licenses/MIT MIT
+# @trademark    HUBzero is a registered trademark of The Regents of the University of California.
+#
+import os
+import stat
+import json
+import time
+import sqlite3
+
+BLOBMANIFEST = '.simtool_blobs.json'  # files of an entry stored in the blob store
+
+def getTreeSize(path):
+   """Get the size of a cache entry.
+
+      Files hardlinked more than once in the entry are counted once.  Files
+      listed in the BLOBMANIFEST of the entry are kept in the blob store,
+      shared with other entries, and are not counted.
+
+      Args:
+          path: Path of the cache entry directory.
+      Returns:
+          Tuple of the number of bytes and number of files in the entry.
+   """
+   try:
+      with open(os.path.join(path,BLOBMANIFEST),'r') as fp:
+         blobFiles = set(json.load(fp)['blobs'])
+   except (OSError,ValueError,KeyError):
+      blobFiles = set()
+
+   size  = 0
+   files = 0
+   fileIds = set()
+   for rootDir,dirNames,fileNames in os.walk(path):
+      for fileName in fileNames:
+         filePath = os.path.join(rootDir,fileName)
+         if os.path.relpath(filePath,path) in blobFiles:
+            continue
+         try:
+            fileStat = os.lstat(filePath)
+         except OSError:
+            pass
+         else:
+            files += 1
+            fileId = (fileStat.st_dev,fileStat.st_ino)
+            if not fileId in fileIds:
+               fileIds.add(fileId)
+               size += fileStat.st_size
+
+   return size,files
+
+
+class CacheIndex:
+   """
+   Index of the entries in a FileDataStore cache root kept in a SQLite database.
+
+   Each entry records the inputs that produced it, its size, number of files,
+   creation time, last access time and number of accesses.  When the index is
+   created it is filled in from the entries already in the cache.
+   """
+   INDEXNAME      = '.simtool_cache_index.sqlite'
+   TIMEOUT        = 60   # seconds to wait for the database lock
+   QUERYCHUNKSIZE = 500  # cache keys per query, keeps below the SQLite variable limit
+
+   def __init__(self,cacheLocationRoot):
+      self.cacheLocationRoot = cacheLocationRoot
+      self.cacheDirectory    = os.path.join(cacheLocationRoot,'.simtool_cache')
+      self.indexPath         = os.path.join(cacheLocationRoot,CacheIndex.INDEXNAME)
+
+
+   def __connect(self):
+      if not os.path.isdir(self.cacheLocationRoot):
+         os.makedirs(self.cacheLocationRoot,exist_ok=True)
+      connection = sqlite3.connect(self.indexPath,timeout=CacheIndex.TIMEOUT,isolation_level=None)
+      try:
+         connection.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                  simToolName     TEXT    NOT NULL,
+                                  simToolRevision TEXT    NOT NULL,
+                                  cacheKey        TEXT    NOT NULL,
+                                  inputs          TEXT,
+                                  size            INTEGER NOT NULL,
+                                  files           INTEGER NOT NULL,
+                                  created         REAL    NOT NULL,
+                                  lastAccess      REAL    NOT NULL,
+                                  accessCount     INTEGER NOT NULL DEFAULT 0,
+                                  PRIMARY KEY (simToolName,simToolRevision,cacheKey))""")
+         connection.execute("CREATE INDEX IF NOT EXISTS entriesLastAccess ON entries (lastAccess)")
+         connection.execute("CREATE TABLE IF NOT EXISTS properties (name TEXT PRIMARY KEY, value TEXT)")
+         seeded = connection.execute("SELECT value FROM properties WHERE name = 'seeded'").fetchone()
+         if seeded is None:
+            self.__seed(connection)
+      except:
+         connection.close()
+         raise
+
+      return connection
+
+
+   def __seed(self,connection):
+      # Add the entries written before the index existed.
+      connection.execute("BEGIN IMMEDIATE")
+      try:
+         seeded = connection.execute("SELECT value FROM properties WHERE name = 'seeded'").fetchone()
+         if seeded is None:
+            try:
+               simToolNames = os.listdir(self.cacheDirectory)
+            except OSError:
+               simToolNames = []
+            for simToolName in simToolNames:
+               try:
+                  simToolRevisions = os.listdir(os.path.join(self.cacheDirectory,simToolName))
+               except OSError:
+                  continue
+               for simToolRevision in simToolRevisions:
+                  try:
+                     cacheKeys = os.listdir(os.path.join(self.cacheDirectory,simToolName,simToolRevision))
+                  except OSError:
+                     continue
+                  for cacheKey in cacheKeys:
+# skip lock files and entries being removed
+                     if cacheKey.startswith('.') or cacheKey.endswith('.lock'):
+                        continue
+                     entryPath = os.path.join(self.cacheDirectory,simToolName,simToolRevision,cacheKey)
+                     try:
+                        entryStat = os.stat(entryPath)
+                     except OSError:
+                        continue
+                     if not stat.S_ISDIR(entryStat.st_mode):
+                        continue
+                     created = entryStat.st_mtime
+                     size,files = getTreeSize(entryPath)
+                     connection.execute("""INSERT OR IGNORE INTO entries
+                                              (simToolName,simToolRevision,cacheKey,inputs,size,files,created,lastAccess)
+                                              VALUES (?,?,?,NULL,?,?,?,?)""",
+                                        (simToolName,simToolRevision,cacheKey,size,files,created,created))
+            connection.execute("INSERT INTO properties (name,value) VALUES ('seeded',?)",(str(time.time()),))
+      except:
+         connection.execute("ROLLBACK")
+         raise
+      else:
+         connection.execute("COMMIT")
+
+
+   def addEntry(self,simToolName,simToolRevision,cacheKey,inputs,size,files):
+      """Record a new cache entry.
+
+         Args:
+             simToolName: SimTool name.
+             simToolRevision: SimTool revision.
+             cacheKey: Name of the cache entry.
+             inputs: Inputs that produced the entry.
+             size: Number of bytes in the entry.
+             files: Number of files in the entry.
+      """
+      now = time.time()
+      connection = self.__connect()
+      try:
+         connection.execute("""INSERT OR REPLACE INTO entries
+                                  (simToolName,simToolRevision,cacheKey,inputs,size,files,created,lastAccess,accessCount)
+                                  VALUES (?,?,?,?,?,?,?,?,0)""",
+                            (simToolName,simToolRevision,cacheKey,json.dumps(inputs,sort_keys=True,default=str),
+                             size,files,now,now))
+      finally:
+         connection.close()
+
+
+   def touchEntry(self,simToolName,simToolRevision,cacheKey):
+      """Record an access to a cache entry.
+
+         Returns:
+             True if the entry is in the index.
+      """
+      connection = self.__connect()
+      try:
+         cursor = connection.execute("""UPDATE entries SET lastAccess = ?, accessCount = accessCount + 1
+                                           WHERE simToolName = ? AND simToolRevision = ? AND cacheKey = ?""",
+                                     (time.time(),simToolName,simToolRevision,cacheKey))
+         indexed = cursor.rowcount > 0
+      finally:
+         connection.close()
+
+      return indexed
+
+
+   def removeEntry(self,simToolName,simToolRevision,cacheKey):
+      """Remove a cache entry from the index."""
+      connection = self.__connect()
+      try:
+         connection.execute("DELETE FROM entries WHERE simToolName = ? AND simToolRevision = ? AND cacheKey = ?",
+                            (simToolName,simToolRevision,cacheKey))
+      finally:
+         connection.close()
+
+
+   def getCachedKeys(self,simToolName,simToolRevision,cacheKeys):
+      """Find which of a set of cache entries are in the index.
+
+         Args:
+             simToolName: SimTool name.
+             simToolRevision: SimTool revision.
+             cacheKeys: List of cache entry names.
+         Returns:
+             Set of the cacheKeys that are in the index.
+      """
+      cachedKeys = set()
+      cacheKeys = list(cacheKeys)
+      connection = self.__connect()
+      try:
+         for chunkStart in range(0,len(cacheKeys),CacheIndex.QUERYCHUNKSIZE):
+            chunk = cacheKeys[chunkStart:chunkStart+CacheIndex.QUERYCHUNKSIZE]
+            query = """SELECT cacheKey FROM entries
+                          WHERE simToolName = ? AND simToolRevision = ? AND cacheKey IN (%s)""" % (','.join('?'*len(chunk)))
+            for row in connection.execute(query,[simToolName,simToolRevision] + chunk):
+               cachedKeys.add(row[0])
+      finally:
+         connection.close()
+
+      return cachedKeys
+
+
+   def getEntries(self,simToolName=None,simToolRevision=None):
+      """Get the recorded cache entries.
+
+         Args:
+             simToolName: Only entries for this SimTool.
+             simToolRevision: Only entries for this revision.
+         Returns:
+             List of dictionaries, one per entry, least recently used first.
+      """
+      conditions = []
+      parameters = []
+      if simToolName is not None:
+         conditions.append("simToolName = ?")
+         parameters.append(simToolName)
+      if simToolRevision is not None:
+         conditions.append("simToolRevision = ?")
+         parameters.append(simToolRevision)
+      query = """SELECT simToolName,simToolRevision,cacheKey,inputs,size,files,created,lastAccess,accessCount
+                    FROM entries"""
+      if conditions:
+         query += " WHERE " + " AND ".join(conditions)
+      query += " ORDER BY lastAccess"
+
+      entries = []
+      connection = self.__connect()
+      try:
+         for row in connection.execute(query,parameters):
+            entry = {}
+            entry['simToolName']     = row[0]
+            entry['simToolRevision'] = row[1]
+            entry['cacheKey']        = row[2]
+            entry['inputs']          = json.loads(row[3]) if row[3] is not None else None
+            entry['size']            = row[4]
+            entry['files']           = row[5]
+            entry['created']         = row[6]
+            entry['lastAccess']      = row[7]
+            entry['accessCount']     = row[8]
+            entries.append(entry)
+      finally:
+         connection.close()
+
+      return entries
+
+
+   def getStats(self,simToolName=None):
+      """Get cache usage per SimTool revision.
+
+         Args:
+             simToolName: Only report this SimTool.
+         Returns:
+             List of dictionaries with simToolName, simToolRevision, entries, size and files.
+      """
+      query = """SELECT simToolName,simToolRevision,COUNT(*),SUM(size),SUM(files) FROM entries"""
+      parameters = []
+      if simToolName is not None:
+         query += " WHERE simToolName = ?"
+         parameters.append(simToolName)
+      query += " GROUP BY simToolName,simToolRevision ORDER BY simToolName,simToolRevision"
+
+      stats = []
+      connection = self.__connect()
+      try:
+         for row in connection.execute(query,parameters):
+            simToolStats = {}
+            simToolStats['simToolName']     = row[0]
+            simToolStats['simToolRevision'] = row[1]
+            simToolStats['entries']         = row[2]
+            simToolStats['size']            = row[3]
+            simToolStats['files']           = row[4]
+            stats.append(simToolStats)
+      finally:
+         connection.close()
+
+      return stats
+
@@ -0,0 +1,337 @@
+# @package      hubzero-simtool
+# @file         cacheserver.py
+# @copyright    Copyright (c) 2019-2021 The Regents of the University of California.
+# @license      http://opensource.org/licenses/MIT MIT
+# @trademark    HUBzero is a registered trademark of The Regents of the University of California.
+#
+"""Stand-in for the results cache web service used by WSDataStore.
+
+   Implements the squidid, squidlist and files endpoints of the service, the
+   squidids endpoint for batch lookups and the squidfile and squidcommit
+   endpoints used for chunked uploads.  Files
+   are kept once by checksum under the server root.  Intended for tests and
+   benchmarks, run it with
+
+      python -m simtool.cacheserver --root DIRECTORY --port 8000
+"""
+import os
+import sys
+import json
+import uuid
+import hashlib
+import argparse
+import threading
+import email.parser
+import email.policy
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+CHUNKSIZE = 1024*1024
+
+
+def _getFileChecksum(path):
+   checksum = hashlib.sha256()
+   with open(path,'rb') as fp:
+      while True:
+         block = fp.read(CHUNKSIZE)
+         if not block:
+            break
+         checksum.update(block)
+
+   return checksum.hexdigest()
+
+
+class CacheStore:
+   """
+   Storage of a stand-in cache server.
+
+   blobs/<checksum> holds file contents, entries/<squidid>.json maps the file
+   names of each entry to checksums and staged/ holds partially uploaded files.
+   """
+
+   def __init__(self,root):
+      self.root       = root
+      self.blobsDir   = os.path.join(root,'blobs')
+      self.entriesDir = os.path.join(root,'entries')
+      self.stagedDir  = os.path.join(root,'staged')
+      for directory in [self.blobsDir,self.entriesDir,self.stagedDir]:
+         os.makedirs(directory,exist_ok=True)
+      self.lock = threading.Lock()
+      self.stagedLocks = {}
+# files uploaded for entries not committed yet
+      self.uploaded = {}
+
+
+   @staticmethod
+   def getSquidId(simtoolName,simtoolRevision,inputs):
+      squid = json.dumps({'simtoolName':simtoolName,'simtoolRevision':simtoolRevision,'inputs':inputs},
+                         sort_keys=True,separators=(',',':'))
+      return hashlib.sha256(squid.encode('utf-8')).hexdigest()
+
+
+   def getBlobPath(self,checksum):
+      return os.path.join(self.blobsDir,checksum)
+
+
+   def __getEntryPath(self,squidid):
+      return os.path.join(self.entriesDir,hashlib.sha256(squidid.encode('utf-8')).hexdigest() + '.json')
+
+
+   def __getStagedPath(self,squidid,name):
+      return os.path.join(self.stagedDir,hashlib.sha256((squidid + '/' + name).encode('utf-8')).hexdigest())
+
+
+   def getEntry(self,squidid):
+      try:
+         with open(self.__getEntryPath(squidid),'r') as fp:
+            return json.load(fp)
+      except FileNotFoundError:
+         return None
+
+
+   def __setEntry(self,squidid,files):
+      entryPath = self.__getEntryPath(squidid)
+      temporaryPath = '%s.%s' % (entryPath,uuid.uuid4().hex)
+      with open(temporaryPath,'w') as fp:
+         json.dump(files,fp)
+      os.replace(temporaryPath,entryPath)
+
+
+   def getFileList(self,squidid):
+      files = self.getEntry(squidid) or {}
+      return [ {'name':name,'id':checksum,'checksum':checksum,'size':os.path.getsize(self.getBlobPath(checksum))}
+               for name,checksum in files.items() ]
+
+
+   def addBlob(self,path):
+      # Move a file to the blob store, returns its checksum.
+      checksum = _getFileChecksum(path)
+      blobPath = self.getBlobPath(checksum)
+      if os.path.exists(blobPath):
+         os.unlink(path)
+      else:
+         os.replace(path,blobPath)
+      return checksum
+
+
+   def putFiles(self,squidid,files):
+      # Replace an entry by files given as (name,content) pairs.
+      entry = {}
+      for name,content in files:
+         temporaryPath = os.path.join(self.stagedDir,uuid.uuid4().hex)
+         with open(temporaryPath,'wb') as fp:
+            fp.write(content)
+         entry[name] = self.addBlob(temporaryPath)
+      with self.lock:
+         self.__setEntry(squidid,entry)
+
+
+   def getUploadStatus(self,squidid,name,checksum):
+      # Files with content already held are not uploaded again.
+      if checksum and os.path.exists(self.getBlobPath(checksum)):
+         with self.lock:
+            self.uploaded.setdefault(squidid,{})[name] = checksum
+         return {'size':os.path.getsize(self.getBlobPath(checksum)),'complete':True}
+      try:
+         size = os.path.getsize(self.__getStagedPath(squidid,name))
+      except FileNotFoundError:
+         size = 0
+      return {'size':size,'complete':False}
+
+
+   def __getStagedLock(self,stagedPath):
+      with self.lock:
+         return self.stagedLocks.setdefault(stagedPath,threading.Lock())
+
+
+   def putChunk(self,squidid,name,checksum,size,offset,content):
+      stagedPath = self.__getStagedPath(squidid,name)
+      with self.__getStagedLock(stagedPath):
+         try:
+            stagedSize = os.path.getsize(stagedPath)
+         except FileNotFoundError:
+            stagedSize = 0
+# chunk does not follow the data received, the client resumes from the staged size
+         if offset != stagedSize:
+            return {'size':stagedSize,'complete':False}
+         with open(stagedPath,'ab') as fp:
+            fp.write(content)
+         stagedSize += len(content)
+         if stagedSize < size:
+            return {'size':stagedSize,'complete':False}
+         if stagedSize > size or _getFileChecksum(stagedPath) != checksum:
+            os.unlink(stagedPath)
+            raise ValueError("upload of %s does not match its size and checksum" % (name))
+         self.addBlob(stagedPath)
+         with self.lock:
+            self.uploaded.setdefault(squidid,{})[name] = checksum
+
+      return {'size':stagedSize,'complete':True}
+
+
+   def commit(self,squidid,names):
+      with self.lock:
+         uploaded = self.uploaded.get(squidid,{})
+         missing = [ name for name in names if name not in uploaded ]
+         if missing:
+            raise ValueError("files not uploaded: %s" % (', '.join(missing)))
+         self.__setEntry(squidid,{ name:uploaded[name] for name in names })
+         del self.uploaded[squidid]
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+
+   def log_message(self,format,*args):
+      if self.server.verbose:
+         BaseHTTPRequestHandler.log_message(self,format,*args)
+
+
+   def __readBody(self):
+      length = int(self.headers.get('Content-Length') or 0)
+      return self.rfile.read(length)
+
+
+   def __sendJSON(self,content,status=200):
+      body = json.dumps(content).encode('utf-8')
+      self.send_response(status)
+      self.send_header('Content-Type','application/json')
+      self.send_header('Content-Length',str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+
+   def __sendError(self,status,message):
+      self.__sendJSON({'error':message},status)
+
+
+   def __getRequest(self):
+      url = urllib.parse.urlsplit(self.path)
+      endpoint = url.path.strip('/').split('/')
+      query = dict(urllib.parse.parse_qsl(url.query,keep_blank_values=True))
+      return endpoint,query
+
+
+   def do_GET(self):
+      store = self.server.store
+      endpoint,query = self.__getRequest()
+      body = self.__readBody()
+      try:
+         if   endpoint == ['squidid']:
+            request = json.loads(body)
+            self.__sendJSON({'id':CacheStore.getSquidId(request['simtoolName'],request['simtoolRevision'],
+                                                        request['inputs'])})
+         elif endpoint == ['squidids']:
+            request = json.loads(body)
+            lookups = []
+            for inputs in request['inputsList']:
+               squidid = CacheStore.getSquidId(request['simtoolName'],request['simtoolRevision'],inputs)
+               lookups.append({'id':squidid,'cached':bool(store.getEntry(squidid))})
+            self.__sendJSON(lookups)
+         elif endpoint == ['squidlist']:
+            self.__sendJSON(store.getFileList(json.loads(body)['squidid']))
+         elif endpoint == ['squidfile']:
+            self.__sendJSON(store.getUploadStatus(query['squidid'],query['name'],query.get('checksum')))
+         elif len(endpoint) == 2 and endpoint[0] == 'files':
+            self.__sendFile(store.getBlobPath(os.path.basename(endpoint[1])))
+         else:
+            self.__sendError(404,"unknown endpoint")
+      except (ValueError,KeyError) as err:
+         self.__sendError(400,str(err))
+
+
+   def __sendFile(self,path):
+      try:
+         fp = open(path,'rb')
+      except FileNotFoundError:
+         self.__sendError(404,"file not found")
+         return
+      with fp:
+         self.send_response(200)
+         self.send_header('Content-Type','application/octet-stream')
+         self.send_header('Content-Length',str(os.fstat(fp.fileno()).st_size))
+         self.end_headers()
+         while True:
+            block = fp.read(CHUNKSIZE)
+            if not block:
+               break
+            self.wfile.write(block)
+
+
+   def do_PUT(self):
+      store = self.server.store
+      endpoint,query = self.__getRequest()
+      body = self.__readBody()
+      try:
+         if   endpoint == ['squidlist']:
+            squidid,files = self.__parseMultipart(body)
+            store.putFiles(squidid,files)
+            self.__sendJSON({'squidid':squidid,'files':len(files)})
+         elif endpoint == ['squidfile']:
+            self.__sendJSON(store.putChunk(query['squidid'],query['name'],query['checksum'],
+                                           int(query['size']),int(query['offset']),body))
+         elif endpoint == ['squidcommit']:
+            request = json.loads(body)
+            store.commit(request['squidid'],request['files'])
+            self.__sendJSON({'squidid':request['squidid'],'files':len(request['files'])})
+         else:
+            self.__sendError(404,"unknown endpoint")
+      except (ValueError,KeyError) as err:
+         self.__sendError(400,str(err))
+
+
+   def __parseMultipart(self,body):
+      header = ('Content-Type: %s\r\n\r\n' % (self.headers['Content-Type'])).encode('utf-8')
+      message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + body)
+      squidid = None
+      files = []
+      for part in message.iter_parts():
+         fieldName = part.get_param('name',header='content-disposition')
+         if   fieldName == 'squidid':
+            squidid = part.get_payload(decode=True).decode('utf-8')
+         elif fieldName == 'file':
+            files.append((part.get_filename(),part.get_payload(decode=True)))
+      if squidid is None:
+         raise ValueError("squidid is required")
+
+      return squidid,files
+
+
+class CacheServer(ThreadingHTTPServer):
+   """
+   Stand-in cache web service, WSDataStore URL is http://HOST:PORT/
+   """
+
+   def __init__(self,root,host='127.0.0.1',port=0,verbose=False):
+      self.store   = CacheStore(root)
+      self.verbose = verbose
+      ThreadingHTTPServer.__init__(self,(host,port),CacheRequestHandler)
+
+
+   def getURL(self):
+      host,port = self.server_address[:2]
+      return "http://%s:%d/" % (host,port)
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description="stand-in sim2L results cache web service")
+   parser.add_argument('--root',required=True,help="directory holding the cached files")
+   parser.add_argument('--host',default='127.0.0.1',help="address to listen on, default 127.0.0.1")
+   parser.add_argument('--port',type=int,default=8000,help="port to listen on, default 8000")
+   parser.add_argument('--verbose',action='store_true',help="log requests")
+   args = parser.parse_args(argv)
+
+   server = CacheServer(args.root,host=args.host,port=args.port,verbose=args.verbose)
+   print("Serving %s at %s" % (args.root,server.getURL()))
+   try:
+      server.serve_forever()
+   except KeyboardInterrupt:
+      pass
+   finally:
+      server.server_close()
+
+   return 0
+
+
+if __name__ == '__main__':
+   sys.exit(main())
@@ -5,63 +5,731 @@
 # @trademark    HUBzero is a registered trademark of The Regents of the University of California.
 #
 import os
+import sys
+import ast
 import stat
 import json
-from joblib import Memory
+import time
 import uuid
+import fcntl
+import collections
+import contextlib
+import pickle
+import hashlib
 import shutil
-import warnings
+import tempfile
+import gzip
+import sqlite3
+import asyncio
+import threading
+import concurrent.futures
 import requests
+from requests.adapters import HTTPAdapter
 import traceback
+try:
+   import zstandard
+except ImportError:
+   zstandard = None
+from .cacheindex import CacheIndex, getTreeSize, BLOBMANIFEST
 
-class FileDataStore:
+FICLONE = 0x40049409  # Linux ioctl sharing the data blocks of two files
+
+def _reflinkFile(sourcePath,destinationPath):
+   # Copy on write clone of a file, supported by btrfs, XFS and others.
+   with open(sourcePath,'rb') as fsrc:
+      fd = os.open(destinationPath,os.O_WRONLY | os.O_CREAT | os.O_EXCL,0o600)
+      try:
+         fcntl.ioctl(fd,FICLONE,fsrc.fileno())
+      except:
+         os.close(fd)
+         os.unlink(destinationPath)
+         raise
+      os.close(fd)
+   shutil.copystat(sourcePath,destinationPath)
+
+
+def _compressFile(compression,sourcePath,destinationPath):
+   with open(sourcePath,'rb') as fsrc:
+      if compression == 'zstd':
+         with open(destinationPath,'wb') as fp:
+            with zstandard.ZstdCompressor().stream_writer(fp) as fdst:
+               shutil.copyfileobj(fsrc,fdst)
+      else:
+         with gzip.open(destinationPath,'wb',compresslevel=6) as fdst:
+            shutil.copyfileobj(fsrc,fdst)
+   shutil.copystat(sourcePath,destinationPath)
+
+
+def _decompressFile(compression,sourcePath,destinationPath):
+   # Decompressed to a temporary file first, a file with the final name is complete.
+   temporaryPath = '%s.%s' % (destinationPath,uuid.uuid4().hex)
+   try:
+      if compression == 'zstd':
+         if zstandard is None:
+            raise RuntimeError("zstandard is required to read %s" % (sourcePath))
+         with open(sourcePath,'rb') as fp:
+            with zstandard.ZstdDecompressor().stream_reader(fp) as fsrc:
+               with open(temporaryPath,'wb') as fdst:
+                  shutil.copyfileobj(fsrc,fdst)
+      else:
+         with gzip.open(sourcePath,'rb') as fsrc:
+            with open(temporaryPath,'wb') as fdst:
+               shutil.copyfileobj(fsrc,fdst)
+      os.chmod(temporaryPath,stat.S_IMODE(os.stat(sourcePath).st_mode) | stat.S_IWUSR)
+      os.replace(temporaryPath,destinationPath)
+   except:
+      if os.path.exists(temporaryPath):
+         os.unlink(temporaryPath)
+      raise
+
+
+def _getFileChecksum(path):
+   checksum = hashlib.sha256()
+   with open(path,'rb') as fp:
+      while True:
+         block = fp.read(1024*1024)
+         if not block:
+            break
+         checksum.update(block)
+
+   return checksum.hexdigest()
+
+
+class _DataUnpickler(pickle.Unpickler):
+   # Loads plain data only, pickles naming classes or functions are refused.
+   def find_class(self,module,name):
+      raise pickle.UnpicklingError("%s.%s is not allowed" % (module,name))
+
+
+def _linkCachedFile(sourcePath,destinationPath,compression):
+   if compression:
+      _decompressFile(compression,sourcePath,destinationPath)
+   else:
+      os.symlink(sourcePath,destinationPath)
+
+
+_session     = None
+_sessionLock = threading.Lock()
+
+def _getSession():
+   # Connections to the web service are kept alive and shared by all threads.
+   global _session
+   with _sessionLock:
+      if _session is None:
+         session = requests.Session()
+         adapter = HTTPAdapter(pool_connections=WSDataStore.DOWNLOADTHREADS,
+                               pool_maxsize=max(WSDataStore.DOWNLOADTHREADS,ASYNCTHREADS))
+         session.mount('http://',adapter)
+         session.mount('https://',adapter)
+         _session = session
+   return _session
+
+
+def _downloadCacheFile(cacheLocationRoot,fileId,path):
+   # The body is written as it arrives, memory use does not depend on the file size.
+   if os.path.dirname(path):
+      os.makedirs(os.path.dirname(path),exist_ok=True)
+   temporaryPath = '%s.%s' % (path,uuid.uuid4().hex)
+   try:
+      with _getSession().get(cacheLocationRoot + "files/" + fileId,
+                             headers = {"Cache-Control": "no-cache"},
+                             params = {"download": "true"},
+                             stream = True
+                            ) as r:
+         r.raise_for_status()
+         with open(temporaryPath, 'wb') as fp:
+            for chunk in r.iter_content(chunk_size=WSDataStore.DOWNLOADCHUNKSIZE):
+               fp.write(chunk)
+      os.replace(temporaryPath,path)
+   except:
+      if os.path.exists(temporaryPath):
+         os.unlink(temporaryPath)
+      raise
+
+
+# squidids found by WSDataStore.lookupMany, most recently used last
+_squidIds     = collections.OrderedDict()
+_squidIdsLock = threading.Lock()
+
+
+# Files of a partially read cache entry, they are fetched when first read
+PENDINGFILES = '.simtool_cache_pending.json'
+
+def _writePendingFiles(directory,dataStore,location,files):
+   with open(os.path.join(directory,PENDINGFILES),'w') as fp:
+      json.dump({'version':1,'dataStore':dataStore,'location':location,'files':files},fp)
+
+
+def _readPendingFiles(directory):
+   try:
+      with open(os.path.join(directory,PENDINGFILES),'r') as fp:
+         return json.load(fp)
+   except FileNotFoundError:
+      return None
+
+
+def _fetchPendingFile(pendingFiles,directory,path):
+   # Returns False if the file is not part of the cached results.
+   pendingFile = pendingFiles['files'].get(os.path.normpath(path))
+   if pendingFile is None:
+      return False
+
+   destinationPath = os.path.join(directory,path)
+   if pendingFiles['dataStore'] == 'WSDataStore':
+      _downloadCacheFile(pendingFiles['location'],pendingFile['id'],destinationPath)
+   else:
+      compression = pendingFile['compression']
+      sourcePath = os.path.join(pendingFiles['location'],path)
+      if compression:
+         sourcePath += FileDataStore.COMPRESSIONSUFFIXES[compression]
+      if os.path.dirname(destinationPath):
+         os.makedirs(os.path.dirname(destinationPath),exist_ok=True)
+      try:
+         _linkCachedFile(sourcePath,destinationPath,compression)
+      except FileExistsError:
+         pass
+
+   return True
+
+
+def _fetchPendingFiles(directory):
+   # Fetch the files of a partially read cache entry not read yet.
+   pendingFiles = _readPendingFiles(directory)
+   if pendingFiles is None:
+      return False
+   for path in pendingFiles['files']:
+      if not os.path.lexists(os.path.join(directory,path)):
+         _fetchPendingFile(pendingFiles,directory,path)
+   os.unlink(os.path.join(directory,PENDINGFILES))
+
+   return True
+
+
+ASYNCTHREADS = 64 # threads doing the blocking I/O of async data store methods
+
+_asyncExecutor     = None
+_asyncExecutorLock = threading.Lock()
+
+def _getAsyncExecutor():
+   global _asyncExecutor
+   with _asyncExecutorLock:
+      if _asyncExecutor is None:
+         _asyncExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNCTHREADS,
+                                                                thread_name_prefix='simtool-datastore')
+   return _asyncExecutor
+
+
+class AsyncDataStore:
+   """
+   asyncio counterparts of the data store methods.
+
+   The blocking methods run in a pool of ASYNCTHREADS threads shared by all
+   data stores, an event loop can keep that many cache operations in flight.
+   """
+
+   async def aexists(self):
+      """Awaitable exists()."""
+      return await asyncio.get_running_loop().run_in_executor(_getAsyncExecutor(),self.exists)
+
+
+   async def aread_cache(self,outdir):
+      """Awaitable read_cache()."""
+      return await asyncio.get_running_loop().run_in_executor(_getAsyncExecutor(),self.read_cache,outdir)
+
+
+   async def awrite_cache(self,sourcedir,prerunFiles,savedOutputFiles):
+      """Awaitable write_cache()."""
+      return await asyncio.get_running_loop().run_in_executor(_getAsyncExecutor(),self.write_cache,
+                                                              sourcedir,prerunFiles,savedOutputFiles)
+
+
+   @classmethod
+   async def aexistsMany(cls,simtoolName,simtoolRevision,inputsList,cacheLocationRoot=None):
+      """Awaitable existsMany()."""
+      return await asyncio.get_running_loop().run_in_executor(_getAsyncExecutor(),cls.existsMany,
+                                                              simtoolName,simtoolRevision,inputsList,cacheLocationRoot)
+
+
+_runLocks     = {} # cache entry directory: [number of data stores using the lock, lock held by the run]
+_runLocksLock = threading.Lock()
+
+_entryReaders     = {} # cache entry directory: [number of threads reading it, fd holding its shared lock]
+_entryReadersLock = threading.Lock()
+
+
+class FileDataStore(AsyncDataStore):
    """
    A data store implemented on a shared file system.
    """
    USERCACHELOCATIONROOT = os.path.expanduser('~/data')
+   CACHEKEYVERSION       = '1'  # change when the cache key computation changes
+   CACHEINDEX            = True # keep a CacheIndex of entries in each cache root
+   CACHEQUOTA            = None # bytes allowed in a cache root, None for no limit
+   SIMTOOLCACHEQUOTA     = None # bytes allowed for each sim2L in a cache root, None for no limit
+   EVICTIONPOLICY        = 'LRU' # LRU (least recently used) or LFU (least frequently used)
+   EVICTIONMINAGE        = 600  # seconds after the last access before an entry can be evicted
+   COMPLETEMARKER        = '.simtool_cache_complete' # written to entries as they are published
+   LEGACYENTRYAGE        = 3600 # seconds after which entries written without a marker are complete
+   RUNLOCKPOLL           = 1.   # seconds between attempts to get the lock held by an identical run
+# How files are put in the cache, falling back to the next method when one fails
+#    hardlink - hardlink, reflink or copy.  The run directory and cache share the files,
+#               files of the run directory must not be changed once cached.
+#    reflink  - reflink or copy
+#    copy     - copy
+# Only files of the run directory are linked, files reached through symbolic links are copied.
+   LINKMODE              = 'copy'
+   BLOBSTORE             = False # store files once by content in .simtool_blobs, entries hardlink to them
+   BLOBMANIFEST          = BLOBMANIFEST # files of an entry stored in the blob store
+   COMPRESSION           = None # gzip or zstd (gzip if zstandard is not installed), None to store files as is
+   COMPRESSIONTHRESHOLD  = 1024*1024 # bytes, smaller files are stored as is
+   COMPRESSIONSUFFIXES   = {'gzip':'.gz','zstd':'.zst'}
+# already compressed formats
+   COMPRESSIONSKIPSUFFIXES = ['.gz','.zst','.bz2','.xz','.zip','.npz','.png','.jpg','.jpeg','.gif','.mp4']
+   COMPRESSIONMANIFEST   = '.simtool_compressed.json' # compressed files of an entry
+# Compressed files other than notebooks are linked into the run directory
+# under their compressed name and decompressed the first time readFile reads them
+   DECOMPRESSONREAD      = False
+# read_cache links the run directory to the cache entry instead of linking each file,
+# entries with compressed files are still linked file by file
+   LAZYREAD              = False
+# read_cache only retrieves notebooks, the other files are retrieved when first read
+   PARTIALREAD           = False
+   CACHEENTRYLINK        = '.simtool_cache_entry' # link to the cache entry in lazily read run directories
 
-   def __init__(self,simtoolName,simtoolRevision,inputs,cacheLocationRoot=None):
+   def __init__(self,simtoolName,simtoolRevision,inputs,cacheLocationRoot=None,linkMode=None):
 
       if cacheLocationRoot:
          self.cacheLocationRoot = cacheLocationRoot
       else:
          self.cacheLocationRoot = FileDataStore.USERCACHELOCATIONROOT
 
+      self.linkMode = linkMode or FileDataStore.LINKMODE
+      if not self.linkMode in ['hardlink','reflink','copy']:
+         raise ValueError("Unknown link mode: %s" % (self.linkMode))
+
       self.cachedir    = os.path.join(self.cacheLocationRoot,'.simtool_cache',simtoolName,simtoolRevision)
+# joblib tables used to map inputs to cache entries by earlier versions
       self.cachetabdir = os.path.join(self.cacheLocationRoot,'.simtool_cache_table',simtoolName,simtoolRevision)
 
 #     print(simtoolName,simtoolRevision)
 #     print(self.cacheLocationRoot)
 #     print("cachedir    = %s" % (self.cachedir))
 #     print("cachetabdir = %s" % (self.cachetabdir))
-      if not os.path.isdir(self.cachedir):
-         os.makedirs(self.cachedir)
+      self.simtoolName     = simtoolName
+      self.simtoolRevision = simtoolRevision
+      self.inputs          = inputs
+      self.cacheKey        = FileDataStore.getCacheKey(inputs)
+      self.rdir = os.path.join(self.cachedir,self.cacheKey)
+      self.blobdir         = FileDataStore.__getBlobDirectory(self.cacheLocationRoot)
+      self.runLockFd       = None
+      self.runLock         = None
 
-      memory = Memory(cachedir=self.cachetabdir, verbose=0)
 
-      @memory.cache
-      def make_rname(*args):
-         # uuid should be unique, but check just in case
-         while True:
-            fname = str(uuid.uuid4()).replace('-', '')
-            if not os.path.isdir(os.path.join(self.cachedir, fname)):
-               break
-         return fname
+   @staticmethod
+   def getCacheKey(inputs):
+      """Get the cache entry name for a set of inputs.
+
+      The name is a hash of the canonical JSON representation of the inputs,
+      the same inputs always map to the same cache entry.
+
+      Args:
+          inputs: Dictionary of input values as made by _get_inputs_cache_dict.
+      Returns:
+          The cache entry name.
+      """
+      def toJSON(obj):
+         # numpy values
+         if hasattr(obj,'tolist'):
+            return obj.tolist()
+         raise TypeError("Object of type %s is not JSON serializable" % (type(obj).__name__))
+
+      canonicalInputs = json.dumps(inputs,sort_keys=True,separators=(',',':'),ensure_ascii=True,default=toJSON)
+
+      return hashlib.sha256((FileDataStore.CACHEKEYVERSION + canonicalInputs).encode('utf-8')).hexdigest()
+
+
+   @staticmethod
+   def existsMany(simtoolName,simtoolRevision,inputsList,cacheLocationRoot=None):
+      """Check for cached results for several sets of inputs.
+
+      The cache index is used when enabled, otherwise each entry is checked.
+
+      Args:
+          simtoolName: SimTool name.
+          simtoolRevision: SimTool revision.
+          inputsList: List of input dictionaries as made by _get_inputs_cache_dict.
+          cacheLocationRoot: Cache root, default is USERCACHELOCATIONROOT.
+      Returns:
+          List of booleans in the order of inputsList.
+      """
+      dstores = [ FileDataStore(simtoolName,simtoolRevision,inputs,cacheLocationRoot) for inputs in inputsList ]
+      if dstores and FileDataStore.CACHEINDEX:
+         try:
+            cachedKeys = dstores[0].__getIndex().getCachedKeys(simtoolName,simtoolRevision,
+                                                               [dstore.cacheKey for dstore in dstores])
+         except (sqlite3.Error,OSError):
+            pass
+         else:
+            return [ dstore.cacheKey in cachedKeys for dstore in dstores ]
+
+      return [ dstore.exists() for dstore in dstores ]
+
+
+   def __getIndex(self):
+      return CacheIndex(self.cacheLocationRoot)
+
+
+   @staticmethod
+   def __getBlobDirectory(cacheLocationRoot):
+      return os.path.join(cacheLocationRoot,'.simtool_blobs')
+
+
+   @staticmethod
+   def __getBlobPath(blobdir,blobName):
+      return os.path.join(blobdir,blobName[:2],blobName)
+
+
+   def __linkBlob(self,filePath,blobPath):
+      os.makedirs(os.path.dirname(blobPath),exist_ok=True)
+      linkPath = '%s.%s' % (filePath,uuid.uuid4().hex)
+      try:
+         os.link(blobPath,linkPath)
+      except FileNotFoundError:
+# first file with this content becomes the blob, a file shared with the run directory is copied first
+         if os.lstat(filePath).st_nlink > 1:
+            shutil.copy2(filePath,linkPath)
+            os.replace(linkPath,filePath)
+         try:
+            os.link(filePath,blobPath)
+         except FileExistsError:
+            os.link(blobPath,linkPath)
+         else:
+            return
+      os.replace(linkPath,filePath)
 
-#
-# suppress this message:
-#
-# UserWarning: Persisting input arguments took 0.84s to run.
-# If this happens often in your code, it can cause performance problems
-# (results will be correct in all cases).
-# The reason for this is probably some large input arguments for a wrapped
-# function (e.g. large strings).
-# THIS IS A JOBLIB ISSUE. If you can, kindly provide the joblib's team with an
-# example so that they can fix the problem.
-#
-      with warnings.catch_warnings():
-         warnings.simplefilter('ignore')
-         self.rdir = os.path.join(self.cachedir, make_rname(inputs))
+
+   def __storeBlobs(self,stagingdir):
+      # Replace the files of a staged entry by hardlinks to blobs named by
+      # their content and permissions.  The number of links to a blob is
+      # its reference count, a blob with one link is not used by any entry.
+      blobs = {}
+      for rootDir,dirNames,fileNames in os.walk(stagingdir):
+         for fileName in fileNames:
+            filePath = os.path.join(rootDir,fileName)
+            fileStat = os.lstat(filePath)
+            if not stat.S_ISREG(fileStat.st_mode):
+               continue
+            blobName = '%s.%03o' % (_getFileChecksum(filePath),stat.S_IMODE(fileStat.st_mode))
+            try:
+               self.__linkBlob(filePath,FileDataStore.__getBlobPath(self.blobdir,blobName))
+            except OSError:
+# the entry keeps its own copy
+               continue
+            blobs[os.path.relpath(filePath,stagingdir)] = blobName
+
+      with open(os.path.join(stagingdir,FileDataStore.BLOBMANIFEST),'w') as fp:
+         json.dump({'version':1,'blobs':blobs},fp)
+      os.chmod(os.path.join(stagingdir,FileDataStore.BLOBMANIFEST),0o644)
+
+
+   @staticmethod
+   def __removeEntryDirectory(cacheLocationRoot,rdir):
+      # Remove an entry that is no longer visible and the blobs only it used.
+      # Returns the number of bytes of the blobs removed.
+      try:
+         with open(os.path.join(rdir,FileDataStore.BLOBMANIFEST),'r') as fp:
+            blobNames = set(json.load(fp)['blobs'].values())
+      except (OSError,ValueError,KeyError):
+         blobNames = set()
+      shutil.rmtree(rdir,ignore_errors=True)
+
+      blobSize = 0
+      blobdir = FileDataStore.__getBlobDirectory(cacheLocationRoot)
+      for blobName in blobNames:
+         blobPath = FileDataStore.__getBlobPath(blobdir,blobName)
+         try:
+            blobStat = os.stat(blobPath)
+            if blobStat.st_nlink == 1:
+               os.unlink(blobPath)
+               blobSize += blobStat.st_size
+         except OSError:
+            pass
+
+      return blobSize
+
+
+   def __updateIndex(self,cached):
+      # the index is advisory, errors do not affect caching
+      if FileDataStore.CACHEINDEX:
+         try:
+            cacheIndex = self.__getIndex()
+            if   not cached:
+               cacheIndex.removeEntry(self.simtoolName,self.simtoolRevision,self.cacheKey)
+            elif not cacheIndex.touchEntry(self.simtoolName,self.simtoolRevision,self.cacheKey):
+               size,files = getTreeSize(self.rdir)
+               cacheIndex.addEntry(self.simtoolName,self.simtoolRevision,self.cacheKey,self.inputs,size,files)
+         except (sqlite3.Error,OSError):
+            pass
+
+
+   @staticmethod
+   def __getLockPath(rdir):
+      return rdir + '.lock'
+
+
+   @contextlib.contextmanager
+   def __readLock(self):
+      # Shared lock held while an entry is read, eviction needs an exclusive lock.
+      # Locks of lockf belong to the process, threads reading the same entry
+      # share one lock that is released by the last of them.
+      with _entryReadersLock:
+         entryReaders = _entryReaders.get(self.rdir)
+         if entryReaders is None:
+            try:
+               fd = os.open(FileDataStore.__getLockPath(self.rdir),os.O_RDWR | os.O_CREAT,0o644)
+            except OSError:
+# read only cache
+               fd = None
+            if fd is not None:
+               try:
+                  fcntl.lockf(fd,fcntl.LOCK_SH)
+               except:
+                  os.close(fd)
+                  raise
+            entryReaders = [0,fd]
+            _entryReaders[self.rdir] = entryReaders
+         entryReaders[0] += 1
+      try:
+         yield
+      finally:
+         with _entryReadersLock:
+            entryReaders[0] -= 1
+            if entryReaders[0] == 0:
+               del _entryReaders[self.rdir]
+               if entryReaders[1] is not None:
+                  os.close(entryReaders[1])
+
+
+   def lockRun(self,timeout):
+      """Get exclusive use of the cache entry for producing its results.
+
+      Identical runs in other threads and processes use the same lock, the
+      first to get it executes while the others wait for it to publish the
+      results.
+
+      Args:
+          timeout: Maximum seconds to wait for an identical run to finish.
+      Returns:
+          True if the lock was obtained, False if waiting timed out.
+      """
+      deadline = time.time() + timeout
+      waiting = False
+# lockf locks belong to the process, threads are kept apart by a lock of their own
+      with _runLocksLock:
+         runLock = _runLocks.setdefault(self.rdir,[0,threading.Lock()])
+         runLock[0] += 1
+      if not runLock[1].acquire(blocking=False):
+         print("Waiting for identical run in progress")
+         waiting = True
+         if not runLock[1].acquire(timeout=max(0.,deadline - time.time())):
+            FileDataStore.__releaseRunLock(self.rdir,runLock,False)
+            print("Identical run did not finish in %d seconds" % (timeout))
+            return False
+
+      runningPath = self.rdir + '.running'
+      while True:
+         try:
+            os.makedirs(self.cachedir,exist_ok=True)
+            fd = os.open(runningPath,os.O_RDWR | os.O_CREAT,0o644)
+         except OSError:
+# read only cache, there is no coordination with other processes
+            fd = None
+            break
+         try:
+            fcntl.lockf(fd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+         except OSError:
+            os.close(fd)
+            if time.time() >= deadline:
+               FileDataStore.__releaseRunLock(self.rdir,runLock,True)
+               print("Identical run did not finish in %d seconds" % (timeout))
+               return False
+            if not waiting:
+               print("Waiting for identical run in progress")
+               waiting = True
+            time.sleep(FileDataStore.RUNLOCKPOLL)
+         else:
+# the lock file is removed by unlockRun, a lock on a removed file is not held
+            try:
+               if os.path.samestat(os.fstat(fd),os.stat(runningPath)):
+                  break
+            except OSError:
+               pass
+            os.close(fd)
+
+      self.runLockFd = fd
+      self.runLock   = runLock
+      return True
+
+
+   @staticmethod
+   def __releaseRunLock(rdir,runLock,acquired):
+      if acquired:
+         runLock[1].release()
+      with _runLocksLock:
+         runLock[0] -= 1
+         if runLock[0] == 0:
+            del _runLocks[rdir]
+
+
+   def unlockRun(self):
+      """Release the lock obtained with lockRun()."""
+      if self.runLock is not None:
+         if self.runLockFd is not None:
+            try:
+               os.unlink(self.rdir + '.running')
+            except OSError:
+               pass
+            os.close(self.runLockFd)
+            self.runLockFd = None
+         FileDataStore.__releaseRunLock(self.rdir,self.runLock,True)
+         self.runLock = None
+
+
+   @staticmethod
+   def __evictEntry(cacheIndex,entry):
+      # Returns None if the entry is being read, otherwise the number of
+      # bytes of the blobs removed with the entry.
+      rdir = os.path.join(cacheIndex.cacheDirectory,entry['simToolName'],entry['simToolRevision'],entry['cacheKey'])
+      lockPath = FileDataStore.__getLockPath(rdir)
+      with _entryReadersLock:
+# entry is being read by this process, its lock would also be released by closing fd
+         if rdir in _entryReaders:
+            return None
+         try:
+            fd = os.open(lockPath,os.O_RDWR | os.O_CREAT,0o644)
+         except OSError:
+            return None
+         try:
+            try:
+               fcntl.lockf(fd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+# entry is being read by another process
+               return None
+            evictedDir = os.path.join(os.path.dirname(rdir),'.evicted.%s.%s' % (entry['cacheKey'],uuid.uuid4().hex))
+            try:
+               os.rename(rdir,evictedDir)
+            except FileNotFoundError:
+               evictedDir = None
+            os.unlink(lockPath)
+         finally:
+            os.close(fd)
+
+      cacheIndex.removeEntry(entry['simToolName'],entry['simToolRevision'],entry['cacheKey'])
+      blobSize = 0
+      if evictedDir:
+         blobSize = FileDataStore.__removeEntryDirectory(cacheIndex.cacheLocationRoot,evictedDir)
+
+      return blobSize
+
+
+   @staticmethod
+   def enforceQuota(cacheLocationRoot=None,quota=None,simToolQuota=None,policy=None):
+      """Evict cache entries until the cache is within its quotas.
+
+      Entries are evicted in the order given by the eviction policy.  Entries
+      that are being read or were accessed in the last EVICTIONMINAGE seconds
+      are kept.  Blobs count toward the cache root quota, they are shared by
+      entries and are not part of the sim2L quotas.
+
+      Args:
+          cacheLocationRoot: Cache root, default is USERCACHELOCATIONROOT.
+          quota: Bytes allowed in the cache root, default is CACHEQUOTA.
+          simToolQuota: Bytes allowed for each sim2L, default is SIMTOOLCACHEQUOTA.
+          policy: LRU or LFU, default is EVICTIONPOLICY.
+      Returns:
+          Tuple of the number of entries and bytes evicted.
+      """
+      cacheLocationRoot = cacheLocationRoot or FileDataStore.USERCACHELOCATIONROOT
+      quota             = quota if quota is not None else FileDataStore.CACHEQUOTA
+      simToolQuota      = simToolQuota if simToolQuota is not None else FileDataStore.SIMTOOLCACHEQUOTA
+      policy            = policy or FileDataStore.EVICTIONPOLICY
+      if   policy == 'LRU':
+         evictionOrder = lambda entry: entry['lastAccess']
+      elif policy == 'LFU':
+         evictionOrder = lambda entry: (entry['accessCount'],entry['lastAccess'])
+      else:
+         raise ValueError("Unknown eviction policy: %s" % (policy))
+
+      evictedEntries = 0
+      evictedSize    = 0
+      if quota is None and simToolQuota is None:
+         return evictedEntries,evictedSize
+
+      cacheIndex = CacheIndex(cacheLocationRoot)
+      simToolSizes = {}
+      for stats in cacheIndex.getStats():
+         simToolSizes[stats['simToolName']] = simToolSizes.get(stats['simToolName'],0) + stats['size']
+      blobSize = 0
+      if quota is not None:
+         blobSize = getTreeSize(FileDataStore.__getBlobDirectory(cacheLocationRoot))[0]
+      totalSize = sum(simToolSizes.values()) + blobSize
+      if (quota is None or totalSize <= quota) and \
+         (simToolQuota is None or max(simToolSizes.values(),default=0) <= simToolQuota):
+         return evictedEntries,evictedSize
+
+      youngest = time.time() - FileDataStore.EVICTIONMINAGE
+      entries = [ entry for entry in cacheIndex.getEntries() if entry['lastAccess'] < youngest ]
+      entries.sort(key=evictionOrder)
+      for entry in entries:
+         overSimToolQuota = simToolQuota is not None and simToolSizes[entry['simToolName']] > simToolQuota
+         overQuota        = quota is not None and totalSize > quota
+         if overSimToolQuota or overQuota:
+            blobSize = FileDataStore.__evictEntry(cacheIndex,entry)
+            if blobSize is not None:
+               simToolSizes[entry['simToolName']] -= entry['size']
+               totalSize                          -= entry['size'] + blobSize
+               evictedEntries += 1
+               evictedSize    += entry['size'] + blobSize
+
+      return evictedEntries,evictedSize
+
+
+   def __migrateJoblibCacheTable(self):
+      # Rename cache entries listed in the joblib table to their content
+      # based names.  Entries of the table are removed once renamed, the
+      # table is removed once all entries are renamed.
+      migrated = True
+      for rootDir,dirNames,fileNames in os.walk(self.cachetabdir):
+         if 'metadata.json' in fileNames and 'output.pkl' in fileNames:
+            try:
+               with open(os.path.join(rootDir,'metadata.json'),'r') as fp:
+                  metadata = json.load(fp)
+               inputs = ast.literal_eval(metadata['input_args']['*'])[0]
+               with open(os.path.join(rootDir,'output.pkl'),'rb') as fp:
+                  rname = _DataUnpickler(fp).load()
+               if not isinstance(rname,str) or os.path.basename(rname) != rname or rname in ['','.','..']:
+                  raise ValueError("%r is not an entry name" % (rname,))
+            except Exception:
+               migrated = False
+               continue
+            rdir = os.path.join(self.cachedir,FileDataStore.getCacheKey(inputs))
+            if os.path.isdir(os.path.join(self.cachedir,rname)) and not os.path.exists(rdir):
+               try:
+                  os.rename(os.path.join(self.cachedir,rname),rdir)
+               except OSError:
+                  migrated = False
+                  continue
+            dirNames[:] = []
+            shutil.rmtree(rootDir,ignore_errors=True)
+
+      if migrated:
+         try:
+            removedTableDir = self.cachetabdir + '.' + uuid.uuid4().hex
+            os.rename(self.cachetabdir,removedTableDir)
+         except OSError:
+            pass
+         else:
+            shutil.rmtree(removedTableDir,ignore_errors=True)
 
 
    def getSimToolSquidId(self):
@@ -73,18 +741,95 @@ class FileDataStore:
 
 
    @staticmethod
-   def __copySimToolTreeAsLinks(sdir,ddir):
+   def __copySimToolTreeAsLinks(sdir,ddir,compressedFiles,decompressOnRead=None):
+      if decompressOnRead is None:
+         decompressOnRead = FileDataStore.DECOMPRESSONREAD
+      def linkFile(sourcePath,destinationPath):
+         compression = compressedFiles.get(os.path.relpath(sourcePath,sdir))
+         if compression and (not decompressOnRead or
+                             destinationPath.endswith('.ipynb' + FileDataStore.COMPRESSIONSUFFIXES[compression])):
+            destinationPath = destinationPath[:-len(FileDataStore.COMPRESSIONSUFFIXES[compression])]
+         else:
+            compression = None
+         _linkCachedFile(sourcePath,destinationPath,compression)
+
       simToolFiles = os.listdir(sdir)
       for simToolFile in simToolFiles:
+         if simToolFile in [FileDataStore.COMPLETEMARKER,FileDataStore.BLOBMANIFEST,FileDataStore.COMPRESSIONMANIFEST]:
+            continue
          simToolPath = os.path.join(sdir,simToolFile)
          if os.path.isdir(simToolPath):
-            shutil.copytree(simToolPath,os.path.join(ddir,simToolFile),copy_function=os.symlink)
+            shutil.copytree(simToolPath,os.path.join(ddir,simToolFile),copy_function=linkFile)
          else:
-            os.symlink(simToolPath,os.path.join(ddir,simToolFile))
+            linkFile(simToolPath,os.path.join(ddir,simToolFile))
 
 
-   @staticmethod
-   def __copySimToolTree(spath,ddir):
+   def __compressFiles(self,stagingdir):
+      compression = FileDataStore.COMPRESSION
+      if compression == 'zstd' and zstandard is None:
+         compression = 'gzip'
+      suffix = FileDataStore.COMPRESSIONSUFFIXES[compression]
+
+      compressedFiles = {}
+      for rootDir,dirNames,fileNames in os.walk(stagingdir):
+         for fileName in fileNames:
+            if os.path.splitext(fileName)[1].lower() in FileDataStore.COMPRESSIONSKIPSUFFIXES:
+               continue
+# name of the compressed file is taken
+            if fileName + suffix in fileNames:
+               continue
+            filePath = os.path.join(rootDir,fileName)
+            fileStat = os.lstat(filePath)
+            if not stat.S_ISREG(fileStat.st_mode) or fileStat.st_size < FileDataStore.COMPRESSIONTHRESHOLD:
+               continue
+            compressedPath = filePath + suffix
+            _compressFile(compression,filePath,compressedPath)
+            if os.path.getsize(compressedPath) >= fileStat.st_size:
+               os.unlink(compressedPath)
+            else:
+               os.unlink(filePath)
+               compressedFiles[os.path.relpath(compressedPath,stagingdir)] = compression
+
+      if compressedFiles:
+         with open(os.path.join(stagingdir,FileDataStore.COMPRESSIONMANIFEST),'w') as fp:
+            json.dump({'version':1,'files':compressedFiles},fp)
+         os.chmod(os.path.join(stagingdir,FileDataStore.COMPRESSIONMANIFEST),0o644)
+
+
+   def __getCompressedFiles(self):
+      try:
+         with open(os.path.join(self.rdir,FileDataStore.COMPRESSIONMANIFEST),'r') as fp:
+            return json.load(fp)['files']
+      except FileNotFoundError:
+         return {}
+
+
+   def __copyFile(self,sourcePath,destinationPath,sourcedir):
+      # Files reached through symbolic links, such as the sim2L files, are
+      # copied, only files of the run directory sourcedir are hardlinked.
+      if os.path.lexists(destinationPath):
+# prerun file also saved as an output
+         os.unlink(destinationPath)
+      if self.linkMode == 'hardlink' and not os.path.islink(sourcePath) and \
+         os.path.realpath(sourcePath).startswith(os.path.join(os.path.realpath(sourcedir),'')):
+         try:
+            os.link(sourcePath,destinationPath,follow_symlinks=False)
+         except OSError:
+            pass
+         else:
+            return destinationPath
+      if self.linkMode in ['hardlink','reflink']:
+         try:
+            _reflinkFile(sourcePath,destinationPath)
+         except OSError:
+            pass
+         else:
+            return destinationPath
+
+      return shutil.copy2(sourcePath,destinationPath)
+
+
+   def __copySimToolTree(self,spath,ddir,sourcedir):
       if os.path.isdir(spath):
          sdir = os.path.realpath(os.path.abspath(spath))
          simToolFiles = os.listdir(sdir)
@@ -96,57 +841,241 @@ class FileDataStore:
          simToolFiles = [os.path.basename(spath)]
          destinationDir = ddir
 
+      def copyFile(sourcePath,destinationPath):
+         return self.__copyFile(sourcePath,destinationPath,sourcedir)
+
       for simToolFile in simToolFiles:
          simToolPath = os.path.join(sdir,simToolFile)
          if os.path.isdir(simToolPath):
-            shutil.copytree(simToolPath,os.path.join(destinationDir,simToolFile))
+            shutil.copytree(simToolPath,os.path.join(destinationDir,simToolFile),copy_function=copyFile)
          else:
-            shutil.copy2(simToolPath,os.path.join(destinationDir,simToolFile))
+            copyFile(simToolPath,os.path.join(destinationDir,simToolFile))
+
+
+   @staticmethod
+   def __isComplete(rdir):
+      # Only published entries are complete.  Entries written before
+      # publication was atomic have no marker, they are complete unless
+      # they may still be being written.
+      if os.path.exists(os.path.join(rdir,FileDataStore.COMPLETEMARKER)):
+         return True
+      try:
+         rdirMtime = os.stat(rdir).st_mtime
+      except OSError:
+         return False
+      return rdirMtime < time.time() - FileDataStore.LEGACYENTRYAGE
+
+
+   def exists(self):
+      # check for cached results without retrieving them
+      if FileDataStore.__isComplete(self.rdir):
+         return True
+      if os.path.isdir(self.cachetabdir):
+         self.__migrateJoblibCacheTable()
+         return FileDataStore.__isComplete(self.rdir)
+      return False
 
 
    def read_cache(self,outdir):
       # reads cache and copies contents to outdir
-      if os.path.exists(self.rdir):
-#        print("CACHED. Fetching results from %s" % (self.cacheLocationRoot))
-         self.__copySimToolTreeAsLinks(self.rdir,outdir)
-         return True
+      if self.exists():
+         with self.__readLock():
+# the entry may have been evicted while waiting for the lock
+            if FileDataStore.__isComplete(self.rdir):
+#              print("CACHED. Fetching results from %s" % (self.cacheLocationRoot))
+               compressedFiles = self.__getCompressedFiles()
+               if   FileDataStore.LAZYREAD and not compressedFiles:
+                  os.symlink(self.rdir,os.path.join(outdir,FileDataStore.CACHEENTRYLINK))
+               elif FileDataStore.PARTIALREAD:
+                  self.__readNotebooks(outdir,compressedFiles)
+               else:
+                  self.__copySimToolTreeAsLinks(self.rdir,outdir,compressedFiles)
+               self.__updateIndex(True)
+               return True
+      self.__updateIndex(False)
       return False
 
 
+   @contextlib.contextmanager
+   def readEntry(self):
+      """Hold the cache entry while its files are used.
+
+      The entry cannot be evicted until the context is left.
+
+      Yields:
+          A temporary directory linking the files of the entry as they were
+          written, None if the entry is not cached.
+      """
+      with self.__readLock():
+         if not FileDataStore.__isComplete(self.rdir):
+            yield None
+            return
+         entryDir = tempfile.mkdtemp(prefix='simtool_entry_')
+         try:
+            self.__copySimToolTreeAsLinks(self.rdir,entryDir,self.__getCompressedFiles(),decompressOnRead=False)
+            yield entryDir
+         finally:
+            shutil.rmtree(entryDir,ignore_errors=True)
+
+
+   def __readNotebooks(self,outdir,compressedFiles):
+      # Retrieve the notebooks of the entry, the other files are listed
+      # in the run directory and retrieved by resolvePath.
+      pendingFiles = {}
+      for rootDir,dirNames,fileNames in os.walk(self.rdir):
+         for fileName in fileNames:
+            if rootDir == self.rdir and \
+               fileName in [FileDataStore.COMPLETEMARKER,FileDataStore.BLOBMANIFEST,FileDataStore.COMPRESSIONMANIFEST]:
+               continue
+            entryPath = os.path.relpath(os.path.join(rootDir,fileName),self.rdir)
+            compression = compressedFiles.get(entryPath)
+            if compression:
+               filePath = entryPath[:-len(FileDataStore.COMPRESSIONSUFFIXES[compression])]
+            else:
+               filePath = entryPath
+            if filePath.endswith('.ipynb') and not os.path.dirname(filePath):
+               _linkCachedFile(os.path.join(self.rdir,entryPath),os.path.join(outdir,filePath),compression)
+            else:
+               pendingFiles[filePath] = {'compression':compression}
+
+      _writePendingFiles(outdir,'FileDataStore',self.rdir,pendingFiles)
+
+
+   @staticmethod
+   def resolvePath(directory,path):
+      """Get the location of a file of a run.
+
+      Files of runs read lazily from the cache are found in the cache entry,
+      files of runs read partially are retrieved.
+
+      Args:
+          directory: The run directory.
+          path: Path of the file relative to the run directory.
+      Returns:
+          The path of the file.
+      """
+      runPath = os.path.join(directory,path)
+      if not os.path.lexists(runPath):
+         entryPath = os.path.join(directory,FileDataStore.CACHEENTRYLINK,path)
+         if os.path.lexists(entryPath):
+            return entryPath
+         pendingFiles = _readPendingFiles(directory)
+         if pendingFiles is not None:
+            _fetchPendingFile(pendingFiles,directory,path)
+      return runPath
+
+
+   @staticmethod
+   def materialize(outdir):
+      """Link each file of a lazily or partially read cache entry into the run directory.
+
+      Files can then be added to the run directory or replaced.
+
+      Args:
+          outdir: The run directory.
+      Returns:
+          True if files were added to the run directory.
+      """
+      entryLink = os.path.join(outdir,FileDataStore.CACHEENTRYLINK)
+      if os.path.islink(entryLink):
+         rdir = os.readlink(entryLink)
+         FileDataStore.__copySimToolTreeAsLinks(rdir,outdir,{})
+         os.unlink(entryLink)
+         return True
+
+      return _fetchPendingFiles(outdir)
+
+
    def write_cache(self,
                    sourcedir,
                    prerunFiles,
                    savedOutputFiles):
       # copy notebook to data store
-      os.makedirs(self.rdir)
-
-#     print("write_cache(sourcedir): %s" % (sourcedir))
-#     print("write_cache(cachedir): %s" % (self.rdir))
-      for prerunFile in prerunFiles:
-         self.__copySimToolTree(os.path.join(sourcedir,prerunFile),self.rdir)
-      for savedOutputFile in savedOutputFiles:
-         savedDirectory,savedFile = os.path.split(savedOutputFile)
-         if savedDirectory:
-            cacheDirectory = os.path.join(self.rdir,savedDirectory)
-            if not os.path.isdir(cacheDirectory):
-               os.mkdir(cacheDirectory)
-            self.__copySimToolTree(os.path.join(sourcedir,savedOutputFile),cacheDirectory)
-         else:
-            self.__copySimToolTree(os.path.join(sourcedir,savedOutputFile),self.rdir)
+      # The entry is staged next to its final location and published by
+      # renaming it, readers never see a partially written entry.
+      stagingdir = os.path.join(self.cachedir,'.staging.%s.%s' % (self.cacheKey,uuid.uuid4().hex))
+      os.makedirs(stagingdir)
+      try:
+#        print("write_cache(sourcedir): %s" % (sourcedir))
+#        print("write_cache(stagingdir): %s" % (stagingdir))
+         for prerunFile in prerunFiles:
+            self.__copySimToolTree(os.path.join(sourcedir,prerunFile),stagingdir,sourcedir)
+         for savedOutputFile in savedOutputFiles:
+            savedDirectory,savedFile = os.path.split(savedOutputFile)
+            if savedDirectory:
+               cacheDirectory = os.path.join(stagingdir,savedDirectory)
+               if not os.path.isdir(cacheDirectory):
+                  os.mkdir(cacheDirectory)
+               self.__copySimToolTree(os.path.join(sourcedir,savedOutputFile),cacheDirectory,sourcedir)
+            else:
+               self.__copySimToolTree(os.path.join(sourcedir,savedOutputFile),stagingdir,sourcedir)
+
+         if FileDataStore.COMPRESSION:
+            self.__compressFiles(stagingdir)
+
+# hardlinked files share their mode with the run directory, only read permission is added
+         for rootDir,dirNames,fileNames in os.walk(stagingdir):
+            for fileName in fileNames:
+               filePath = os.path.join(rootDir,fileName)
+               os.chmod(filePath,os.stat(filePath).st_mode | stat.S_IROTH)
+            for dirName in dirNames:
+               dirPath = os.path.join(rootDir,dirName)
+               os.chmod(dirPath,os.stat(dirPath).st_mode | stat.S_IROTH | stat.S_IXOTH)
+
+         if FileDataStore.BLOBSTORE:
+            self.__storeBlobs(stagingdir)
+
+         with open(os.path.join(stagingdir,FileDataStore.COMPLETEMARKER),'w') as fp:
+            fp.write(str(time.time()))
+         os.chmod(os.path.join(stagingdir,FileDataStore.COMPLETEMARKER),0o644)
+
+         published = self.__publish(stagingdir)
+      finally:
+         if os.path.isdir(stagingdir):
+            FileDataStore.__removeEntryDirectory(self.cacheLocationRoot,stagingdir)
+
+      if published and FileDataStore.CACHEINDEX:
+         try:
+            size,files = getTreeSize(self.rdir)
+            self.__getIndex().addEntry(self.simtoolName,self.simtoolRevision,self.cacheKey,self.inputs,size,files)
+            if FileDataStore.CACHEQUOTA is not None or FileDataStore.SIMTOOLCACHEQUOTA is not None:
+               FileDataStore.enforceQuota(self.cacheLocationRoot)
+         except (sqlite3.Error,OSError):
+            pass
 
-      for rootDir,dirNames,fileNames in os.walk(self.rdir):
-         for fileName in fileNames:
-            filePath = os.path.join(rootDir,fileName)
-            os.chmod(filePath,os.stat(filePath).st_mode | stat.S_IROTH)
-         for dirName in dirNames:
-            dirPath = os.path.join(rootDir,dirName)
-            os.chmod(dirPath,os.stat(dirPath).st_mode | stat.S_IROTH | stat.S_IXOTH)
+
+   def __publish(self,stagingdir):
+      # Returns False if an identical run has already published the entry.
+      try:
+         os.rename(stagingdir,self.rdir)
+      except OSError:
+         if FileDataStore.__isComplete(self.rdir):
+            return False
+# incomplete entry left by a failed write, replace it
+         replacedDir = os.path.join(self.cachedir,'.evicted.%s.%s' % (self.cacheKey,uuid.uuid4().hex))
+         try:
+            os.rename(self.rdir,replacedDir)
+         except FileNotFoundError:
+            replacedDir = None
+         try:
+            os.rename(stagingdir,self.rdir)
+         except OSError:
+            if FileDataStore.__isComplete(self.rdir):
+               return False
+            raise
+         finally:
+            if replacedDir:
+               FileDataStore.__removeEntryDirectory(self.cacheLocationRoot,replacedDir)
+
+      return True
 
 
    @staticmethod
    def readFile(path, out_type=None):
       """Reads the contents of an artifact file.
 
+      Files left compressed by read_cache are decompressed first.
+
       Args:
           path: Path to the artifact
           out_type: The data type
@@ -155,6 +1084,13 @@ class FileDataStore:
           output type.  So for an Array, this will return a Numpy array,
           for an Image, an IPython Image, etc.
       """
+      if not os.path.exists(path):
+# cached file linked compressed
+         for compression,suffix in FileDataStore.COMPRESSIONSUFFIXES.items():
+            if os.path.exists(path + suffix):
+               _decompressFile(compression,path + suffix,path)
+               os.unlink(path + suffix)
+               break
       if out_type is None:
          with open(path, 'rb') as fp:
             res = fp.read()
@@ -179,74 +1115,320 @@ class FileDataStore:
       return out_type.read_from_data(data)
 
 
-class WSDataStore:
+class WSDataStore(AsyncDataStore):
    """
    A data store implemented as a web service.
    """
-   def __init__(self,simtoolName,simtoolRevision,inputs,cacheLocationRoot):
+   CACHELOCATIONROOT = None  # URL of the web service used when none is given
+   PARTIALREAD       = False # read_cache only downloads notebooks, the other files are downloaded when first read
+   DOWNLOADTHREADS   = 8     # files downloaded at the same time, also the size of the connection pool
+   DOWNLOADCHUNKSIZE = 1024*1024
+   CHUNKEDUPLOAD     = True  # upload files in chunks when the web service supports it
+   UPLOADTHREADS     = 4     # files uploaded at the same time
+   UPLOADCHUNKSIZE   = 8*1024*1024
+   UPLOADRETRIES     = 5     # attempts to resume the upload of a file after a failure
+   UPLOADRETRYDELAY  = 1.    # seconds before the first retry, doubled for each retry
+   LOOKUPBATCHSIZE   = 1000  # sets of inputs per batch squidid request
+   SQUIDIDCACHESIZE  = 4096  # squidids kept from batch requests
+
+   def __init__(self,simtoolName,simtoolRevision,inputs,cacheLocationRoot=None):
+
+      self.cacheLocationRoot = WSDataStore.__getCacheLocationRoot(cacheLocationRoot)
+      self.simtoolName       = simtoolName
+      self.simtoolRevision   = simtoolRevision
+      self.inputs            = inputs
+
+      # squidid found by an earlier batch request, otherwise requested when first used
+      squidIdKey = WSDataStore.__getSquidIdKey(self.cacheLocationRoot,simtoolName,simtoolRevision,inputs)
+      with _squidIdsLock:
+         self.__squidId = _squidIds.get(squidIdKey)
+         if self.__squidId is not None:
+            _squidIds.move_to_end(squidIdKey)
+      self.__squidIdRequested = self.__squidId is not None
 
-      self.cacheLocationRoot = cacheLocationRoot.rstrip('/') + '/'
 
+   @property
+   def rdir(self):
+      """The squidid of the inputs, None if it could not be determined.
+
+         The squidid is requested from the web service when first used, by
+         the thread doing the cache operation rather than the one creating
+         the data store.
+      """
+      if not self.__squidIdRequested:
+         self.__squidId = self.__requestSquidId()
+         self.__squidIdRequested = True
+      return self.__squidId
+
+
+   def __requestSquidId(self):
       try:
          # Request the signature for the set of inputs
-         squidid = requests.get(self.cacheLocationRoot + "squidid",
-                                headers = {'Content-Type': 'application/json'},
-                                data = json.dumps({'simtoolName':simtoolName,
-                                                   'simtoolRevision':simtoolRevision,
-                                                   'inputs':inputs}
-                                                 )
-                               )
+         squidid = _getSession().get(self.cacheLocationRoot + "squidid",
+                                     headers = {'Content-Type': 'application/json'},
+                                     data = json.dumps({'simtoolName':self.simtoolName,
+                                                        'simtoolRevision':self.simtoolRevision,
+                                                        'inputs':self.inputs}
+                                                      )
+                                    )
          sid = squidid.json()
          # The signature id (squidid) is saved on the rdir variable instead of the path to the directory
-         self.rdir = sid['id']
+         return sid['id']
       except Exception as e:
          print("squidId determination failed")
          print(traceback.format_exc())
          # If there is any error obtaining the squidid the mode is changed to global. should it be "local"?
-         self.rdir = None
+         return None
 
 
    def getSimToolSquidId(self):
       return self.rdir
 
 
-   def read_cache(self, outdir):
+   @staticmethod
+   def __getCacheLocationRoot(cacheLocationRoot):
+      cacheLocationRoot = cacheLocationRoot or WSDataStore.CACHELOCATIONROOT
+      if not cacheLocationRoot:
+         raise ValueError("URL of the cache web service is not set")
+      return cacheLocationRoot.rstrip('/') + '/'
+
+
+   @staticmethod
+   def __getSquidIdKey(cacheLocationRoot,simtoolName,simtoolRevision,inputs):
+      return (cacheLocationRoot,simtoolName,simtoolRevision,FileDataStore.getCacheKey(inputs))
+
+
+   @staticmethod
+   def lookupMany(simtoolName,simtoolRevision,inputsList,cacheLocationRoot=None):
+      """Get the squidid and cache status for several sets of inputs.
+
+      The web service is asked about LOOKUPBATCHSIZE sets of inputs per request.
+      The squidids are kept, WSDataStore objects later created for the same
+      inputs do not ask for them again.
+
+      Args:
+          simtoolName: SimTool name.
+          simtoolRevision: SimTool revision.
+          inputsList: List of input dictionaries as made by _get_inputs_cache_dict.
+          cacheLocationRoot: URL of the web service, default is CACHELOCATIONROOT.
+      Returns:
+          List of (squidid,cached) tuples in the order of inputsList.
+      """
+      cacheLocationRoot = WSDataStore.__getCacheLocationRoot(cacheLocationRoot)
+      lookups = []
+      for batchStart in range(0,len(inputsList),WSDataStore.LOOKUPBATCHSIZE):
+         batch = inputsList[batchStart:batchStart+WSDataStore.LOOKUPBATCHSIZE]
+         res = _getSession().get(cacheLocationRoot + "squidids",
+                                 headers = {'Content-Type': 'application/json'},
+                                 data = json.dumps({'simtoolName':simtoolName,
+                                                    'simtoolRevision':simtoolRevision,
+                                                    'inputsList':batch}
+                                                  )
+                                )
+         if res.status_code == 404:
+            # web service without batch requests
+            for inputs in batch:
+               dstore = WSDataStore(simtoolName,simtoolRevision,inputs,cacheLocationRoot)
+               lookups.append((dstore.rdir,dstore.rdir is not None and dstore.exists()))
+            continue
+         res.raise_for_status()
+         results = res.json()
+         if len(results) != len(batch):
+            raise ValueError("expected %d squidids, got %d" % (len(batch),len(results)))
+         with _squidIdsLock:
+            for inputs,result in zip(batch,results):
+               _squidIds[WSDataStore.__getSquidIdKey(cacheLocationRoot,simtoolName,simtoolRevision,inputs)] = result['id']
+               lookups.append((result['id'],result['cached']))
+            while len(_squidIds) > WSDataStore.SQUIDIDCACHESIZE:
+               _squidIds.popitem(last=False)
+
+      return lookups
+
+
+   @staticmethod
+   def existsMany(simtoolName,simtoolRevision,inputsList,cacheLocationRoot=None):
+      """Check for cached results for several sets of inputs.
+
+      Args:
+          simtoolName: SimTool name.
+          simtoolRevision: SimTool revision.
+          inputsList: List of input dictionaries as made by _get_inputs_cache_dict.
+          cacheLocationRoot: URL of the web service, default is CACHELOCATIONROOT.
+      Returns:
+          List of booleans in the order of inputsList.
+      """
+      try:
+         lookups = WSDataStore.lookupMany(simtoolName,simtoolRevision,inputsList,cacheLocationRoot)
+      except Exception as e:
+         print("squidId determination failed")
+         print(traceback.format_exc())
+         return [False]*len(inputsList)
+
+      return [ cached for squidid,cached in lookups ]
+
+
+   def exists(self):
+      # check for cached results without retrieving them
+      try:
+         cachefile = _getSession().get(self.cacheLocationRoot + "squidlist",
+                                       headers = {'Content-Type': 'application/json'},
+                                       data = json.dumps({'squidid':self.rdir})
+                                      )
+         return len(cachefile.json()) > 0
+      except Exception as e:
+         return False
+
+
+   def read_cache(self, outdir, partial=None):
       # reads cache and copies contents to outdir
+      # partial overrides PARTIALREAD
+      if partial is None:
+         partial = WSDataStore.PARTIALREAD
       try:
          squidid = self.rdir
          # request the list of files given the squidid
-         cachefile = requests.get(self.cacheLocationRoot + "squidlist",
-                                  headers = {'Content-Type': 'application/json'},
-                                  data = json.dumps({'squidid':squidid})
-                                 )
+         cachefile = _getSession().get(self.cacheLocationRoot + "squidlist",
+                                       headers = {'Content-Type': 'application/json'},
+                                       data = json.dumps({'squidid':squidid})
+                                      )
          results = cachefile.json()
          if len(results) == 0:
             return False;
          if not os.path.isdir(outdir):
             os.mkdir(outdir)
          # for each file on the response, download the blob
-         for result in results:
-            if "_._" in result['name']:
-               outputfile = result['name'].split("_._")
-               outputname = outputfile[-1]
-               outputdir = os.path.join(outdir,os.sep.join(outputfile[:-1]))
-               if not os.path.isdir(outputdir):
-                  os.makedirs(outputdir)
-            else:
-               outputdir = outdir
-               outputname = result['name']
-            # request the file and save on the proper user file directory
-            r = requests.get(self.cacheLocationRoot + "files/" + result['id'],
-                             headers = {"Cache-Control": "no-cache"},
-                             params = {"download": "true"}
-                            )
-            with open(os.path.join(outputdir,outputname), 'wb') as fp:
-               fp.write(r.content)
+         # downloads start while the rest of the list is processed
+         pendingFiles = {}
+         with concurrent.futures.ThreadPoolExecutor(max_workers=WSDataStore.DOWNLOADTHREADS) as executor:
+            downloads = []
+            try:
+               for result in results:
+                  # names are flattened with _._ as the path separator
+                  relativePath = os.sep.join(result['name'].split("_._"))
+                  if partial and not (relativePath.endswith('.ipynb') and not os.path.dirname(relativePath)):
+                     pendingFiles[relativePath] = {'id':result['id']}
+                  else:
+                     # request the file and save on the proper user file directory
+                     downloads.append(executor.submit(_downloadCacheFile,
+                                                      self.cacheLocationRoot,result['id'],os.path.join(outdir,relativePath)))
+               for download in concurrent.futures.as_completed(downloads):
+                  download.result()
+            except:
+               for download in downloads:
+                  download.cancel()
+               raise
+         if partial:
+            _writePendingFiles(outdir,'WSDataStore',self.cacheLocationRoot,pendingFiles)
          return True
       except Exception as e:
          return False
 
 
+   @staticmethod
+   def __getCacheFiles(sourcedir,prerunFiles,savedOutputFiles):
+      # Returns (path,name) of each file, the path separator of names relative
+      # to sourcedir is changed from / to _._, flattening the path.  A prerun
+      # file also saved as an output is listed once.
+      cacheFiles = []
+      cacheFileNames = set()
+      rootPath = os.path.abspath(sourcedir)
+      for cacheFile in prerunFiles + savedOutputFiles:
+         cacheFilePath = os.path.join(rootPath,cacheFile)
+         if os.path.isdir(cacheFilePath):
+            cacheFilePaths = []
+            for dirPath,dirs,files in os.walk(cacheFilePath,followlinks=True):
+               for fileName in files:
+                  cacheFilePaths.append(os.path.join(dirPath,fileName))
+         else:
+            cacheFilePaths = [cacheFilePath]
+         for cacheFilePath in cacheFilePaths:
+            relativePath = os.path.relpath(cacheFilePath,rootPath)
+            cacheFileName = "_._".join(relativePath.split(os.sep))
+            if not cacheFileName in cacheFileNames:
+               cacheFileNames.add(cacheFileName)
+               cacheFiles.append((cacheFilePath,cacheFileName))
+
+      return cacheFiles
+
+
+   def __getUploadStatus(self,squidid,name,checksum):
+      # None if the web service does not support chunked uploads
+      res = _getSession().get(self.cacheLocationRoot + "squidfile",
+                              params = {'squidid':squidid,'name':name,'checksum':checksum}
+                             )
+      if res.status_code == 404:
+         return None
+      res.raise_for_status()
+      return res.json()
+
+
+   def __uploadFile(self,squidid,cacheFilePath,name):
+      # Upload a file in chunks, after a failure the upload is resumed
+      # from the data received by the web service.
+      checksum = _getFileChecksum(cacheFilePath)
+      size = os.path.getsize(cacheFilePath)
+      retryDelay = WSDataStore.UPLOADRETRYDELAY
+      attempt = 0
+      uploadStatus = None
+      while uploadStatus is None or not uploadStatus['complete']:
+         try:
+            if uploadStatus is None:
+               uploadStatus = self.__getUploadStatus(squidid,name,checksum)
+               if uploadStatus is None:
+                  raise ValueError("chunked uploads are not supported")
+               continue
+            with open(cacheFilePath,'rb') as fp:
+               fp.seek(uploadStatus['size'])
+               chunk = fp.read(WSDataStore.UPLOADCHUNKSIZE)
+            res = _getSession().put(self.cacheLocationRoot + "squidfile",
+                                    params = {'squidid':squidid,'name':name,'checksum':checksum,
+                                              'size':size,'offset':uploadStatus['size']},
+                                    data = chunk
+                                   )
+            res.raise_for_status()
+            uploadStatus = res.json()
+            if not chunk and not uploadStatus['complete']:
+               raise ValueError("upload of %s is incomplete" % (name))
+         except (requests.RequestException,ValueError):
+            attempt += 1
+            if attempt > WSDataStore.UPLOADRETRIES:
+               raise
+            time.sleep(retryDelay)
+            retryDelay *= 2
+            uploadStatus = None
+
+
+   def __uploadFiles(self,squidid,cacheFiles):
+      # Returns False if the web service does not support chunked uploads.
+      # Files are uploaded UPLOADTHREADS at a time, files the web service
+      # already holds are skipped.
+      try:
+         uploadStatus = self.__getUploadStatus(squidid,'',None)
+      except Exception as e:
+# any failure of the probe, the files are uploaded in one multipart request
+         uploadStatus = None
+      if uploadStatus is None:
+         return False
+
+      with concurrent.futures.ThreadPoolExecutor(max_workers=WSDataStore.UPLOADTHREADS) as executor:
+         uploads = []
+         for cacheFilePath,name in cacheFiles:
+            uploads.append(executor.submit(self.__uploadFile,squidid,cacheFilePath,name))
+         for upload in concurrent.futures.as_completed(uploads):
+            upload.result()
+
+      res = _getSession().put(self.cacheLocationRoot + "squidcommit",
+                              headers = {'Content-Type': 'application/json'},
+                              data = json.dumps({'squidid':squidid,'files':[ name for cacheFilePath,name in cacheFiles ]})
+                             )
+      if res.status_code != 200:
+         print("res['status_code']: %s" % (res.status_code))
+         print("res['reason']: %s" % (res.reason))
+         print("res['text']: %s" % (res.text))
+
+      return True
+
+
    def write_cache(self,
                    sourcedir,
                    prerunFiles,
@@ -255,45 +1437,23 @@ class WSDataStore:
       cacheFps = []
       try:
          squidid = self.rdir
-         cacheFilePaths = []
-         # loop prerunFiles, save full paths
-         for prerunFile in prerunFiles:
-            cacheFilePath = os.path.realpath(os.path.join(sourcedir,prerunFile))
-            if os.path.isdir(cacheFilePath):
-               for rootPath,dirs,files in os.walk(cacheFilePath):
-                  for cacheFile in files:
-                     cacheFilePaths.append(os.path.join(rootPath,cacheFile))
-            else:
-               cacheFilePaths.append(cacheFilePath)
-         # loop savedOutputFiles, save full paths
-         for savedOutputFile in savedOutputFiles:
-            cacheFilePath = os.path.realpath(os.path.join(sourcedir,savedOutputFile))
-            if os.path.isdir(cacheFilePath):
-               for rootPath,dirs,files in os.walk(cacheFilePath):
-                  for cacheFile in files:
-                     cacheFilePaths.append(os.path.join(rootPath,cacheFile))
-            else:
-               cacheFilePaths.append(cacheFilePath)
+         cacheFiles = WSDataStore.__getCacheFiles(sourcedir,prerunFiles,savedOutputFiles)
+         if WSDataStore.CHUNKEDUPLOAD and self.__uploadFiles(squidid,cacheFiles):
+            return
 
-         # loop all files found and change the path separtor from / to _._, flattening the path.
-         cacheFiles = []
-         rootPath = os.path.realpath(sourcedir)
-         for cacheFilePath in cacheFilePaths:
-            relativePath = os.path.relpath(cacheFilePath,rootPath)
-            cacheFp = open(relativePath,'rb')
+         multipartFiles = []
+         for cacheFilePath,name in cacheFiles:
+            cacheFp = open(cacheFilePath,'rb')
             cacheFps.append(cacheFp)
-            if os.path.dirname(relativePath):
-               cacheFiles.append(('file',("_._".join(relativePath.split(os.sep)),cacheFp)))
-            else:
-               cacheFiles.append(('file',cacheFp))
+            multipartFiles.append(('file',(name,cacheFp)))
 
          # Store the files on the server
 #        print("squidid: %s" % (squidid))
-#        print("files: %s" % (cacheFiles))
-         res = requests.put(self.cacheLocationRoot + "squidlist",
-                            data = {'squidid':squidid},
-                            files = cacheFiles
-                           )
+#        print("files: %s" % (multipartFiles))
+         res = _getSession().put(self.cacheLocationRoot + "squidlist",
+                                 data = {'squidid':squidid},
+                                 files = multipartFiles
+                                )
          if res.status_code != 200:
             print("res['status_code']: %s" % (res.status_code))
             print("res['reason']: %s" % (res.reason))
@@ -307,6 +1467,30 @@ class WSDataStore:
          del cacheFps
 
 
+   @staticmethod
+   def resolvePath(directory,path):
+      """Get the location of a file of a run.
+
+      Files of runs read partially are downloaded.
+      """
+      runPath = os.path.join(directory,path)
+      if not os.path.lexists(runPath):
+         pendingFiles = _readPendingFiles(directory)
+         if pendingFiles is not None:
+            _fetchPendingFile(pendingFiles,directory,path)
+      return runPath
+
+
+   @staticmethod
+   def materialize(outdir):
+      """Download the files of a partially read cache entry not read yet.
+
+      Returns:
+          True if files were added to the run directory.
+      """
+      return _fetchPendingFiles(outdir)
+
+
    @staticmethod
    def readFile(path, out_type=None):
       """Reads the contents of an artifact file.
@@ -343,3 +1527,183 @@ class WSDataStore:
       return out_type.read_from_data(data)
 
 
+_pushExecutor     = None
+_pushExecutorLock = threading.Lock()
+_pushes           = []
+
+def _getPushExecutor():
+   global _pushExecutor
+   with _pushExecutorLock:
+      if _pushExecutor is None:
+         _pushExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=TieredDataStore.PUSHTHREADS)
+   return _pushExecutor
+
+
+class TieredDataStore(AsyncDataStore):
+   """
+   A FileDataStore in front of a WSDataStore.
+
+   Results are read from the local data store when it holds them.  Results
+   read from the web service are added to the local data store.  Results
+   written are stored locally and the local entry is pushed to the web service
+   in the background, waitForPushes() returns when the pushes are done.
+   """
+   LOCALCACHELOCATIONROOT  = None # FileDataStore cache root, default is FileDataStore.USERCACHELOCATIONROOT
+   REMOTECACHELOCATIONROOT = None # web service URL, default is WSDataStore.CACHELOCATIONROOT
+   PUSHTHREADS             = 2    # results pushed to the web service at the same time
+
+   def __init__(self,simtoolName,simtoolRevision,inputs,cacheLocationRoot=None):
+      self.simtoolName     = simtoolName
+      self.simtoolRevision = simtoolRevision
+      self.inputs          = inputs
+      self.local = FileDataStore(simtoolName,simtoolRevision,inputs,
+                                 cacheLocationRoot or TieredDataStore.LOCALCACHELOCATIONROOT)
+      self.rdir  = self.local.rdir
+# created when needed, local hits do not contact the web service
+      self.remote = None
+
+
+   def __getRemote(self):
+      if self.remote is None:
+         self.remote = WSDataStore(self.simtoolName,self.simtoolRevision,self.inputs,
+                                   TieredDataStore.REMOTECACHELOCATIONROOT)
+      return self.remote
+
+
+   def getSimToolSquidId(self):
+      return self.local.getSimToolSquidId()
+
+
+   @staticmethod
+   def existsMany(simtoolName,simtoolRevision,inputsList,cacheLocationRoot=None):
+      """Check for cached results for several sets of inputs.
+
+      The web service is only asked about the inputs not cached locally.
+
+      Args:
+          simtoolName: SimTool name.
+          simtoolRevision: SimTool revision.
+          inputsList: List of input dictionaries as made by _get_inputs_cache_dict.
+          cacheLocationRoot: Local cache root, default is LOCALCACHELOCATIONROOT.
+      Returns:
+          List of booleans in the order of inputsList.
+      """
+      cachedList = FileDataStore.existsMany(simtoolName,simtoolRevision,inputsList,
+                                            cacheLocationRoot or TieredDataStore.LOCALCACHELOCATIONROOT)
+      missingIndices = [ index for index,cached in enumerate(cachedList) if not cached ]
+      if missingIndices:
+         remoteCachedList = WSDataStore.existsMany(simtoolName,simtoolRevision,
+                                                   [ inputsList[index] for index in missingIndices ],
+                                                   TieredDataStore.REMOTECACHELOCATIONROOT)
+         for index,cached in zip(missingIndices,remoteCachedList):
+            cachedList[index] = cached
+
+      return cachedList
+
+
+   def exists(self):
+      # check for cached results without retrieving them
+      return self.local.exists() or self.__getRemote().exists()
+
+
+   def lockRun(self,timeout):
+      """Get exclusive use of the local cache entry, see FileDataStore.lockRun()."""
+      return self.local.lockRun(timeout)
+
+
+   def unlockRun(self):
+      """Release the lock obtained with lockRun()."""
+      self.local.unlockRun()
+
+
+   def read_cache(self,outdir):
+      # reads cache and copies contents to outdir
+      if self.local.read_cache(outdir):
+         return True
+
+      remote = self.__getRemote()
+      if remote.rdir is None:
+         return False
+# download next to the local cache entry and add it to the local cache
+      try:
+         os.makedirs(self.local.cachedir,exist_ok=True)
+         downloadDir = tempfile.mkdtemp(prefix='.remote.%s.' % (self.local.cacheKey),dir=self.local.cachedir)
+      except OSError:
+# read only local cache
+         return remote.read_cache(outdir)
+      try:
+         if not remote.read_cache(downloadDir,partial=False):
+            return False
+         self.local.write_cache(downloadDir,os.listdir(downloadDir),[])
+      finally:
+         shutil.rmtree(downloadDir,ignore_errors=True)
+
+      return self.local.read_cache(outdir)
+
+
+   def write_cache(self,
+                   sourcedir,
+                   prerunFiles,
+                   savedOutputFiles):
+      # store locally, then push the local entry to the web service in the background
+      self.local.write_cache(sourcedir,prerunFiles,savedOutputFiles)
+      with _pushExecutorLock:
+         _pushes[:] = [ push for push in _pushes if not push.done() ]
+      push = _getPushExecutor().submit(self.__push)
+      with _pushExecutorLock:
+         _pushes.append(push)
+
+
+   def __push(self):
+# The run directory can be changed once write_cache returns, the files
+# pushed are those of the published local entry.
+      try:
+         remote = self.__getRemote()
+         if remote.rdir is not None and not remote.exists():
+            with self.local.readEntry() as entryDir:
+               if entryDir is not None:
+                  remote.write_cache(entryDir,sorted(os.listdir(entryDir)),[])
+      except Exception:
+         print("Push of %s to %s failed" % (self.local.rdir,TieredDataStore.REMOTECACHELOCATIONROOT or WSDataStore.CACHELOCATIONROOT),
+               file=sys.stderr)
+         print(traceback.format_exc(),file=sys.stderr)
+
+
+   @staticmethod
+   def waitForPushes(timeout=None):
+      """Wait for results written to be pushed to the web service.
+
+      Args:
+          timeout: Maximum seconds to wait, None to wait until done.
+      Returns:
+          True if all pushes are done.
+      """
+      with _pushExecutorLock:
+         pushes = list(_pushes)
+      done,notDone = concurrent.futures.wait(pushes,timeout=timeout)
+
+      return len(notDone) == 0
+
+
+   @staticmethod
+   def resolvePath(directory,path):
+      """Get the location of a file of a run, see FileDataStore.resolvePath()."""
+      return FileDataStore.resolvePath(directory,path)
+
+
+   @staticmethod
+   def materialize(outdir):
+      """Link each file of cached results into the run directory, see FileDataStore.materialize()."""
+      return FileDataStore.materialize(outdir)
+
+
+   @staticmethod
+   def readFile(path, out_type=None):
+      """Reads the contents of an artifact file, see FileDataStore.readFile()."""
+      return FileDataStore.readFile(path,out_type)
+
+
+   @staticmethod
+   def readData(data, out_type=None):
+      """Reads the contents of an artifact data, see FileDataStore.readData()."""
+      return FileDataStore.readData(data,out_type)
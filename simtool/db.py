@@ -200,7 +200,7 @@ class DB(object):
             read_type = None
         path = self._get_ref(data)
         if path:
-            path = os.path.join(self.dir,path)
+            path = DB.datastore.resolvePath(self.dir,path)
             if raw:
                 return self._make_ref(path)
             val = DB.datastore.readFile(path,read_type)
@@ -0,0 +1,258 @@
+# @package      hubzero-simtool
+# @file         kernelpool.py
+# @copyright    Copyright (c) 2019-2021 The Regents of the University of California.
+# @license      http://opensource.org/licenses/MIT MIT
+# @trademark    HUBzero is a registered trademark of The Regents of the University of California.
+#
+import os
+import sys
+import atexit
+import threading
+import traceback
+from jupyter_client.manager import KernelManager
+from papermill.engines import NBClientEngine, papermill_engines
+from papermill.clientwrap import PapermillNotebookClient
+from papermill.utils import merge_kwargs, remove_args
+from papermill.log import logger
+
+class KernelPool:
+   """
+   A pool of started Jupyter kernels with commonly used modules already imported.
+
+   Kernels are handed out for the execution of one notebook at a time.  When
+   returned to the pool the kernel namespace is reset.  A kernel is shut down
+   and replaced after it has been used MAXUSES times.
+
+   The pool is filled in the background the first time a kernel is acquired.
+   Call start() ahead of the first run to have kernels ready for it, e.g.
+
+      from simtool.kernelpool import getKernelPool
+      getKernelPool().start('python3')
+   """
+   POOLSIZE       = 2
+   MAXUSES        = 20
+   STARTUPTIMEOUT = 60
+   PRELOADMODULES = ['numpy','pint','mendeleev','PIL.Image','scrapbook','simtool']
+
+   def __init__(self,poolSize=None,maxUses=None,preloadModules=None):
+      self.poolSize       = poolSize or KernelPool.POOLSIZE
+      self.maxUses        = maxUses or KernelPool.MAXUSES
+      self.preloadModules = preloadModules if preloadModules is not None else KernelPool.PRELOADMODULES
+      self.pid = os.getpid()
+
+      self.__idleKernels = {}
+      self.__startedKernelNames = set()
+      self.__lock = threading.Lock()
+
+
+   def __startKernel(self,kernelName):
+      kernel = {}
+      kernel['kernelName'] = kernelName
+      kernel['uses']       = 0
+      kernel['km']         = KernelManager(kernel_name=kernelName)
+      kernel['km'].start_kernel()
+      try:
+         preloadCode = ["import importlib"]
+         for preloadModule in self.preloadModules:
+            preloadCode.append("try:\n   importlib.import_module(%r)\nexcept ImportError:\n   pass" % (preloadModule))
+         self.__execute(kernel,'\n'.join(preloadCode))
+      except:
+         self.__stopKernel(kernel)
+         raise
+
+      return kernel
+
+
+   @staticmethod
+   def __stopKernel(kernel):
+      try:
+         kernel['km'].shutdown_kernel(now=True)
+      except:
+         pass
+
+
+   @staticmethod
+   def __execute(kernel,code):
+# A client is only used for one request, long lived clients miss replies once
+# the notebook client has been connected to the same kernel.
+      kc = kernel['km'].client()
+      kc.start_channels()
+      try:
+         kc.wait_for_ready(timeout=KernelPool.STARTUPTIMEOUT)
+         reply = kc.execute_interactive(code,silent=True,store_history=False,
+                                        timeout=KernelPool.STARTUPTIMEOUT,
+                                        output_hook=lambda message: None)
+      finally:
+         kc.stop_channels()
+      if reply['content']['status'] != 'ok':
+         raise RuntimeError("Kernel setup failed: %s" % (reply['content'].get('evalue')))
+
+
+   def __replenish(self,kernelName):
+      try:
+         kernel = self.__startKernel(kernelName)
+      except:
+         print(traceback.format_exc(),file=sys.stderr)
+      else:
+         with self.__lock:
+            idleKernels = self.__idleKernels.setdefault(kernelName,[])
+            if len(idleKernels) < self.poolSize:
+               idleKernels.append(kernel)
+               kernel = None
+         if kernel:
+            self.__stopKernel(kernel)
+
+
+   def start(self,kernelName='python3'):
+      """Start kernels in the background until the pool is full.
+
+         Args:
+             kernelName: Name of the kernel specification.
+      """
+      with self.__lock:
+         self.__startedKernelNames.add(kernelName)
+         nIdle = len(self.__idleKernels.get(kernelName,[]))
+      for iKernel in range(nIdle,self.poolSize):
+         threading.Thread(target=self.__replenish,args=(kernelName,),daemon=True).start()
+
+
+   def acquire(self,kernelName,cwd=None):
+      """Get a kernel for exclusive use.
+
+         Args:
+             kernelName: Name of the kernel specification.
+             cwd: Working directory for the kernel.
+         Returns:
+             A dictionary holding the KernelManager (km) and pool bookkeeping.
+      """
+      kernel = None
+      with self.__lock:
+         started = kernelName in self.__startedKernelNames
+         idleKernels = self.__idleKernels.get(kernelName,[])
+         while idleKernels and kernel is None:
+            kernel = idleKernels.pop(0)
+            if not kernel['km'].is_alive():
+               self.__stopKernel(kernel)
+               kernel = None
+# first use of the kernel, fill the pool for the runs that follow
+      if not started:
+         self.start(kernelName)
+      if kernel is None:
+         kernel = self.__startKernel(kernelName)
+
+      if cwd:
+         self.__execute(kernel,"import os\nos.chdir(%r)\ndel os" % (cwd))
+      kernel['uses'] += 1
+
+      return kernel
+
+
+   def release(self,kernel):
+      """Return a kernel to the pool.
+
+         The kernel namespace is reset.  Kernels that have reached the maximum
+         number of uses or are no longer alive are replaced.
+
+         Args:
+             kernel: A kernel obtained from acquire().
+      """
+      reuse = kernel['uses'] < self.maxUses and kernel['km'].is_alive()
+      if reuse:
+         try:
+            self.__execute(kernel,"get_ipython().run_line_magic('reset','-f')\nimport gc\ngc.collect()")
+         except:
+            reuse = False
+
+      if reuse:
+         with self.__lock:
+            idleKernels = self.__idleKernels.setdefault(kernel['kernelName'],[])
+            if len(idleKernels) < self.poolSize:
+               idleKernels.append(kernel)
+               kernel = None
+         if kernel:
+            self.__stopKernel(kernel)
+      else:
+         self.__stopKernel(kernel)
+         threading.Thread(target=self.__replenish,args=(kernel['kernelName'],),daemon=True).start()
+
+
+   def getIdleCount(self,kernelName='python3'):
+      """Get the number of started kernels waiting in the pool.
+
+         Args:
+             kernelName: Name of the kernel specification.
+         Returns:
+             The number of idle kernels.
+      """
+      with self.__lock:
+         return len(self.__idleKernels.get(kernelName,[]))
+
+
+   def shutdown(self):
+      """Stop all idle kernels."""
+      with self.__lock:
+         idleKernels = self.__idleKernels
+         self.__idleKernels = {}
+      for kernelName in idleKernels:
+         for kernel in idleKernels[kernelName]:
+            self.__stopKernel(kernel)
+
+
+_kernelPool = None
+_kernelPoolLock = threading.Lock()
+
+def getKernelPool():
+   """Get the kernel pool for this process.
+
+      The pool is created on first use, its kernels are started when the first
+      notebook is executed or by calling start().  A process started with fork
+      gets its own pool rather than sharing the kernels of its parent.
+
+      Returns:
+          The KernelPool object.
+   """
+   global _kernelPool
+   with _kernelPoolLock:
+      if _kernelPool is None or _kernelPool.pid != os.getpid():
+         _kernelPool = KernelPool()
+         atexit.register(_kernelPool.shutdown)
+   return _kernelPool
+
+
+class KernelPoolEngine(NBClientEngine):
+   """
+   A papermill engine executing notebooks in kernels from the KernelPool.
+   """
+
+   @classmethod
+   def execute_managed_notebook(cls,nb_man,kernel_name,
+                                    log_output=False,stdout_file=None,stderr_file=None,
+                                    start_timeout=60,execution_timeout=None,**kwargs):
+      kwargs = remove_args(['input_path'],**kwargs)
+      safe_kwargs = remove_args(['timeout','startup_timeout'],**kwargs)
+      final_kwargs = merge_kwargs(safe_kwargs,
+                                  timeout=execution_timeout if execution_timeout else kwargs.get('timeout'),
+                                  startup_timeout=start_timeout,
+                                  kernel_name=kernel_name,
+                                  log=logger,
+                                  log_output=log_output,
+                                  stdout_file=stdout_file,
+                                  stderr_file=stderr_file)
+
+      kernelPool = getKernelPool()
+# papermill has changed to the notebook working directory
+      kernel = kernelPool.acquire(kernel_name,cwd=os.getcwd())
+      try:
+         client = PapermillNotebookClient(nb_man,km=kernel['km'],**final_kwargs)
+         try:
+            client.execute()
+         finally:
+            if client.kc is not None:
+               client.kc.stop_channels()
+      finally:
+         kernelPool.release(kernel)
+
+      return nb_man.nb
+
+
+papermill_engines.register('kernelpool',KernelPoolEngine)
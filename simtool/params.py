@@ -705,11 +705,9 @@ class Array(Params):
     def value(self, newval):
         self._value = None
         if newval is not None:
-            if   type(newval) is np.ndarray:
-                # papermill expects inputs to be json-encodeable by nbformat.
-                # This is OK for typical input arrays, but if we ever need
-                # to support really large arrays we will need to write a
-                # custom papermill engine.
+            if   isinstance(newval,np.ndarray):
+                # Large arrays are passed to the notebook as memory-mapped
+                # files (see simtool.loadParameterFile).
                 if self.min is not None and newval.min() < self.min:
                     raise ValueError("Minimum value is %g" % self.min)
                 if self.max is not None and newval.max() > self.max:
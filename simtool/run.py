@@ -15,6 +15,9 @@ import stat
 import subprocess
 import select
 import traceback
+import signal
+import multiprocessing
+import concurrent.futures
 try:
    from hubzero.submit.SubmitCommand import SubmitCommand
 except ImportError:
@@ -35,10 +38,13 @@ except:
 
 import yaml
 from .db import DB
-from .experiment import get_experiment
+from .experiment import get_experiment, set_experiment
 from .datastore import FileDataStore
+from . import kernelpool
+from .script import compileNotebook
 from .utils import getSimToolInputs, getSimToolOutputs, getParamsFromDictionary
 from .utils import _get_inputs_dict, _get_extra_files, _get_inputFiles, _get_inputs_cache_dict
+from .utils import _write_parameter_file, ParameterFile
 
 
 class RunBase:
@@ -49,6 +55,10 @@ class RunBase:
    DSHANDLER          = FileDataStore  # local files or NFS.  should be config option
    INPUTFILERUNPREFIX = '.notebookInputFiles'
    SIMTOOLRUNPREFIX   = '.simtool'
+   PARAMETERFILERUNPREFIX = '.notebookInputParameters'
+   PARAMETERFILETHRESHOLD = 1024*1024  # bytes. Larger Array/List/Dict inputs are passed in files. None to disable
+   RUNLOCKTIMEOUT     = 600  # seconds to wait for an identical run in another process. 0 to disable
+   LEGACYCACHEKEYS    = True # also look for results cached with the MD5 file input checksums of earlier versions
 
    def __init__(self,simToolLocation,inputs,runName,cache,
                      createOutDir=True,remoteAttributes=None,
@@ -84,12 +94,27 @@ class RunBase:
 
       self.cached = False
       self.dstore = None
+      self.runLocked = False
       if not trustedExecution:
          if cache:
-            hashableInputs = _get_inputs_cache_dict(getParamsFromDictionary(inputsSchema,self.input_dict))
-            self.dstore = RunBase.DSHANDLER(simToolLocation['simToolName'],simToolLocation['simToolRevision'],hashableInputs)
-            del hashableInputs
+            self.dstore = RunBase.getDataStore(simToolLocation,self.inputs,inputsSchema=inputsSchema)
             self.cached = self.dstore.read_cache(self.outdir)
+            if not self.cached and RunBase.RUNLOCKTIMEOUT and hasattr(self.dstore,'lockRun'):
+# Only one of several identical runs is executed, the others
+# wait for it to finish and use the cached results.
+# The lock is released by unlockRun once the results are cached.
+               self.runLocked = self.dstore.lockRun(RunBase.RUNLOCKTIMEOUT)
+               try:
+                  if self.dstore.exists():
+                     self.cached = self.dstore.read_cache(self.outdir)
+               except:
+                  self.unlockRun()
+                  raise
+               if self.cached:
+                  self.unlockRun()
+            if self.cached:
+# the notebook of results read lazily is in the cache entry
+               self.outname = self.dstore.resolvePath(self.outdir,self.nbName)
 
 #        print("runname = %s" % (self.runName))
 #        print("outdir  = %s" % (self.outdir))
@@ -101,6 +126,130 @@ class RunBase:
       self.savedOutputs = None
 
 
+   def unlockRun(self):
+      """Let identical runs waiting for this run proceed.
+
+         Called by each venue once the results are written to the cache
+         or the run has failed.
+      """
+      if self.runLocked:
+         self.runLocked = False
+         self.dstore.unlockRun()
+
+
+   def __getstate__(self):
+# The results database holds the parsed notebook, it is reloaded from outname when unpickled
+      state = self.__dict__.copy()
+      state['db'] = None
+      if state.get('savedOutputs') is not None:
+         state['savedOutputs'] = list(state['savedOutputs'])
+      return state
+
+
+   def __setstate__(self,state):
+      self.__dict__.update(state)
+      outname = state.get('outname')
+      if outname and os.path.exists(outname):
+         self.db = DB(outname,dir=self.outdir)
+
+
+   @staticmethod
+   def getDataStore(simToolLocation,inputs,inputsSchema=None):
+      """Create the data store handler for a set of inputs.
+
+         Args:
+             simToolLocation: A dictionary containing information on SimTool notebook
+                 location and status.
+             inputs: A SimTools Params object or a dictionary of key-value pairs, file
+                 inputs refer to the files supplied rather than their copies in a run.
+             inputsSchema: SimTool inputs definition.  Read from the notebook if not supplied.
+         Returns:
+             A RunBase.DSHANDLER object for the inputs.
+      """
+      if inputsSchema is None:
+         inputsSchema = getSimToolInputs(simToolLocation)
+      hashableInputs = RunBase.__getHashableInputs(inputsSchema,inputs)
+      dstore = RunBase.DSHANDLER(simToolLocation['simToolName'],simToolLocation['simToolRevision'],hashableInputs)
+      if RunBase.LEGACYCACHEKEYS:
+         legacyHashableInputs = RunBase.__getHashableInputs(inputsSchema,inputs,legacy=True)
+         if legacyHashableInputs != hashableInputs and not dstore.exists():
+            legacyDstore = RunBase.DSHANDLER(simToolLocation['simToolName'],simToolLocation['simToolRevision'],
+                                             legacyHashableInputs)
+            if legacyDstore.exists():
+               dstore = legacyDstore
+
+      return dstore
+
+
+   @staticmethod
+   def __getHashableInputs(inputsSchema,inputs,legacy=False):
+# File inputs are hashed where they were supplied, the run directory copies
+# named by _get_inputs_dict() do not exist yet.
+      if type(inputs) == dict:
+         inputDict = inputs
+      else:
+         inputDict = { label:inputs[label].serialValue for label in inputs }
+      return _get_inputs_cache_dict(getParamsFromDictionary(inputsSchema,inputDict),legacy)
+
+
+   @staticmethod
+   def isCached(simToolLocation,inputs):
+      """Check whether results for a set of inputs are available from the data store.
+
+         Args:
+             simToolLocation: A dictionary containing information on SimTool notebook
+                 location and status.
+             inputs: A SimTools Params object or a dictionary of key-value pairs.
+         Returns:
+             True if the data store holds results for the inputs.
+      """
+      if simToolLocation['simToolRevision'] is None:
+         return False
+      dstore = RunBase.getDataStore(simToolLocation,inputs)
+      return dstore.exists()
+
+
+   @staticmethod
+   def areCached(simToolLocation,inputsList):
+      """Check whether results for several sets of inputs are available from the data store.
+
+         The data store is queried once for all sets of inputs when it supports it.
+
+         Args:
+             simToolLocation: A dictionary containing information on SimTool notebook
+                 location and status.
+             inputsList: A list of SimTools Params objects or dictionaries of key-value pairs.
+         Returns:
+             List of booleans in the order of inputsList.
+      """
+      if simToolLocation['simToolRevision'] is None:
+         return [False]*len(inputsList)
+      existsMany = getattr(RunBase.DSHANDLER,'existsMany',None)
+      if existsMany is None:
+         return [ RunBase.isCached(simToolLocation,inputs) for inputs in inputsList ]
+
+      inputsSchema = getSimToolInputs(simToolLocation)
+      hashableInputsList = [ RunBase.__getHashableInputs(inputsSchema,inputs) for inputs in inputsList ]
+
+      cachedList = existsMany(simToolLocation['simToolName'],simToolLocation['simToolRevision'],hashableInputsList)
+      if RunBase.LEGACYCACHEKEYS:
+         legacyIndices = []
+         legacyHashableInputsList = []
+         for index,cached in enumerate(cachedList):
+            if not cached:
+               legacyHashableInputs = RunBase.__getHashableInputs(inputsSchema,inputsList[index],legacy=True)
+               if legacyHashableInputs != hashableInputsList[index]:
+                  legacyIndices.append(index)
+                  legacyHashableInputsList.append(legacyHashableInputs)
+         if legacyIndices:
+            legacyCachedList = existsMany(simToolLocation['simToolName'],simToolLocation['simToolRevision'],
+                                          legacyHashableInputsList)
+            for index,cached in zip(legacyIndices,legacyCachedList):
+               cachedList[index] = cached
+
+      return cachedList
+
+
    @staticmethod
    def __copySimToolTreeAsLinks(sdir,ddir):
       simToolFiles = os.listdir(sdir)
@@ -169,11 +318,42 @@ class RunBase:
             yaml.dump(self.input_dict,fp)
 
 
+   def getNotebookParameters(self,simToolLocation):
+      """Get parameters for papermill with large values written to files.
+
+         Array, List and Dict values larger than PARAMETERFILETHRESHOLD are written
+         to the PARAMETERFILERUNPREFIX directory and passed to the notebook by reference.
+
+         Args:
+             simToolLocation: A dictionary containing information on SimTool notebook
+                 location and status.
+         Returns:
+             Dictionary of parameters.
+      """
+      parameters = copy.copy(self.input_dict)
+      if RunBase.PARAMETERFILETHRESHOLD is not None:
+         inputsSchema = getSimToolInputs(simToolLocation)
+         parametersDirectory = os.path.join(self.outdir,RunBase.PARAMETERFILERUNPREFIX)
+         for label in parameters:
+            if label in inputsSchema and parameters[label] is not None:
+               paramType = inputsSchema[label].type
+               if paramType in ['Array','List','Dict']:
+                  parameterFile = _write_parameter_file(parameters[label],paramType,
+                                                        parametersDirectory,label,
+                                                        RunBase.PARAMETERFILETHRESHOLD)
+                  if parameterFile:
+# the notebook is executed in outdir
+                     parameters[label] = ParameterFile(os.path.relpath(parameterFile,self.outdir))
+
+      return parameters
+
+
    def executeCommand(self,
                       commandArgs,
                       stdin=None,
                       streamOutput=False,
-                      reportErrorExit=True):
+                      reportErrorExit=True,
+                      cwd=None):
       exitStatus = 0
       outData = []
       errData = []
@@ -192,13 +372,15 @@ class RunBase:
                                         stdin=fpStdin,
                                         stdout=subprocess.PIPE,
                                         stderr=subprocess.PIPE,
-                                        close_fds=True)
+                                        close_fds=True,
+                                        cwd=cwd)
             else:
                child = subprocess.Popen(commandArgs,bufsize=bufferSize,
                                         stdin=None,
                                         stdout=subprocess.PIPE,
                                         stderr=subprocess.PIPE,
-                                        close_fds=True)
+                                        close_fds=True,
+                                        cwd=cwd)
          except OSError as e:
             print("Command: %s\nfailed: %s." % (commandArgs,e.args[1]),file=sys.stderr)
             exitStatus = e.args[0]
@@ -391,40 +573,58 @@ class RunBase:
       return self.db.read(name,display,raw)
 
 
+   def materialize(self):
+      """Link each file of cached results into the run directory.
+
+         Results read lazily from the cache are only linked to the cache entry.
+         Files can be added to or replaced in the run directory once materialized.
+      """
+      if self.cached and hasattr(self.dstore,'materialize'):
+         if self.dstore.materialize(self.outdir):
+            self.outname = os.path.join(self.outdir,self.nbName)
+
+
 class LocalRun(RunBase):
    """
    Run a notebook without using submit.
    """
 
-   def __init__(self,simToolLocation,inputs,runName,cache):
+   def __init__(self,simToolLocation,inputs,runName,cache,engine=None):
       RunBase.__init__(self,simToolLocation,inputs,runName,cache,
                             createOutDir=True,remoteAttributes=None,
                             remote=False,trustedExecution=False)
 
-      if not self.cached:
-         self.setupInputFiles(simToolLocation,
-                              doSimToolFiles=True,keepSimToolNotebook=False,remote=False,
-                              doUserInputFiles=True,
-                              doSimToolInputFile=False)
+      try:
+         if not self.cached:
+            self.setupInputFiles(simToolLocation,
+                                 doSimToolFiles=True,keepSimToolNotebook=False,remote=False,
+                                 doUserInputFiles=True,
+                                 doSimToolInputFile=False)
 
-         prerunFiles = os.listdir(self.outdir)
-         prerunFiles.append(self.nbName)
+            prerunFiles = os.listdir(self.outdir)
+            prerunFiles.append(self.nbName)
 
-         # FIXME: run in background. wait or check status.
-         # Suppress
-         # FutureWarning: Method cleanup(connection_file=True) is deprecated, use cleanup_resources(restart=False).
-         with warnings.catch_warnings():
-            warnings.simplefilter(action='ignore',category=FutureWarning)
-            pm.execute_notebook(simToolLocation['notebookPath'],self.outname,parameters=self.input_dict,cwd=self.outdir)
+# Parameter files are created after prerunFiles is determined, they are not cached
+            parameters = self.getNotebookParameters(simToolLocation)
 
-         self.processOutputs(cache,prerunFiles,trustedExecution=False)
-      else:
-         self.db = DB(self.outname,dir=self.outdir)
+            # Suppress
+            # FutureWarning: Method cleanup(connection_file=True) is deprecated, use cleanup_resources(restart=False).
+            with warnings.catch_warnings():
+               warnings.simplefilter(action='ignore',category=FutureWarning)
+               pm.execute_notebook(simToolLocation['notebookPath'],self.outname,parameters=parameters,cwd=self.outdir,
+                                   engine_name=engine)
 
+            self.processOutputs(cache,prerunFiles,trustedExecution=False)
+         else:
+            self.db = DB(self.outname,dir=self.outdir)
+      finally:
+# results have been written to the cache or the run failed, waiting identical runs can proceed
+         self.unlockRun()
 
-class SubmitLocalRun(RunBase):
+
+class ScriptRun(RunBase):
    """
-   Run a notebook using submit --local.
+   Run a notebook converted to a Python script without a Jupyter kernel.
    """
 
    def __init__(self,simToolLocation,inputs,runName,cache):
@@ -432,44 +632,96 @@ class SubmitLocalRun(RunBase):
                             createOutDir=True,remoteAttributes=None,
                             remote=False,trustedExecution=False)
 
-      if not self.cached:
-         self.setupInputFiles(simToolLocation,
-                              doSimToolFiles=True,keepSimToolNotebook=False,remote=False,
-                              doUserInputFiles=True,
-                              doSimToolInputFile=True)
+      try:
+         if not self.cached:
+            self.setupInputFiles(simToolLocation,
+                                 doSimToolFiles=True,keepSimToolNotebook=False,remote=False,
+                                 doUserInputFiles=True,
+                                 doSimToolInputFile=True)
+
+            prerunFiles = os.listdir(self.outdir)
+            prerunFiles.append(self.nbName)
+
+            try:
+               scriptPath = compileNotebook(simToolLocation['notebookPath'])
+            except ValueError as e:
+               print("SimTool cannot be run as a script, %s" % (e.args[0]))
+               print("Executing notebook with papermill")
+# Parameter files are created after prerunFiles is determined, they are not cached
+               parameters = self.getNotebookParameters(simToolLocation)
+               with warnings.catch_warnings():
+                  warnings.simplefilter(action='ignore',category=FutureWarning)
+                  pm.execute_notebook(simToolLocation['notebookPath'],self.outname,parameters=parameters,cwd=self.outdir)
+            else:
+# the script runs in outdir, the working directory of this process is not changed
+               try:
+                  commandArgs = [sys.executable,scriptPath,simToolLocation['notebookPath'],self.nbName]
+                  exitCode,commandStdout,commandStderr = self.executeCommand(commandArgs,streamOutput=True,cwd=self.outdir)
+               except:
+                  exitCode = 1
+                  print(traceback.format_exc(),file=sys.stderr)
+               if exitCode != 0:
+                  print("SimTool execution failed")
 
-         cwd = os.getcwd()
-         os.chdir(self.outdir)
-
-         prerunFiles = os.listdir(os.getcwd())
-         prerunFiles.append(self.nbName)
-
-         # FIXME: run in background. wait or check status.
-         submitCommand = SubmitCommand()
-         submitCommand.setLocal()
-         submitCommand.setCommand(papermillCLI)
-         submitCommand.setCommandArguments(["--no-request-save-on-cell-execute",
-                                            "--autosave-cell-every","0",
-                                            "--no-use-black-format-injection",
-                                            "--parameters_file","inputs.yaml",
-                                            simToolLocation['notebookPath'],
-                                            self.nbName])
-         submitCommand.show()
-         try:
-            result = submitCommand.submit()
-         except:
-            exitCode = 1
-            print(traceback.format_exc(),file=sys.stderr)
+            self.processOutputs(cache,prerunFiles,trustedExecution=False)
          else:
-            exitCode = result['exitCode']
-            if exitCode != 0:
-               print("SimTool execution failed")
+            self.db = DB(self.outname,dir=self.outdir)
+      finally:
+# results have been written to the cache or the run failed, waiting identical runs can proceed
+         self.unlockRun()
 
-         os.chdir(cwd)
 
-         self.processOutputs(cache,prerunFiles,trustedExecution=False)
-      else:
-         self.db = DB(self.outname,dir=self.outdir)
+class SubmitLocalRun(RunBase):
+   """
+   Run a notebook using submit --local.
+   """
+
+   def __init__(self,simToolLocation,inputs,runName,cache):
+      RunBase.__init__(self,simToolLocation,inputs,runName,cache,
+                            createOutDir=True,remoteAttributes=None,
+                            remote=False,trustedExecution=False)
+
+      try:
+         if not self.cached:
+            self.setupInputFiles(simToolLocation,
+                                 doSimToolFiles=True,keepSimToolNotebook=False,remote=False,
+                                 doUserInputFiles=True,
+                                 doSimToolInputFile=True)
+
+            cwd = os.getcwd()
+            os.chdir(self.outdir)
+
+            prerunFiles = os.listdir(os.getcwd())
+            prerunFiles.append(self.nbName)
+
+            submitCommand = SubmitCommand()
+            submitCommand.setLocal()
+            submitCommand.setCommand(papermillCLI)
+            submitCommand.setCommandArguments(["--no-request-save-on-cell-execute",
+                                               "--autosave-cell-every","0",
+                                               "--no-use-black-format-injection",
+                                               "--parameters_file","inputs.yaml",
+                                               simToolLocation['notebookPath'],
+                                               self.nbName])
+            submitCommand.show()
+            try:
+               result = submitCommand.submit()
+            except:
+               exitCode = 1
+               print(traceback.format_exc(),file=sys.stderr)
+            else:
+               exitCode = result['exitCode']
+               if exitCode != 0:
+                  print("SimTool execution failed")
+
+            os.chdir(cwd)
+
+            self.processOutputs(cache,prerunFiles,trustedExecution=False)
+         else:
+            self.db = DB(self.outname,dir=self.outdir)
+      finally:
+# results have been written to the cache or the run failed, waiting identical runs can proceed
+         self.unlockRun()
 
 
 class SubmitRemoteRun(RunBase):
@@ -482,55 +734,58 @@ class SubmitRemoteRun(RunBase):
                             createOutDir=True,remoteAttributes=remoteAttributes,
                             remote=True,trustedExecution=False)
 
-      if not self.cached:
-         self.setupInputFiles(simToolLocation,
-                              doSimToolFiles=True,keepSimToolNotebook=True,remote=True,
-                              doUserInputFiles=True,
-                              doSimToolInputFile=True)
+      try:
+         if not self.cached:
+            self.setupInputFiles(simToolLocation,
+                                 doSimToolFiles=True,keepSimToolNotebook=True,remote=True,
+                                 doUserInputFiles=True,
+                                 doSimToolInputFile=True)
+
+            cwd = os.getcwd()
+            os.chdir(self.outdir)
+
+            prerunFiles = os.listdir(os.getcwd())
+            prerunFiles.append(self.nbName)
+
+            submitCommand = SubmitCommand()
+            try:
+               submitCommand.setVenue(remoteAttributes['venue'])
+            except:
+               pass
+            try:
+               submitCommand.setWallTime(remoteAttributes['wallTime'])
+            except:
+               pass
+            try:
+               submitCommand.setNcores(remoteAttributes['nCores'])
+            except:
+               pass
+            submitCommand.setInputFiles([RunBase.SIMTOOLRUNPREFIX,RunBase.INPUTFILERUNPREFIX])
+            submitCommand.setCommand(remoteAttributes['command'])
+            submitCommand.setCommandArguments(["-s",simToolLocation['simToolName'],
+                                               "-i","inputs.yaml"])
+            submitCommand.show()
+            try:
+               result = submitCommand.submit()
+            except:
+               exitCode = 1
+               print(traceback.format_exc(),file=sys.stderr)
+            else:
+               exitCode = result['exitCode']
+               if exitCode != 0:
+                  print("SimTool execution failed")
 
-         cwd = os.getcwd()
-         os.chdir(self.outdir)
+            shutil.rmtree(self.remoteSimTool,True)
 
-         prerunFiles = os.listdir(os.getcwd())
-         prerunFiles.append(self.nbName)
+            os.chdir(cwd)
 
-         # FIXME: run in background. wait or check status.
-         submitCommand = SubmitCommand()
-         try:
-            submitCommand.setVenue(remoteAttributes['venue'])
-         except:
-            pass
-         try:
-            submitCommand.setWallTime(remoteAttributes['wallTime'])
-         except:
-            pass
-         try:
-            submitCommand.setNcores(remoteAttributes['nCores'])
-         except:
-            pass
-         submitCommand.setInputFiles([RunBase.SIMTOOLRUNPREFIX,RunBase.INPUTFILERUNPREFIX])
-         submitCommand.setCommand(remoteAttributes['command'])
-         submitCommand.setCommandArguments(["-s",simToolLocation['simToolName'],
-                                            "-i","inputs.yaml"])
-         submitCommand.show()
-         try:
-            result = submitCommand.submit()
-         except:
-            exitCode = 1
-            print(traceback.format_exc(),file=sys.stderr)
+            self.processOutputs(cache,prerunFiles,trustedExecution=False)
          else:
-            exitCode = result['exitCode']
-            if exitCode != 0:
-               print("SimTool execution failed")
-
-         shutil.rmtree(self.remoteSimTool,True)
-
-         os.chdir(cwd)
-
-         self.processOutputs(cache,prerunFiles,trustedExecution=False)
-      else:
-         shutil.rmtree(self.remoteSimTool,True)
-         self.db = DB(self.outname,dir=self.outdir)
+            shutil.rmtree(self.remoteSimTool,True)
+            self.db = DB(self.outname,dir=self.outdir)
+      finally:
+# results have been written to the cache or the run failed, waiting identical runs can proceed
+         self.unlockRun()
 
 
 class TrustedUserLocalRun(RunBase):
@@ -635,18 +890,55 @@ class Run:
                parameter is False, do neither of these.  The SimTool must be published
                to access the global cache, otherwise each user has a local cache
                that can be accesed.
-           venue: [None, noSubmit, local, trustedLocal, remote, trustedRemote] venue selection mode.
+           venue: [None, noSubmit, script, local, trustedLocal, remote, trustedRemote] venue selection mode.
                noSubmit - to ignore presense of submit.
+               script - to run the notebook converted to a Python script, without a Jupyter kernel.
                local - to use 'submit --local'.
                trustedLocal - to use 'submit --local' as the trusted user for global cache interaction.
                remote - to use 'submit' to execute job on remote resource.
                trustedRemote - to use 'submit' to execute job on remote resource as the trusted user for global cache interaction.
                None - venue is determined based on the availability of submit and the other arguments.
+           engine: Name of the papermill engine used for noSubmit execution.  'kernelpool'
+               executes the notebook in a kernel from a pool of started kernels, the pool
+               is filled on first use or ahead of it by simtool.kernelpool.getKernelPool().start().
+               None - the papermill default engine.
+           wait: If False, the run is started in a separate process and a BackgroundRun
+               handle is returned immediately.  The Run object is available from the
+               handle once the run completes.
        Returns:
-           A Run object.
+           A Run object, or a BackgroundRun object if wait is False.
        """
 
-   def __new__(cls,simToolLocation,inputs,runName=None,remoteAttributes=None,cache=True,venue=None):
+   def __new__(cls,simToolLocation,inputs,runName=None,remoteAttributes=None,cache=True,venue=None,engine=None,wait=True):
+      venue,remoteRunAttributes,cache = Run._selectVenue(simToolLocation,remoteAttributes,cache,venue)
+
+      if not wait:
+         return BackgroundRun(simToolLocation,inputs,runName,remoteRunAttributes,cache,venue,engine)
+
+      if   venue == 'local':
+         newclass = SubmitLocalRun(simToolLocation,inputs,runName,cache)
+      elif venue == 'remote':
+         newclass = SubmitRemoteRun(simToolLocation,inputs,runName,remoteRunAttributes,cache)
+      elif venue == 'trustedLocal':
+         newclass = TrustedUserLocalRun(simToolLocation,inputs,runName,cache)
+      elif venue == 'trustedRemote':
+         newclass = TrustedUserRemoteRun(simToolLocation,inputs,runName,remoteRunAttributes,cache)
+      elif venue == 'noSubmit':
+         newclass = LocalRun(simToolLocation,inputs,runName,cache,engine=engine)
+      elif venue == 'script':
+         newclass = ScriptRun(simToolLocation,inputs,runName,cache)
+      elif venue == 'webService': 
+         newclass = WebServicePrepare(simToolLocation,inputs,runName,remoteRunAttributes,cache)
+      elif venue is None:
+         newclass = LocalRun(simToolLocation,inputs,runName,cache,engine=engine)
+      else:
+         raise ValueError('Bad venue/cache combination')
+
+      return newclass
+
+
+   @staticmethod
+   def _selectVenue(simToolLocation,remoteAttributes,cache,venue):
       remoteRunAttributes = copy.deepcopy(remoteAttributes)
       if venue is None and submitAvailable:
          if   remoteRunAttributes:
@@ -671,23 +963,229 @@ class Run:
       if simToolLocation['simToolRevision'] is None:
          cache = False
 
-      if   venue == 'local':
-         newclass = SubmitLocalRun(simToolLocation,inputs,runName,cache)
-      elif venue == 'remote':
-         newclass = SubmitRemoteRun(simToolLocation,inputs,runName,remoteRunAttributes,cache)
-      elif venue == 'trustedLocal':
-         newclass = TrustedUserLocalRun(simToolLocation,inputs,runName,cache)
-      elif venue == 'trustedRemote':
-         newclass = TrustedUserRemoteRun(simToolLocation,inputs,runName,remoteRunAttributes,cache)
-      elif venue == 'noSubmit':
-         newclass = LocalRun(simToolLocation,inputs,runName,cache)
-      elif venue == 'webService': 
-         newclass = WebServicePrepare(simToolLocation,inputs,runName,remoteRunAttributes,cache)
-      elif venue is None:
-         newclass = LocalRun(simToolLocation,inputs,runName,cache)
+      return venue,remoteRunAttributes,cache
+
+
+   @staticmethod
+   def sweep(simToolLocation,inputsList,maxWorkers=None,remoteAttributes=None,cache=True,venue=None,engine=None):
+      """Runs a SimTool for each set of inputs, several at a time.
+
+          Each set of inputs is run as by Run() in a pool of worker processes.
+          Sets of inputs whose results are already in the cache are retrieved
+          directly and do not occupy a worker.
+
+          Args:
+              simToolLocation: A dictionary containing information on SimTool notebook
+                  location and status.
+              inputsList: A list of SimTools Params objects or dictionaries of key-value pairs.
+              maxWorkers: The maximum number of runs executed concurrently.  Defaults
+                  to the number of processors on the machine.
+              remoteAttributes: A list of parameters used for submission to offsite
+                  resource, applied to every run.
+              cache: Use the cache as described for Run().
+              venue: venue selection mode as described for Run().
+              engine: papermill engine as described for Run().
+          Returns:
+              A list of Run objects in the same order as inputsList.  The entry
+              for a run that raised an exception is None.
+      """
+      venue,remoteRunAttributes,cache = Run._selectVenue(simToolLocation,remoteAttributes,cache,venue)
+      checkCache = cache and venue not in ['trustedLocal','trustedRemote','webService']
+
+      runs = [None]*len(inputsList)
+      pendingRuns = []
+      inputsList = [ _getPortableInputs(inputs) for inputs in inputsList ]
+      if checkCache:
+         cachedList = RunBase.areCached(simToolLocation,inputsList)
       else:
-         raise ValueError('Bad venue/cache combination')
+         cachedList = [False]*len(inputsList)
+      for index,inputs in enumerate(inputsList):
+         if cachedList[index]:
+            runs[index] = Run(simToolLocation,inputs,remoteAttributes=remoteRunAttributes,cache=cache,venue=venue,engine=engine)
+         else:
+            pendingRuns.append((index,inputs))
+
+      if pendingRuns:
+         experiment = get_experiment()
+         with concurrent.futures.ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+            futures = {}
+            for index,inputs in pendingRuns:
+               future = executor.submit(_runInWorker,simToolLocation,inputs,None,experiment,
+                                                     remoteRunAttributes,cache,venue,engine)
+               futures[future] = index
+            for future in concurrent.futures.as_completed(futures):
+               try:
+                  runs[futures[future]] = future.result()
+               except:
+                  print("Run of inputs[%d] failed" % (futures[future]),file=sys.stderr)
+                  print(traceback.format_exc(),file=sys.stderr)
+
+      return runs
 
-      return newclass
 
+class BackgroundRun:
+   """Handle for a SimTool Run executing in a separate process.
 
+       The run, including processing of outputs and writing to the cache,
+       proceeds independently of the calling process.  The handle is used
+       to check on, wait for or cancel the run.
+
+       Attributes:
+           runName: The run name.
+           outdir: The directory where results are placed.
+   """
+   CANCELTIMEOUT = 10 # seconds the run process has to clean up when cancelled
+
+   def __init__(self,simToolLocation,inputs,runName,remoteAttributes,cache,venue,engine):
+      if runName:
+         self.runName = runName
+      else:
+         self.runName = str(uuid.uuid4()).replace('-','')
+      experiment = get_experiment()
+      self.outdir = os.path.join(experiment,self.runName)
+
+      self.__run       = None
+      self.__error     = None
+      self.__cancelled = False
+      self.__connection,childConnection = multiprocessing.Pipe(duplex=False)
+      self.__process = multiprocessing.Process(target=_runInBackground,
+                                               args=(childConnection,simToolLocation,_getPortableInputs(inputs),
+                                                     self.runName,experiment,remoteAttributes,cache,venue,engine))
+      self.__process.start()
+      childConnection.close()
+
+
+   def __collect(self,timeout):
+      if self.__connection.poll(timeout):
+         try:
+            self.__run,self.__error = self.__connection.recv()
+         except EOFError:
+            self.__process.join()
+            self.__error = "Run process exited with code %s" % (self.__process.exitcode)
+         else:
+            self.__process.join()
+         self.__connection.close()
+
+
+   def done(self):
+      """Check if the run has completed.
+
+         Returns:
+             True if the run has finished, failed or been cancelled.
+      """
+      if self.__run is None and self.__error is None and not self.__cancelled:
+         self.__collect(0)
+      return self.__run is not None or self.__error is not None or self.__cancelled
+
+
+   def status(self):
+      """Get the state of the run.
+
+         Returns:
+             One of 'running', 'finished', 'failed' or 'cancelled'.
+      """
+      if not self.done():
+         return 'running'
+      if self.__cancelled:
+         return 'cancelled'
+      if self.__error is not None:
+         return 'failed'
+      return 'finished'
+
+
+   def wait(self,timeout=None):
+      """Wait for the run to complete.
+
+         Args:
+             timeout: Maximum number of seconds to wait.  Wait indefinitely if None.
+         Returns:
+             True if the run has completed.
+      """
+      if not self.done():
+         self.__collect(timeout)
+      return self.done()
+
+
+   def result(self,timeout=None):
+      """Get the Run object, waiting for the run to complete.
+
+         Args:
+             timeout: Maximum number of seconds to wait.  Wait indefinitely if None.
+         Returns:
+             The Run object.
+      """
+      if not self.wait(timeout):
+         raise concurrent.futures.TimeoutError("Run %s has not completed" % (self.runName))
+      if self.__cancelled:
+         raise concurrent.futures.CancelledError("Run %s was cancelled" % (self.runName))
+      if self.__error is not None:
+         raise RuntimeError("Run %s failed:\n%s" % (self.runName,self.__error))
+      return self.__run
+
+
+   def cancel(self):
+      """Cancel the run.
+
+         The run process and any processes it started are terminated.  The
+         run process is given CANCELTIMEOUT seconds to remove partially
+         written cache entries and release its run lock.
+
+         Returns:
+             True if the run was cancelled, False if it had already completed.
+      """
+      if self.done():
+         return False
+# The run process leads its own process group, terminate kernel and submit processes with it.
+# The run process cleans up on SIGTERM, it is killed if that takes longer than CANCELTIMEOUT.
+      try:
+         os.killpg(self.__process.pid,signal.SIGTERM)
+      except OSError:
+         self.__process.terminate()
+      self.__process.join(BackgroundRun.CANCELTIMEOUT)
+      if self.__process.is_alive():
+         self.__process.kill()
+         self.__process.join()
+      try:
+         os.killpg(self.__process.pid,signal.SIGKILL)
+      except OSError:
+         pass
+      self.__connection.close()
+      self.__cancelled = True
+      return True
+
+
+def _getPortableInputs(inputs):
+# Params objects carry units from the module unit registry and do not travel
+# well between processes, reduce them to the equivalent dictionary of values.
+   if type(inputs) == dict:
+      return inputs
+   portableInputs = {}
+   for label in inputs:
+      portableInputs[label] = inputs[label].serialValue
+   return portableInputs
+
+
+def _runInWorker(simToolLocation,inputs,runName,experiment,remoteAttributes,cache,venue,engine):
+# Entry point for runs executed in a separate process
+   set_experiment(experiment)
+   return Run(simToolLocation,inputs,runName=runName,remoteAttributes=remoteAttributes,cache=cache,
+                                     venue=venue,engine=engine)
+
+
+def _runInBackground(connection,simToolLocation,inputs,runName,experiment,remoteAttributes,cache,venue,engine):
+# Entry point for BackgroundRun, the outcome is returned through connection
+   os.setpgid(0,0)
+# BackgroundRun.cancel() sends SIGTERM, unwind so that cache entries being
+# written are removed and run locks are released
+   def cancelRun(signum,frame):
+      signal.signal(signal.SIGTERM,signal.SIG_IGN)
+      raise SystemExit("Run cancelled")
+   signal.signal(signal.SIGTERM,cancelRun)
+   try:
+      run = _runInWorker(simToolLocation,inputs,runName,experiment,remoteAttributes,cache,venue,engine)
+   except:
+      connection.send((None,traceback.format_exc()))
+   else:
+      connection.send((run,None))
+   finally:
+      connection.close()
@@ -0,0 +1,215 @@
+# @package      hubzero-simtool
+# @file         script.py
+# @copyright    Copyright (c) 2019-2021 The Regents of the University of California.
+# @license      http://opensource.org/licenses/MIT MIT
+# @trademark    HUBzero is a registered trademark of The Regents of the University of California.
+#
+import os
+import sys
+import atexit
+import hashlib
+import tempfile
+import traceback
+import warnings
+import yaml
+import nbformat
+from IPython.core.inputtransformer2 import TransformerManager
+from .datastore import FileDataStore
+
+# Bump when the generated script changes so previously compiled scripts are not reused
+SCRIPTFORMATVERSION = '1'
+SCRIPTCACHEDIR      = None  # default is .simtool_scripts in FileDataStore.USERCACHELOCATIONROOT
+
+# Magics with no effect outside of a kernel
+IGNOREDLINEMAGICS = ['%load_ext yamlmagic','%matplotlib']
+
+
+def _getScriptCacheDir():
+   if SCRIPTCACHEDIR:
+      return SCRIPTCACHEDIR
+   return os.path.join(FileDataStore.USERCACHELOCATIONROOT,'.simtool_scripts')
+
+
+def _convertYAMLCell(cellSource):
+# %%yaml NAME [-lLOADER] as handled by yamlmagic
+   cellSourceLines = cellSource.split('\n')
+   magicArgs = cellSourceLines[0].split()[1:]
+   if len(magicArgs) == 0 or len(magicArgs) > 2:
+      raise ValueError("cannot convert cell magic: %s" % (cellSourceLines[0]))
+   loader = 'yaml.SafeLoader'
+   if len(magicArgs) == 2:
+      if magicArgs[1].startswith('-l'):
+         loader = magicArgs[1][2:]
+      else:
+         raise ValueError("cannot convert cell magic: %s" % (cellSourceLines[0]))
+   yamlContent = '\n'.join(cellSourceLines[1:])
+
+   return "%s = yaml.load(%r, Loader=%s)" % (magicArgs[0],yamlContent,loader)
+
+
+def _convertCodeCell(cellSource,transformerManager):
+   if cellSource.startswith('%%yaml'):
+      return _convertYAMLCell(cellSource)
+   if cellSource.lstrip().startswith('%%'):
+      raise ValueError("cannot convert cell magic: %s" % (cellSource.lstrip().split('\n')[0]))
+
+   cellSourceLines = []
+   for cellSourceLine in cellSource.split('\n'):
+      ignoreLine = False
+      for ignoredLineMagic in IGNOREDLINEMAGICS:
+         if cellSourceLine.strip().startswith(ignoredLineMagic):
+            ignoreLine = True
+            break
+      if not ignoreLine:
+         cellSourceLines.append(cellSourceLine)
+
+   pythonSource = transformerManager.transform_cell('\n'.join(cellSourceLines))
+   if 'get_ipython()' in pythonSource:
+      raise ValueError("cannot convert IPython magic or shell command in cell:\n%s" % (cellSource))
+
+   return pythonSource
+
+
+def convertNotebook(nb):
+   """Convert a sim2L notebook to a Python script.
+
+      Parameter values are read from inputs.yaml after the cell tagged
+      'parameters'.  Outputs saved with DB.save() are collected and written
+      to an output notebook when the script exits.  The script is run as
+
+          python script.py sourceNotebook outputNotebook
+
+      Args:
+          nb: The notebook node.
+      Returns:
+          The script source.
+   """
+   transformerManager = TransformerManager()
+   scriptLines = ["# Generated by simtool from a sim2L notebook",
+                  "import yaml",
+                  "from simtool import script as _simtoolScript",
+                  "_simtoolScript.startScriptRun()",
+                  ""]
+   for cellIndex,cell in enumerate(nb.cells):
+      if cell.cell_type != 'code':
+         continue
+      scriptLines.append("# In[%d]:" % (cellIndex))
+      scriptLines.append(_convertCodeCell(cell.source,transformerManager))
+      if 'parameters' in cell.metadata.get('tags',[]):
+         scriptLines.append("# Parameters")
+         scriptLines.append("globals().update(_simtoolScript.loadParameters('inputs.yaml'))")
+      scriptLines.append("")
+
+   return '\n'.join(scriptLines)
+
+
+def compileNotebook(notebookPath):
+   """Get the Python script for a sim2L notebook.
+
+      Scripts are kept in a cache keyed by the notebook content, a notebook
+      is only converted the first time it is seen.
+
+      Args:
+          notebookPath: Path to the sim2L notebook.
+      Returns:
+          Path of the script.
+   """
+   with open(notebookPath,'rb') as fp:
+      notebookContent = fp.read()
+   notebookHash = hashlib.sha256(SCRIPTFORMATVERSION.encode('utf-8') + notebookContent).hexdigest()
+
+   scriptCacheDir = _getScriptCacheDir()
+   scriptPath = os.path.join(scriptCacheDir,notebookHash + '.py')
+   if not os.path.exists(scriptPath):
+      nb = nbformat.reads(notebookContent.decode('utf-8'),as_version=4)
+      scriptSource = convertNotebook(nb)
+      if not os.path.isdir(scriptCacheDir):
+         os.makedirs(scriptCacheDir,exist_ok=True)
+      fd,tmpPath = tempfile.mkstemp(dir=scriptCacheDir,suffix='.tmp')
+      with os.fdopen(fd,'w') as fp:
+         fp.write(scriptSource)
+      os.replace(tmpPath,scriptPath)
+
+   return scriptPath
+
+
+def loadParameters(inputsPath):
+   """Read parameter values written for the run."""
+   with open(inputsPath,'r') as fp:
+      parameters = yaml.load(fp,Loader=yaml.FullLoader)
+   return parameters or {}
+
+
+class _ScriptRun:
+   """
+   Collects scraps glued while a script runs and writes the output notebook.
+   """
+
+   def __init__(self,sourceNotebookPath,outputNotebookPath):
+      self.sourceNotebookPath = sourceNotebookPath
+      self.outputNotebookPath = outputNotebookPath
+      self.outputs   = []
+      self.exception = None
+
+
+   def display(self,*objs,**kwargs):
+      metadata = kwargs.get('metadata')
+      if kwargs.get('raw') and metadata and 'scrapbook' in metadata:
+         for obj in objs:
+            self.outputs.append(nbformat.v4.new_output('display_data',data=obj,metadata=metadata))
+      else:
+         self.ipythonDisplay(*objs,**kwargs)
+
+
+   def excepthook(self,exceptionType,exceptionValue,exceptionTraceback):
+      self.exception = (exceptionType,exceptionValue,exceptionTraceback)
+      sys.__excepthook__(exceptionType,exceptionValue,exceptionTraceback)
+
+
+   def writeNotebook(self):
+      nb = nbformat.read(self.sourceNotebookPath,as_version=4)
+      parametersCellIndex = None
+      for cellIndex,cell in enumerate(nb.cells):
+         if 'parameters' in cell.metadata.get('tags',[]):
+            parametersCellIndex = cellIndex
+            break
+      if parametersCellIndex is not None and os.path.exists('inputs.yaml'):
+         with open('inputs.yaml','r') as fp:
+            parametersCell = nbformat.v4.new_code_cell("# Parameters\n" + fp.read())
+         parametersCell.metadata['tags'] = ['injected-parameters']
+         nb.cells.insert(parametersCellIndex+1,parametersCell)
+
+      outputsCell = nbformat.v4.new_code_cell("# Outputs saved by script execution")
+      outputsCell.metadata['tags'] = ['simtool-script-outputs']
+      outputsCell.outputs = self.outputs
+      if self.exception:
+         exceptionType,exceptionValue,exceptionTraceback = self.exception
+         outputsCell.outputs.append(nbformat.v4.new_output('error',
+                                                           ename=exceptionType.__name__,
+                                                           evalue=str(exceptionValue),
+                                                           traceback=traceback.format_exception(exceptionType,
+                                                                                                exceptionValue,
+                                                                                                exceptionTraceback)))
+      nb.cells.append(outputsCell)
+      nbformat.write(nb,self.outputNotebookPath)
+
+
+def startScriptRun():
+   """Prepare the interpreter for running a sim2L script.
+
+      Called at the beginning of generated scripts.  The current directory
+      is put on the module search path as it is for a kernel and the output
+      notebook is written when the interpreter exits.
+   """
+   import IPython.display
+
+   sourceNotebookPath,outputNotebookPath = sys.argv[1:3]
+   scriptRun = _ScriptRun(sourceNotebookPath,outputNotebookPath)
+
+   sys.path.insert(0,os.getcwd())
+   warnings.filterwarnings('ignore',message="No kernel detected")
+# scrapbook.glue looks up IPython.display.display each time it is called
+   scriptRun.ipythonDisplay = IPython.display.display
+   IPython.display.display = scriptRun.display
+   sys.excepthook = scriptRun.excepthook
+   atexit.register(scriptRun.writeNotebook)
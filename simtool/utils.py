@@ -8,9 +8,19 @@ import os
 import sys
 import re
 import glob
-import nbformat
+import json
+import copy
+import functools
+import time
+import tempfile
+import threading
+import collections
+import concurrent.futures
 import hashlib
+import sqlite3
+import numpy as np
 from papermill.iorw import load_notebook_node
+from papermill.translators import PythonTranslator, papermill_translators
 import yaml
 import jsonpickle
 from .params import Params
@@ -110,13 +120,147 @@ def getValidatedInputs(inputs):
    return validatedInputs
 
 
+APPSROOT = os.path.join(os.sep,'apps')  # installed and published sim2Ls are in APPSROOT/name/revision/simtool
+
+SIMTOOLNOTEBOOKCACHESIZE = 64  # number of parsed notebooks kept by _loadSimToolNotebook
+SIMTOOLMANIFESTVERSION   = 1   # manifests written with a different version are ignored
+
+
+def _getSimToolManifestPath(nbPath):
+   return os.path.splitext(nbPath)[0] + '.manifest.json'
+
+
+def _loadSimToolNotebook(nbPath):
+   """Internal function to get the sim2L definitions from a notebook.
+   The definitions are taken from the notebook manifest if it is newer
+   than the notebook, otherwise the notebook is read and parsed.  Results
+   are kept for as long as the files are unchanged.  The returned
+   dictionary is shared and must not be modified.
+   """
+   realPath = os.path.realpath(nbPath)
+   nbStat = os.stat(realPath)
+
+   try:
+      manifestStat = os.stat(_getSimToolManifestPath(realPath))
+   except OSError:
+      pass
+   else:
+      if manifestStat.st_mtime_ns >= nbStat.st_mtime_ns:
+         simToolNotebook = _readSimToolManifest(_getSimToolManifestPath(realPath),
+                                                manifestStat.st_mtime_ns,manifestStat.st_size)
+         if simToolNotebook is not None:
+            return simToolNotebook
+
+   return _readSimToolNotebook(realPath,nbStat.st_mtime_ns,nbStat.st_size)
+
+
+@functools.lru_cache(maxsize=SIMTOOLNOTEBOOKCACHESIZE)
+def _readSimToolManifest(manifestPath,mtime,size):
+   try:
+      with open(manifestPath,'r') as fp:
+         manifest = json.load(fp)
+   except:
+      return None
+   if manifest.get('version') != SIMTOOLMANIFESTVERSION:
+      return None
+
+   simToolNotebook = {}
+   for key in ['inputs','outputs','extraFiles','description','metadata']:
+      try:
+         simToolNotebook[key] = manifest[key]
+      except KeyError:
+         return None
+
+   return simToolNotebook
+
+
+@functools.lru_cache(maxsize=SIMTOOLNOTEBOOKCACHESIZE)
+def _readSimToolNotebook(realPath,mtime,size):
+   nb = load_notebook_node(realPath)
+
+# Each definition is read on its own, an error in one of them is raised
+# when that definition is used.
+   simToolNotebook = {}
+   simToolNotebook['errors'] = {}
+   for key,getDefinition in [('inputs',     lambda nb: _getNotebookCellYAMLcontent(nb,"INPUTS")),
+                             ('outputs',    lambda nb: _getNotebookCellYAMLcontent(nb,"OUTPUTS")),
+                             ('extraFiles', _getNotebookExtraFiles),
+                             ('description',_getNotebookDescription),
+                             ('metadata',   _getNotebookMetaData)]:
+      try:
+         simToolNotebook[key] = getDefinition(nb)
+      except Exception as err:
+         simToolNotebook[key] = None
+         simToolNotebook['errors'][key] = err
+
+   return simToolNotebook
+
+
+def _getSimToolDefinition(nbPath,key):
+   """Internal function to get a copy of one of the sim2L definitions
+   read by _loadSimToolNotebook.  The error found reading the definition
+   from the notebook is raised.
+   """
+   simToolNotebook = _loadSimToolNotebook(nbPath)
+   error = simToolNotebook.get('errors',{}).get(key)
+   if error is not None:
+      raise error.with_traceback(None)
+
+   return copy.deepcopy(simToolNotebook[key])
+
+
+def writeSimToolManifest(nbPath):
+   """Write the manifest for a sim2L notebook.
+
+      The manifest holds the INPUTS, OUTPUTS, EXTRA_FILES, DESCRIPTION and
+      simTool_info definitions of the notebook.  It is used in place of the
+      notebook for as long as it is newer than the notebook.  Manifests should
+      be written when a sim2L is installed or published, after the notebook
+      metadata has been set.
+
+      Args:
+          nbPath: Path to the sim2L notebook.
+      Returns:
+          Path of the manifest file, <name>.manifest.json next to the notebook.
+   """
+   realPath = os.path.realpath(nbPath)
+   nbStat = os.stat(realPath)
+   manifest = copy.deepcopy(_readSimToolNotebook(realPath,nbStat.st_mtime_ns,nbStat.st_size))
+   errors = manifest.pop('errors')
+   if errors:
+      raise ValueError("cannot write manifest for %s: %s" % (nbPath,'; '.join(str(errors[key]) for key in errors)))
+   manifest['version'] = SIMTOOLMANIFESTVERSION
+   try:
+      manifestContent = json.dumps(manifest,indent=1)
+   except TypeError as err:
+      raise ValueError("cannot write manifest for %s: %s" % (nbPath,err))
+   if json.loads(manifestContent) != manifest:
+      raise ValueError("cannot write manifest for %s: definitions do not convert to JSON" % (nbPath))
+
+   manifestPath = _getSimToolManifestPath(realPath)
+   fd,tmpPath = tempfile.mkstemp(dir=os.path.dirname(manifestPath),suffix='.tmp')
+   try:
+      with os.fdopen(fd,'w') as fp:
+         fp.write(manifestContent)
+      os.chmod(tmpPath,0o644)
+      os.replace(tmpPath,manifestPath)
+   except:
+      os.unlink(tmpPath)
+      raise
+
+   return manifestPath
+
+
 def _get_extra_files(nbPath):
    """Internal function to search the notebook for a cell tagged
    'FILES' with content 'EXTRA_FILES=xxx' where 'xxx' is a list of files
    or '*'
    """
+   return _getSimToolDefinition(nbPath,'extraFiles')
+
+
+def _getNotebookExtraFiles(nb):
    ecell = None
-   nb = load_notebook_node(nbPath)
    for cell in nb.cells:
       if 'FILES' in cell.metadata.tags:
          ecell = cell['source']
@@ -147,8 +291,11 @@ def _getSimToolDescription(nbPath):
    'DESCRIPTION' with content 'DESCRIPTION=xxx' where 'xxx' is a
    string describing the simtool
    """
+   return _getSimToolDefinition(nbPath,'description')
+
+
+def _getNotebookDescription(nb):
    ecell = None
-   nb = load_notebook_node(nbPath)
    for cell in nb.cells:
       if 'DESCRIPTION' in cell.metadata.tags:
          ecell = cell['source']
@@ -191,41 +338,48 @@ def getGetSimToolNameRevisionFromEnvironment():
 
 
 def _getSimToolNotebookMetaData(nbPath):
+   try:
+      simToolNotebookMetaData = _getSimToolDefinition(nbPath,'metadata')
+   except:
+      simToolNotebookMetaData = {}
+      simToolNotebookMetaData['name']     = None
+      simToolNotebookMetaData['revision'] = None
+      simToolNotebookMetaData['state']    = None
+
+   return simToolNotebookMetaData
+
+
+def _getNotebookMetaData(nb):
    simToolNotebookMetaData = {}
    simToolNotebookMetaData['name']     = None
    simToolNotebookMetaData['revision'] = None
    simToolNotebookMetaData['state']    = None
 
    try:
-      nb = nbformat.read(nbPath,nbformat.NO_CONVERT)
-   except:
+      metadata = nb['metadata']['simTool_info']
+   except (AttributeError,KeyError) as err:
       pass
    else:
       try:
-         metadata = nb['metadata']['simTool_info']
-      except (AttributeError,KeyError) as err:
+         name = metadata['name']
+      except:
          pass
       else:
-         try:
-            name = metadata['name']
-         except:
-            pass
-         else:
-            simToolNotebookMetaData['name'] = name
+         simToolNotebookMetaData['name'] = name
 
-         try:
-            revision = metadata['revision']
-         except:
-            pass
-         else:
-            simToolNotebookMetaData['revision'] = "r%d" % (revision)
+      try:
+         revision = metadata['revision']
+      except:
+         pass
+      else:
+         simToolNotebookMetaData['revision'] = "r%d" % (revision)
 
-         try:
-            state = metadata['state']
-         except:
-            pass
-         else:
-            simToolNotebookMetaData['state'] = state
+      try:
+         state = metadata['state']
+      except:
+         pass
+      else:
+         simToolNotebookMetaData['state'] = state
 
    return simToolNotebookMetaData
 
@@ -235,6 +389,10 @@ def findSimToolNotebook(simToolName,simToolRevision=None):
 
       This function has been replaced by searchForSimTool(simToolName,simToolRevision=None)
    """
+   return _getResolvedSimTool(_findSimToolNotebook,simToolName,simToolRevision)
+
+
+def _findSimToolNotebook(simToolName,simToolRevision=None):
    simToolLocation = {}
    simToolLocation['notebookPath']    = None
    simToolLocation['simToolName']     = None
@@ -242,40 +400,15 @@ def findSimToolNotebook(simToolName,simToolRevision=None):
    simToolLocation['published']       = None
 
    if   simToolRevision and not simToolName.endswith('.ipynb'):
-      simToolNotebook = os.path.basename(simToolName) + '.ipynb'
-      notebookPath = os.path.join(os.sep,'apps',simToolName,simToolRevision,'simtool',simToolNotebook)
-      if os.path.exists(notebookPath):
-         # look for installed or published revision in /apps/name/revision/simtool/
-         simToolLocation['notebookPath']    = os.path.realpath(notebookPath)
-         simToolLocation['simToolName']     = os.path.basename(simToolName)
-         simToolLocation['simToolRevision'] = os.path.basename(os.path.dirname(os.path.dirname(simToolLocation['notebookPath'])))
-         # verify pubication status - sample published notebook reference to simtool
-         simToolNotebookMetaData = _getSimToolNotebookMetaData(simToolLocation['notebookPath'])
-         if simToolNotebookMetaData['name'] == simToolLocation['simToolName'] and \
-            simToolNotebookMetaData['revision'] == simToolLocation['simToolRevision'] and \
-            simToolNotebookMetaData['state'] == 'published':
-            simToolLocation['published'] = True
-         else:
-            simToolLocation['published'] = False
-#           print(simToolNotebookMetaData['name'],simToolLocation['simToolName'])
-#           print(simToolNotebookMetaData['revision'],simToolLocation['simToolRevision'])
-#           print(simToolNotebookMetaData['state'])
-      else:
-         notebookPath = os.path.join(simToolName,simToolRevision,'simtool',simToolNotebook)
-         if os.path.exists(notebookPath):
-            # look for notebook in name/revision/simtool/
-            simToolLocation['notebookPath']    = os.path.realpath(notebookPath)
-            simToolLocation['simToolName']     = os.path.basename(simToolName)
-            simToolLocation['simToolRevision'] = simToolRevision
-            simToolLocation['published']       = False
+      simToolLocation = _selectSimToolRevision(_SimToolDirectories(),simToolName,simToolRevision)
    elif not simToolName.endswith('.ipynb'):
       # revision not specified
       # look for latest published revision in /apps
       simToolNotebook = os.path.basename(simToolName) + '.ipynb'
-      notebookPathPattern = os.path.join(os.sep,'apps',simToolName,'*','simtool',simToolNotebook)
+      notebookPathPattern = os.path.join(APPSROOT,simToolName,'*','simtool',simToolNotebook)
       newestRevision = 0
       for notebookPath in glob.glob(notebookPathPattern):
-         revision = notebookPath.split(os.sep)[3]
+         revision = os.path.basename(os.path.dirname(os.path.dirname(notebookPath)))
          if revision.startswith('r'):
             simToolNotebookMetaData = _getSimToolNotebookMetaData(notebookPath)
             if simToolNotebookMetaData['state'] == 'published':
@@ -303,12 +436,12 @@ def findSimToolNotebook(simToolName,simToolRevision=None):
                simToolLocation['simToolName']     = os.path.basename(simToolName)
                simToolLocation['simToolRevision'] = None
                simToolLocation['published']       = False
-               notebookPath = simToolLocation['notebookPath'].split(os.sep)
-               notebookPath.pop(0)
-               if len(notebookPath) == 5:
-                  revision = notebookPath.pop(2)
-                  if os.sep.join(notebookPath) == \
-                     os.path.join('apps',simToolLocation['simToolName'],'simtool',simToolNotebook):
+               notebookDirectory,notebookName = os.path.split(simToolLocation['notebookPath'])
+               revisionPath,notebookDirectory = os.path.split(notebookDirectory)
+               if notebookName == simToolNotebook and notebookDirectory == 'simtool':
+                  revision = os.path.basename(revisionPath)
+                  if os.path.dirname(revisionPath) == \
+                     os.path.join(os.path.realpath(APPSROOT),simToolLocation['simToolName']):
                      simToolLocation['simToolRevision'] = revision
                      # verify pubication status - sample published notebook reference to simtool
                      simToolNotebookMetaData = _getSimToolNotebookMetaData(simToolLocation['notebookPath'])
@@ -331,65 +464,197 @@ def findSimToolNotebook(simToolName,simToolRevision=None):
    return simToolLocation
 
 
+SIMTOOLCATALOGPATH        = os.path.expanduser('~/.simtool_catalog.json')  # None to disable the on-disk catalog
+SIMTOOLCATALOGVERSION     = 1
+SIMTOOLCATALOGSCANTHREADS = 8  # number of revisions read in parallel
+
+
+def _readSimToolCatalog():
+   """Internal function to read the catalog of sim2L revisions in APPSROOT.
+   An empty catalog is returned if there is no catalog for APPSROOT.
+   """
+   catalog = None
+   if SIMTOOLCATALOGPATH:
+      try:
+         with open(SIMTOOLCATALOGPATH,'r') as fp:
+            catalog = json.load(fp)
+      except:
+         catalog = None
+      else:
+         if catalog.get('version') != SIMTOOLCATALOGVERSION or catalog.get('appsRoot') != APPSROOT:
+            catalog = None
+
+   if catalog is None:
+      catalog = {}
+      catalog['version']      = SIMTOOLCATALOGVERSION
+      catalog['appsRoot']     = APPSROOT
+      catalog['mtime']        = None
+      catalog['simToolNames'] = []
+      catalog['simTools']     = {}
+
+   return catalog
+
+
+def _writeSimToolCatalog(catalog):
+   if SIMTOOLCATALOGPATH:
+# the catalog is only an optimization, failure to write it is not an error
+      try:
+         catalogDirectory = os.path.dirname(os.path.abspath(SIMTOOLCATALOGPATH))
+         fd,tmpPath = tempfile.mkstemp(dir=catalogDirectory,suffix='.tmp')
+         try:
+            with os.fdopen(fd,'w') as fp:
+               json.dump(catalog,fp)
+            os.replace(tmpPath,SIMTOOLCATALOGPATH)
+         except:
+            os.unlink(tmpPath)
+            raise
+      except OSError:
+         pass
+
+
+def _getSimToolRevisionCatalogEntry(nbPath,revisionEntry):
+   """Internal function to get the catalog entry for a sim2L revision.
+   The notebook is only read if it changed since revisionEntry was made.
+   """
+   try:
+      nbStat = os.stat(nbPath)
+   except OSError:
+      nbStat = None
+
+   if nbStat is None:
+      mtime = None
+      size  = None
+   else:
+      mtime = nbStat.st_mtime_ns
+      size  = nbStat.st_size
+   if revisionEntry and revisionEntry['mtime'] == mtime and revisionEntry['size'] == size:
+      return revisionEntry
+
+   revisionEntry = {}
+   revisionEntry['mtime']       = mtime
+   revisionEntry['size']        = size
+   revisionEntry['state']       = None
+   revisionEntry['description'] = None
+   if nbStat is not None:
+      simToolNotebookMetaData = _getSimToolNotebookMetaData(nbPath)
+      revisionEntry['state'] = simToolNotebookMetaData['state']
+      if simToolNotebookMetaData['state'] in ['installed','published']:
+         try:
+            revisionEntry['description'] = _getSimToolDescription(nbPath)
+         except Exception:
+            pass
+
+   return revisionEntry
+
+
+def _refreshSimToolCatalog(catalog,
+                           querySimToolName=None):
+   """Internal function to bring the catalog up to date with APPSROOT.
+   The revisions of a sim2L are listed again only if the sim2L directory
+   has changed.  Notebooks that have changed are read in parallel.
+
+   Returns:
+       True if the catalog was changed.
+   """
+   catalogChanged = False
+   if querySimToolName:
+      simToolNames = [querySimToolName]
+   else:
+      appsMtime = os.stat(APPSROOT).st_mtime_ns
+      if appsMtime != catalog['mtime']:
+         simToolNames = []
+         with os.scandir(APPSROOT) as appsDirs:
+            for appsDir in appsDirs:
+               if appsDir.is_dir():
+                  simToolNames.append(appsDir.name)
+         simToolNames.sort()
+         for simToolName in list(catalog['simTools'].keys()):
+            if not simToolName in simToolNames:
+               del catalog['simTools'][simToolName]
+         catalog['mtime']        = appsMtime
+         catalog['simToolNames'] = simToolNames
+         catalogChanged = True
+      simToolNames = catalog['simToolNames']
+
+   reFiles = re.compile("^r[0-9]+$")
+   revisionEntries = []
+   for simToolName in simToolNames:
+      simToolPath = os.path.join(APPSROOT,simToolName)
+      simToolEntry = catalog['simTools'].get(simToolName)
+      try:
+         simToolMtime = os.stat(simToolPath).st_mtime_ns
+         if simToolEntry is None or simToolEntry['mtime'] != simToolMtime:
+            dirFiles = os.listdir(simToolPath)
+      except OSError:
+         if simToolEntry is not None:
+            del catalog['simTools'][simToolName]
+            catalogChanged = True
+         continue
+
+      if simToolEntry is None or simToolEntry['mtime'] != simToolMtime:
+         previousRevisions = simToolEntry['revisions'] if simToolEntry else {}
+         simToolEntry = {}
+         simToolEntry['mtime']     = simToolMtime
+         simToolEntry['revisions'] = {}
+# revisions are listed as rN, the directory r01 holds revision r1
+         simToolEntry['directories'] = {}
+         for revisionDirectory in sorted(filter(reFiles.search,dirFiles)):
+            simToolRevision = 'r%d' % (int(revisionDirectory[1:]))
+            if simToolEntry['directories'].get(simToolRevision) != simToolRevision:
+               simToolEntry['directories'][simToolRevision] = revisionDirectory
+            simToolEntry['revisions'][simToolRevision] = previousRevisions.get(simToolRevision)
+         catalog['simTools'][simToolName] = simToolEntry
+         catalogChanged = True
+
+      for simToolRevision,revisionEntry in simToolEntry['revisions'].items():
+         nbPath = os.path.join(simToolPath,simToolEntry['directories'][simToolRevision],'simtool',"%s.ipynb" % (simToolName))
+         revisionEntries.append((simToolEntry['revisions'],simToolRevision,nbPath,revisionEntry))
+
+   with concurrent.futures.ThreadPoolExecutor(max_workers=SIMTOOLCATALOGSCANTHREADS) as executor:
+      futures = [ executor.submit(_getSimToolRevisionCatalogEntry,nbPath,revisionEntry)
+                                  for revisions,simToolRevision,nbPath,revisionEntry in revisionEntries ]
+      for (revisions,simToolRevision,nbPath,revisionEntry),future in zip(revisionEntries,futures):
+         newRevisionEntry = future.result()
+         if newRevisionEntry is not revisionEntry:
+            revisions[simToolRevision] = newRevisionEntry
+            catalogChanged = True
+
+   return catalogChanged
+
+
 def findInstalledSimToolNotebooks(querySimToolName=None,
                                   returnString=True):
    """Find all the revisions of a SimTool.
 
+       Revisions are kept in a catalog (SIMTOOLCATALOGPATH) that is
+       refreshed for changes in APPSROOT on each call.
+
        Returns:
            Ordered lists of installed and published revisions
    """
    installedSimToolRevisions = {}
 
+   catalog = _readSimToolCatalog()
+   if _refreshSimToolCatalog(catalog,querySimToolName):
+      _writeSimToolCatalog(catalog)
+
    if querySimToolName:
       simToolNames = [querySimToolName]
    else:
-      appsPath = os.path.join(os.sep,'apps')
-      appsDirs = os.listdir(appsPath)
-      simToolNames = []
-      for appsDir in appsDirs:
-         simToolPath = os.path.join(os.sep,'apps',appsDir)
-         if os.path.isdir(simToolPath):
-            simToolNames.append(appsDir)
-   simToolNames.sort()
+      simToolNames = catalog['simToolNames']
 
-   reFiles = re.compile("^r[0-9]+$")
    for simToolName in simToolNames:
-      simToolPath = os.path.join(os.sep,'apps',simToolName)
-      try:
-         dirFiles = os.listdir(simToolPath)
-      except:
-         pass
-      else:
-         matchingFiles = filter(reFiles.search,dirFiles)
-         simToolRevisions = []
-         for matchingFile in matchingFiles:
-            try:
-               revisionIndex = int(matchingFile[1:])
-            except:
-               pass
-            else:
-               simToolRevisions.append(revisionIndex)
-         simToolRevisions.sort()
-         simToolRevisions = [ 'r%d' % (revision) for revision in simToolRevisions ]
-
-         for simToolRevision in simToolRevisions:
-            nbPath = os.path.join(simToolPath,simToolRevision,'simtool',"%s.ipynb" % (simToolName))
-            if os.path.exists(nbPath):
-               simToolNotebookMetaData = _getSimToolNotebookMetaData(nbPath)
-               if   simToolNotebookMetaData['state'] == 'installed':
-                  description = _getSimToolDescription(nbPath)
-                  if not simToolName in installedSimToolRevisions:
-                     installedSimToolRevisions[simToolName] = {}
-                  if not 'installed' in installedSimToolRevisions[simToolName]:
-                     installedSimToolRevisions[simToolName]['installed'] = {}
-                  installedSimToolRevisions[simToolName]['installed'][simToolRevision] = description
-               elif simToolNotebookMetaData['state'] == 'published':
-                  description = _getSimToolDescription(nbPath)
-                  if not simToolName in installedSimToolRevisions:
-                     installedSimToolRevisions[simToolName] = {}
-                  if not 'published' in installedSimToolRevisions[simToolName]:
-                     installedSimToolRevisions[simToolName]['published'] = {}
-                  installedSimToolRevisions[simToolName]['published'][simToolRevision] = description
+      if not simToolName in catalog['simTools']:
+         continue
+      simToolRevisions = catalog['simTools'][simToolName]['revisions']
+      for simToolRevision in sorted(simToolRevisions,key=lambda revision: int(revision[1:])):
+         revisionEntry = simToolRevisions[simToolRevision]
+         if revisionEntry['state'] in ['installed','published']:
+            if not simToolName in installedSimToolRevisions:
+               installedSimToolRevisions[simToolName] = {}
+            if not revisionEntry['state'] in installedSimToolRevisions[simToolName]:
+               installedSimToolRevisions[simToolName][revisionEntry['state']] = {}
+            installedSimToolRevisions[simToolName][revisionEntry['state']][simToolRevision] = revisionEntry['description']
 
    if returnString:
       installedSimToolRevisions = yaml.dump(installedSimToolRevisions,indent=3)
@@ -412,37 +677,237 @@ def searchForSimTool(simToolName,simToolRevision=None):
               simToolRevision - the simtool revision (if installed or published)
               published       - boolean which is True if the notebook is published
    """
+   return _getResolvedSimTool(_searchForSimTool,simToolName,simToolRevision)
+
+
+def _searchForSimTool(simToolName,simToolRevision=None):
+   return _selectSimTool(_SimToolDirectories(),simToolName,simToolRevision)
+
+
+SIMTOOLRESOLVERTTL       = 30.   # seconds lookups by searchForSimTool and findSimToolNotebook are reused, 0 to disable
+SIMTOOLRESOLVERCACHESIZE = 1024  # number of lookups kept
+
+_simToolResolverCache = collections.OrderedDict()
+_simToolResolverLock  = threading.Lock()
+
+
+def _getNotebookStat(notebookPath):
+   if notebookPath is None:
+      return None
+   try:
+      nbStat = os.stat(notebookPath)
+   except OSError:
+      return None
+   return (nbStat.st_mtime_ns,nbStat.st_size)
+
+
+def _getCachedSimTool(cacheKey):
+   with _simToolResolverLock:
+      cacheEntry = _simToolResolverCache.get(cacheKey)
+   if cacheEntry:
+      expires,notebookStat,simToolLocation = cacheEntry
+      if time.monotonic() < expires and _getNotebookStat(simToolLocation['notebookPath']) == notebookStat:
+         return copy.deepcopy(simToolLocation)
+
+   return None
+
+
+def _putCachedSimTool(cacheKey,simToolLocation):
+# a simtool that is not found may be installed at any time, only found simtools are kept
+   if simToolLocation['notebookPath'] is None:
+      return
+
+   cacheEntry = (time.monotonic() + SIMTOOLRESOLVERTTL,
+                 _getNotebookStat(simToolLocation['notebookPath']),
+                 copy.deepcopy(simToolLocation))
+   with _simToolResolverLock:
+      _simToolResolverCache[cacheKey] = cacheEntry
+      _simToolResolverCache.move_to_end(cacheKey)
+      while len(_simToolResolverCache) > SIMTOOLRESOLVERCACHESIZE:
+         _simToolResolverCache.popitem(last=False)
+
+
+def _getResolvedSimTool(resolver,simToolName,simToolRevision):
+   """Internal function to lookup a simtool, reusing recent results.
+   Results are reused for SIMTOOLRESOLVERTTL seconds for the same name,
+   revision and working directory as long as the notebook is unchanged.
+   Lookups that do not find the simtool or raise an exception are not kept.
+   """
+   if not SIMTOOLRESOLVERTTL:
+      return resolver(simToolName,simToolRevision)
+
+   cacheKey = (resolver.__name__,simToolName,simToolRevision,os.getcwd())
+   simToolLocation = _getCachedSimTool(cacheKey)
+   if simToolLocation is None:
+      simToolLocation = resolver(simToolName,simToolRevision)
+      _putCachedSimTool(cacheKey,simToolLocation)
+
+   return simToolLocation
+
+
+def _getInstalledSimToolLocation(simToolName,notebookPath):
+   """Internal function to get the location of an installed simtool
+   from a link to the notebook.  None is returned if the link does
+   not lead to a notebook in APPSROOT.
+   """
+   if not os.path.isfile(notebookPath):
+      return None
+
+   notebookPath = os.path.realpath(os.path.abspath(notebookPath))
+   installedNotebookPattern = os.path.join(re.escape(os.path.realpath(APPSROOT)),re.escape(simToolName),'(r[0-9]+)',
+                                           'simtool',re.escape("%s.ipynb" % (simToolName)))
+   reInstalledNotebookPattern = re.compile("^%s$" % (installedNotebookPattern))
+   match = reInstalledNotebookPattern.match(notebookPath)
+   if not match:
+      return None
+
+   simToolLocation = {}
+   simToolLocation['notebookPath']    = notebookPath
+   simToolLocation['simToolName']     = simToolName
+   simToolLocation['simToolRevision'] = match.group(1)
+   simToolNotebookMetaData = _getSimToolNotebookMetaData(simToolLocation['notebookPath'])
+   if simToolNotebookMetaData['name'] == simToolLocation['simToolName'] and \
+      simToolNotebookMetaData['revision'] == simToolLocation['simToolRevision'] and \
+      simToolNotebookMetaData['state'] == 'published':
+      simToolLocation['published'] = True
+   else:
+      simToolLocation['published'] = False
+
+   return simToolLocation
+
+
+class _SimToolDirectories:
+   """
+   The directories searched for simtools, as seen by _selectSimTool.
+   Every question is answered from the file system.
+   """
+
+   def isNotebookLink(self,notebookPath):
+      return os.path.islink(notebookPath)
+
+
+   def isNotebookFile(self,notebookPath):
+      return os.path.isfile(notebookPath)
+
+
+   def hasRevision(self,simToolRoot,simToolName,simToolRevision):
+# the notebook of the revision is checked for next
+      return True
+
+
+class _ScannedSimToolDirectories(_SimToolDirectories):
+   """
+   The directories searched for simtools, listed once for the named
+   simtools.  The local simtool directories and APPSROOT are listed once,
+   the directories of the named simtools are listed once each.
+   """
+
+   def __init__(self,simToolNames):
+      self.localNotebooks = {}
+      for notebookDirectory in [os.path.join('simtool'),os.path.join('..','simtool')]:
+         localNotebooks = {}
+         try:
+            with os.scandir(notebookDirectory) as dirEntries:
+               for dirEntry in dirEntries:
+                  localNotebooks[dirEntry.name] = dirEntry
+         except OSError:
+            pass
+         self.localNotebooks[notebookDirectory] = localNotebooks
+
+      self.revisions = {}
+      for simToolRoot in [APPSROOT,os.curdir]:
+         simToolRevisions = {}
+         try:
+            rootNames = set(os.listdir(simToolRoot))
+         except OSError:
+            rootNames = set()
+         for simToolName in simToolNames:
+            if simToolName in rootNames:
+               try:
+                  simToolRevisions[simToolName] = set(os.listdir(os.path.join(simToolRoot,simToolName)))
+               except OSError:
+                  pass
+         self.revisions[simToolRoot] = simToolRevisions
+
+
+   def __getLocalNotebook(self,notebookPath):
+      notebookDirectory,simToolNotebook = os.path.split(notebookPath)
+      return self.localNotebooks.get(notebookDirectory,{}).get(simToolNotebook)
+
+
+   def isNotebookLink(self,notebookPath):
+      dirEntry = self.__getLocalNotebook(notebookPath)
+      return dirEntry is not None and dirEntry.is_symlink()
+
+
+   def isNotebookFile(self,notebookPath):
+      dirEntry = self.__getLocalNotebook(notebookPath)
+      return dirEntry is not None and dirEntry.is_file()
+
+
+   def hasRevision(self,simToolRoot,simToolName,simToolRevision):
+      return simToolRevision in self.revisions[simToolRoot].get(simToolName,())
+
+
+def _selectSimToolRevision(simToolDirectories,simToolName,simToolRevision):
+   """Internal function to lookup a revision of a simtool given by name.
+   An installed or published revision in APPSROOT is preferred over a
+   revision in the working directory.
+   """
+   simToolLocation = {}
+   simToolLocation['notebookPath']    = None
+   simToolLocation['simToolName']     = None
+   simToolLocation['simToolRevision'] = None
+   simToolLocation['published']       = None
+
+   simToolNotebook = os.path.basename(simToolName) + '.ipynb'
+   notebookPath = os.path.join(APPSROOT,simToolName,simToolRevision,'simtool',simToolNotebook)
+   if simToolDirectories.hasRevision(APPSROOT,simToolName,simToolRevision) and os.path.exists(notebookPath):
+      # look for installed or published revision in /apps/name/revision/simtool/
+      simToolLocation['notebookPath']    = os.path.realpath(notebookPath)
+      simToolLocation['simToolName']     = os.path.basename(simToolName)
+      simToolLocation['simToolRevision'] = os.path.basename(os.path.dirname(os.path.dirname(simToolLocation['notebookPath'])))
+      # verify pubication status - sample published notebook reference to simtool
+      simToolNotebookMetaData = _getSimToolNotebookMetaData(simToolLocation['notebookPath'])
+      if simToolNotebookMetaData['name'] == simToolLocation['simToolName'] and \
+         simToolNotebookMetaData['revision'] == simToolLocation['simToolRevision'] and \
+         simToolNotebookMetaData['state'] == 'published':
+         simToolLocation['published'] = True
+      else:
+         simToolLocation['published'] = False
+   else:
+      notebookPath = os.path.join(simToolName,simToolRevision,'simtool',simToolNotebook)
+      if simToolDirectories.hasRevision(os.curdir,simToolName,simToolRevision) and os.path.exists(notebookPath):
+         # look for notebook in name/revision/simtool/
+         simToolLocation['notebookPath']    = os.path.realpath(notebookPath)
+         simToolLocation['simToolName']     = os.path.basename(simToolName)
+         simToolLocation['simToolRevision'] = simToolRevision
+         simToolLocation['published']       = False
+
+   return simToolLocation
+
+
+def _selectSimTool(simToolDirectories,simToolName,simToolRevision=None):
+   """Internal function to lookup a simtool, the rules followed by
+   searchForSimTool and resolveSimTools.
+   """
+   def findRevision(simToolRevision):
+      if simToolName.endswith('.ipynb'):
+         return _findSimToolNotebook(simToolName,simToolRevision)
+      return _selectSimToolRevision(simToolDirectories,simToolName,simToolRevision)
+
    foundIt = True
    if simToolRevision is None:
       notebookPath = os.path.join('simtool',"%s.ipynb" % (simToolName))
-      if not os.path.islink(notebookPath):
+      if not simToolDirectories.isNotebookLink(notebookPath):
          notebookPath = os.path.join('..','simtool',"%s.ipynb" % (simToolName))
-         if not os.path.islink(notebookPath):
+         if not simToolDirectories.isNotebookLink(notebookPath):
             foundIt = False
 
       if foundIt:
-#        verify link to installed (/apps) version
-         if os.path.isfile(notebookPath):
-            notebookPath = os.path.realpath(os.path.abspath(notebookPath))
-            installedNotebookPattern = os.path.join(os.sep,'apps',simToolName,'(r[0-9]+)','simtool',"%s.ipynb" % (simToolName))
-            reInstalledNotebookPattern = re.compile("^%s$" % (installedNotebookPattern))
-            match = reInstalledNotebookPattern.match(notebookPath)
-            if match:
-               simToolLocation = {}
-               simToolLocation['notebookPath']    = notebookPath
-               simToolLocation['simToolName']     = simToolName
-               simToolLocation['simToolRevision'] = match.group(1)
-               simToolNotebookMetaData = _getSimToolNotebookMetaData(simToolLocation['notebookPath'])
-               if simToolNotebookMetaData['name'] == simToolLocation['simToolName'] and \
-                  simToolNotebookMetaData['revision'] == simToolLocation['simToolRevision'] and \
-                  simToolNotebookMetaData['state'] == 'published':
-                  simToolLocation['published'] = True
-               else:
-                  simToolLocation['published'] = False
-            else:
-               foundIt = False
-         else:
-#           broken link
+#        verify link to installed (/apps) version, a broken link is not found
+         simToolLocation = _getInstalledSimToolLocation(simToolName,notebookPath)
+         if simToolLocation is None:
             foundIt = False
 
       if not foundIt:
@@ -450,9 +915,9 @@ def searchForSimTool(simToolName,simToolRevision=None):
          foundIt = True
 
          notebookPath = os.path.join('simtool',"%s.ipynb" % (simToolName))
-         if not os.path.isfile(notebookPath):
+         if not simToolDirectories.isNotebookFile(notebookPath):
             notebookPath = os.path.join('..','simtool',"%s.ipynb" % (simToolName))
-            if not os.path.isfile(notebookPath):
+            if not simToolDirectories.isNotebookFile(notebookPath):
                foundIt = False
 
          if foundIt:
@@ -463,34 +928,22 @@ def searchForSimTool(simToolName,simToolRevision=None):
             simToolLocation['simToolRevision'] = None
             simToolLocation['published']       = False
 
-      if not foundIt:
-         foundIt = True
-         try:
-            simToolLocation = findSimToolNotebook(simToolName,'current')
-         except:
-            foundIt = False
-         else:
-            notebookPath = simToolLocation['notebookPath']
-            if notebookPath is None:
-               foundIt = False
-            else:
-               simToolLocation['simToolRevision'] = os.path.basename(os.path.dirname(os.path.dirname(notebookPath)))
-
-      if not foundIt:
-         foundIt = True
-         try:
-            simToolLocation = findSimToolNotebook(simToolName,'dev')
-         except:
-            foundIt = False
-         else:
-            notebookPath = simToolLocation['notebookPath']
-            if notebookPath is None:
+      for installedRevision in ['current','dev']:
+         if not foundIt:
+            foundIt = True
+            try:
+               simToolLocation = findRevision(installedRevision)
+            except:
                foundIt = False
             else:
-               simToolLocation['simToolRevision'] = os.path.basename(os.path.dirname(os.path.dirname(notebookPath)))
+               notebookPath = simToolLocation['notebookPath']
+               if notebookPath is None:
+                  foundIt = False
+               else:
+                  simToolLocation['simToolRevision'] = os.path.basename(os.path.dirname(os.path.dirname(notebookPath)))
    else:
       try:
-         simToolLocation = findSimToolNotebook(simToolName,simToolRevision)
+         simToolLocation = findRevision(simToolRevision)
       except:
          foundIt = False
       else:
@@ -507,6 +960,57 @@ def searchForSimTool(simToolName,simToolRevision=None):
    return simToolLocation
 
 
+def resolveSimTools(simTools):
+   """Lookup several simtools by name and revision.
+
+      The same as calling searchForSimTool for each simtool.  The directories
+      holding simtools are listed once and every simtool is resolved from
+      that listing.  Simtools given by path are looked up with searchForSimTool.
+
+      Args:
+          simTools: List of simtool names or (simToolName,simToolRevision) tuples.
+
+      Returns:
+          A list of simToolLocation dictionaries, in the order of simTools.
+   """
+   cwd = os.getcwd()
+   resolvedSimTools = {}
+   scanSimTools = []
+   for simTool in simTools:
+      if isinstance(simTool,str):
+         simToolName,simToolRevision = simTool,None
+      else:
+         simToolName,simToolRevision = simTool
+      if not (simToolName,simToolRevision) in resolvedSimTools:
+         if os.sep in simToolName or simToolName.endswith('.ipynb') or simToolName in [os.curdir,os.pardir]:
+            simToolLocation = searchForSimTool(simToolName,simToolRevision)
+         else:
+            simToolLocation = None
+            if SIMTOOLRESOLVERTTL:
+               simToolLocation = _getCachedSimTool((_searchForSimTool.__name__,simToolName,simToolRevision,cwd))
+            if simToolLocation is None:
+               scanSimTools.append((simToolName,simToolRevision))
+         resolvedSimTools[(simToolName,simToolRevision)] = simToolLocation
+
+   if scanSimTools:
+      simToolDirectories = _ScannedSimToolDirectories(set([simToolName for simToolName,simToolRevision in scanSimTools]))
+      for simToolName,simToolRevision in scanSimTools:
+         simToolLocation = _selectSimTool(simToolDirectories,simToolName,simToolRevision)
+         if simToolLocation['notebookPath'] is not None and SIMTOOLRESOLVERTTL:
+            _putCachedSimTool((_searchForSimTool.__name__,simToolName,simToolRevision,cwd),simToolLocation)
+         resolvedSimTools[(simToolName,simToolRevision)] = simToolLocation
+
+   simToolLocations = []
+   for simTool in simTools:
+      if isinstance(simTool,str):
+         simToolName,simToolRevision = simTool,None
+      else:
+         simToolName,simToolRevision = simTool
+      simToolLocations.append(copy.deepcopy(resolvedSimTools[(simToolName,simToolRevision)]))
+
+   return simToolLocations
+
+
 def _find_simTool(simToolName,simToolRevision=None):
     """Lookup simtool by name and revision.
 
@@ -582,9 +1086,11 @@ def getSimToolInputs(simToolLocation):
           A simtool.Params object defining expected inputs.
    """
    nbPath = simToolLocation['notebookPath']
-   nb = load_notebook_node(nbPath)
-
-   return getNotebookInputs(nb)
+   yamlDict = _getSimToolDefinition(nbPath,'inputs')
+   if yamlDict:
+      return parse(yamlDict)
+   else:
+      return None
 
 
 def _get_inputs_dict(inputs,
@@ -636,15 +1142,79 @@ def _get_inputs_dict(inputs,
    return inputsDict
 
 
-def _get_file_cache_properties(filePath):
+FILECHECKSUMCACHEPATH = os.path.expanduser('~/.simtool_checksums.sqlite')  # None to disable the checksum cache
+FILECHECKSUMBLOCKSIZE = 8*1024*1024
+FILECHECKSUMTHREADS   = 4  # number of input files hashed in parallel
+FILECHECKSUMTIMEOUT   = 60 # seconds to wait for the checksum cache lock
+# Checksums of file inputs are prefixed with the algorithm, cache keys made
+# with unprefixed MD5 checksums by earlier versions are legacy keys.  The
+# algorithm is part of every cache key, it must be the same on all hosts.
+FILECHECKSUMALGORITHM = 'blake2b'
+
+
+def _connectFileChecksumCache():
+   connection = sqlite3.connect(FILECHECKSUMCACHEPATH,timeout=FILECHECKSUMTIMEOUT,isolation_level=None)
+   try:
+      connection.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                               device    INTEGER NOT NULL,
+                               inode     INTEGER NOT NULL,
+                               size      INTEGER NOT NULL,
+                               mtimeNs   INTEGER NOT NULL,
+                               algorithm TEXT    NOT NULL,
+                               checksum  TEXT    NOT NULL,
+                               PRIMARY KEY (device,inode,size,mtimeNs,algorithm))""")
+   except:
+      connection.close()
+      raise
+
+   return connection
+
+
+def _getFileChecksum(filePath,algorithm):
+   # Checksums are kept for each version of a file, identified by its
+   # device, inode, size and modification time.
+   fileStat = os.stat(filePath)
+   fileVersion = (fileStat.st_dev,fileStat.st_ino,fileStat.st_size,fileStat.st_mtime_ns,algorithm)
+   if FILECHECKSUMCACHEPATH:
+      try:
+         connection = _connectFileChecksumCache()
+         try:
+            row = connection.execute("""SELECT checksum FROM checksums
+                                           WHERE device = ? AND inode = ? AND size = ? AND mtimeNs = ? AND algorithm = ?""",
+                                     fileVersion).fetchone()
+         finally:
+            connection.close()
+      except sqlite3.Error:
+         row = None
+      if row is not None:
+         return row[0]
+
+   fileHash = hashlib.new(algorithm)
+   with open(filePath,'rb') as f:
+      for block in iter(lambda: f.read(FILECHECKSUMBLOCKSIZE),b""):
+         fileHash.update(block)
+   checksum = fileHash.hexdigest()
+
+   if FILECHECKSUMCACHEPATH:
+      try:
+         connection = _connectFileChecksumCache()
+         try:
+            connection.execute("INSERT OR REPLACE INTO checksums VALUES (?,?,?,?,?,?)",fileVersion + (checksum,))
+         finally:
+            connection.close()
+      except sqlite3.Error:
+         pass
+
+   return checksum
+
+
+def _get_file_cache_properties(filePath,legacy=False):
    fileProperties = {}
    if os.path.exists(filePath):
-      md5Hash = hashlib.md5()
-      with open(filePath,'rb') as f:
-         # Read and update hash in chunks of 4K
-         for block in iter(lambda: f.read(4096),b""):
-            md5Hash.update(block)
-         fileProperties['checksum'] = md5Hash.hexdigest()
+      if legacy:
+         fileProperties['checksum'] = _getFileChecksum(filePath,'md5')
+      else:
+         fileProperties['checksum'] = FILECHECKSUMALGORITHM + ':' + _getFileChecksum(filePath,FILECHECKSUMALGORITHM)
 
       fileProperties['fileSize'] = os.lstat(filePath).st_size
    else:
@@ -654,44 +1224,49 @@ def _get_file_cache_properties(filePath):
    return fileProperties
 
 
-def _get_inputs_cache_dict(inputs):
-   inputsCacheDict = {}
-   if type(inputs) == dict:
-      for label in inputs:
-         value = inputs[label]
+def _get_inputs_cache_dict(inputs,legacy=False):
+   """Get the input values used to find cached results.
 
-         checkForFile = False
-         try:
-            if isinstance(value,basestring):
-               checkForFile = True
-         except NameError:
-            if isinstance(value,str):
-               checkForFile = True
+      File inputs are replaced by their checksum and size, files are hashed
+      FILECHECKSUMTHREADS at a time.
 
-         if checkForFile:
-            if value.startswith('file://'):
-               path = value[7:]
-               value = _get_file_cache_properties(path)
-         inputsCacheDict[label] = value
-   else:
-      for label in inputs:
+      Args:
+          inputs: A SimTools Params object or a dictionary of key-value pairs.
+          legacy: Use the MD5 checksums of cache keys made by earlier versions.
+      Returns:
+          Dictionary of input values.
+   """
+   inputsCacheDict = {}
+   inputFilePaths = {}
+   for label in inputs:
+      if type(inputs) == dict:
+         value = inputs[label]
+      else:
          value = inputs[label].serialValue
 
-         checkForFile = False
-         try:
-            if isinstance(value,basestring):
-               checkForFile = True
-         except NameError:
-            if isinstance(value,str):
-               checkForFile = True
-
-         if checkForFile:
-            if value.startswith('file://'):
-               path = value[7:]
-               value = _get_file_cache_properties(path)
-         inputsCacheDict[label] = value
+      checkForFile = False
+      try:
+         if isinstance(value,basestring):
+            checkForFile = True
+      except NameError:
+         if isinstance(value,str):
+            checkForFile = True
+
+      if checkForFile:
+         if value.startswith('file://'):
+            inputFilePaths[label] = value[7:]
+            continue
+      inputsCacheDict[label] = value
+
+   if len(inputFilePaths) > 1:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=FILECHECKSUMTHREADS) as executor:
+         fileProperties = executor.map(lambda path: _get_file_cache_properties(path,legacy),inputFilePaths.values())
+         inputsCacheDict.update(zip(inputFilePaths.keys(),fileProperties))
+   else:
+      for label,path in inputFilePaths.items():
+         inputsCacheDict[label] = _get_file_cache_properties(path,legacy)
 
-   return inputsCacheDict
+   return { label:inputsCacheDict[label] for label in inputs }
 
 
 def _get_inputFiles(inputs):
@@ -738,8 +1313,79 @@ def getSimToolOutputs(simToolLocation):
           A simtool.Params object defining expected outputs.
    """
    nbPath = simToolLocation['notebookPath']
-   nb = load_notebook_node(nbPath)
+   yamlDict = _getSimToolDefinition(nbPath,'outputs')
+   if yamlDict:
+      return parse(yamlDict)
+   else:
+      return None
+
+
+class ParameterFile(str):
+   """Path of a file holding the value of a notebook parameter.
+
+      Parameters of this type are injected into the notebook as a call to
+      loadParameterFile() instead of as literal values.
+   """
+
+
+class _ParameterFilePythonTranslator(PythonTranslator):
+   @classmethod
+   def translate(cls, val):
+      if isinstance(val,ParameterFile):
+         return "__import__('simtool').loadParameterFile(%r)" % (str(val))
+      return super().translate(val)
+
+
+papermill_translators.register('python',_ParameterFilePythonTranslator)
 
-   return getNotebookOutputs(nb)
+
+def _write_parameter_file(value,
+                          paramType,
+                          parametersDirectory,
+                          label,
+                          threshold):
+   """Internal function to write large Array, List or Dict values to a file.
+   Arrays are written in numpy format, other values as JSON.  Returns a
+   ParameterFile or None if the value is smaller than threshold bytes.
+   """
+   if paramType == 'Array':
+      try:
+         arrayValue = np.asarray(value)
+      except ValueError:
+         arrayValue = None
+      if arrayValue is not None and arrayValue.dtype != object:
+         if arrayValue.nbytes < threshold:
+            return None
+         if not os.path.isdir(parametersDirectory):
+            os.makedirs(parametersDirectory)
+         parameterPath = os.path.join(parametersDirectory,label + '.npy')
+         np.save(parameterPath,arrayValue)
+         return ParameterFile(parameterPath)
+
+   jsonValue = json.dumps(value)
+   if len(jsonValue) < threshold:
+      return None
+   if not os.path.isdir(parametersDirectory):
+      os.makedirs(parametersDirectory)
+   parameterPath = os.path.join(parametersDirectory,label + '.json')
+   with open(parameterPath,'w') as fp:
+      fp.write(jsonValue)
+
+   return ParameterFile(parameterPath)
 
 
+def loadParameterFile(path):
+   """Load the value of a parameter stored in a file.
+
+      Arrays are memory-mapped copy-on-write, so only the parts of the array
+      that are used are read and the notebook may modify the array.
+
+      Args:
+          path: Path of a file written for a large Array, List or Dict input.
+      Returns:
+          The parameter value.
+   """
+   if path.endswith('.npy'):
+      return np.load(path,mmap_mode='c')
+   with open(path,'r') as fp:
+      return json.load(fp)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Fixtures shared by the simtool tests.
+
+Runs, the results cache and the other files simtool keeps in the home
+directory are placed in a temporary directory for each test.
+"""
+
+import os
+import shutil
+import threading
+
+import pytest
+
+import simtool
+from simtool import utils
+from simtool.datastore import FileDataStore, WSDataStore
+from simtool.cacheserver import CacheServer
+
+NOTEBOOKS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'notebooks')
+PACKAGEROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Temporary working directory holding the runs and the results cache."""
+    monkeypatch.chdir(tmp_path)
+# kernels executing sim2L notebooks import this simtool, as with tox
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join(filter(None, [PACKAGEROOT, os.environ.get('PYTHONPATH')])))
+    monkeypatch.setattr(FileDataStore, 'USERCACHELOCATIONROOT', str(tmp_path / 'data'))
+    monkeypatch.setattr(utils, 'SIMTOOLCATALOGPATH', str(tmp_path / 'catalog.json'))
+    monkeypatch.setattr(utils, 'FILECHECKSUMCACHEPATH', str(tmp_path / 'checksums.sqlite'))
+    return tmp_path
+
+
+@pytest.fixture
+def cachetest(workdir):
+    """Location of a copy of the cachetest sim2L, with a revision so results are cached."""
+    shutil.copytree(os.path.join(NOTEBOOKS, 'cachetest'), str(workdir / 'cachetest'))
+    simToolLocation = simtool.findSimToolNotebook(str(workdir / 'cachetest' / 'cachetest.ipynb'))
+    simToolLocation['simToolRevision'] = 'r1'
+    return simToolLocation
+
+
+@pytest.fixture
+def rundir(workdir):
+    """Run directory as left by a sim2L run.
+
+    The sim2L file greeting.txt is linked into the run directory and is also
+    a saved output, outputs/report.txt is written by the run.
+    """
+    sim2lDir = workdir / 'sim2l'
+    sim2lDir.mkdir()
+    (sim2lDir / 'greeting.txt').write_text('hello\n')
+    os.chmod(str(sim2lDir / 'greeting.txt'), 0o640)
+
+    runDir = workdir / 'run'
+    (runDir / 'outputs').mkdir(parents=True)
+    (runDir / 'run.ipynb').write_text('{}')
+    os.symlink(str(sim2lDir / 'greeting.txt'), str(runDir / 'greeting.txt'))
+    (runDir / 'outputs' / 'report.txt').write_text('report\n')
+    os.chmod(str(runDir / 'outputs' / 'report.txt'), 0o600)
+
+    prerunFiles = ['greeting.txt', 'run.ipynb']
+    savedOutputFiles = ['greeting.txt', os.path.join('outputs', 'report.txt')]
+    return runDir, prerunFiles, savedOutputFiles
+
+
+@pytest.fixture
+def cacheserver(workdir, monkeypatch):
+    """Stand-in cache web service, WSDataStore uses it by default."""
+    server = CacheServer(str(workdir / 'server'))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(WSDataStore, 'CACHELOCATIONROOT', server.getURL())
+    monkeypatch.setattr(WSDataStore, 'UPLOADRETRYDELAY', 0.01)
+    yield server
+    server.shutdown()
+    server.server_close()
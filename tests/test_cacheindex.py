@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cacheindex
+----------------------------------
+
+Tests for `simtool.cacheindex`.
+"""
+
+import os
+
+from simtool.cacheindex import CacheIndex, getTreeSize
+from simtool.datastore import FileDataStore
+
+
+def test_entries(tmp_path):
+    cacheIndex = CacheIndex(str(tmp_path / 'data'))
+    cacheIndex.addEntry('alpha', 'r1', 'k1', {'value': 1}, 100, 2)
+    cacheIndex.addEntry('alpha', 'r1', 'k2', {'value': 2}, 50, 1)
+    cacheIndex.addEntry('beta', 'r2', 'k3', {'value': 3}, 10, 1)
+    assert os.path.exists(str(tmp_path / 'data' / CacheIndex.INDEXNAME))
+
+    assert cacheIndex.touchEntry('alpha', 'r1', 'k1')
+    assert not cacheIndex.touchEntry('alpha', 'r1', 'missing')
+    entries = cacheIndex.getEntries()
+    assert [entry['cacheKey'] for entry in entries] == ['k2', 'k3', 'k1']
+    assert entries[-1]['accessCount'] == 1
+    assert entries[-1]['inputs'] == {'value': 1}
+    assert [entry['cacheKey'] for entry in cacheIndex.getEntries('alpha', 'r1')] == ['k2', 'k1']
+
+    assert cacheIndex.getCachedKeys('alpha', 'r1', ['k1', 'k3', 'missing']) == {'k1'}
+    assert cacheIndex.getStats() == [
+        {'simToolName': 'alpha', 'simToolRevision': 'r1', 'entries': 2, 'size': 150, 'files': 3},
+        {'simToolName': 'beta', 'simToolRevision': 'r2', 'entries': 1, 'size': 10, 'files': 1}]
+
+    cacheIndex.removeEntry('alpha', 'r1', 'k1')
+    assert cacheIndex.getCachedKeys('alpha', 'r1', ['k1', 'k2']) == {'k2'}
+
+
+def test_cached_keys_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(CacheIndex, 'QUERYCHUNKSIZE', 2)
+    cacheIndex = CacheIndex(str(tmp_path))
+    for key in range(5):
+        cacheIndex.addEntry('alpha', 'r1', 'k%d' % key, None, 1, 1)
+    assert cacheIndex.getCachedKeys('alpha', 'r1', ['k%d' % key for key in range(7)]) == \
+           set(['k%d' % key for key in range(5)])
+
+
+def test_seeded_from_existing_entries(tmp_path):
+    entryDir = tmp_path / '.simtool_cache' / 'alpha' / 'r1' / 'k1'
+    (entryDir / 'outputs').mkdir(parents=True)
+    (entryDir / 'run.ipynb').write_text('{}')
+    (entryDir / 'outputs' / 'report.txt').write_text('report\n')
+    (tmp_path / '.simtool_cache' / 'alpha' / 'r1' / 'k1.lock').write_text('')
+    (tmp_path / '.simtool_cache' / 'alpha' / 'r1' / '.staging.k2.0').mkdir()
+
+    entries = CacheIndex(str(tmp_path)).getEntries()
+    assert [entry['cacheKey'] for entry in entries] == ['k1']
+    assert entries[0]['size'] == 9
+    assert entries[0]['files'] == 2
+    assert entries[0]['inputs'] is None
+    assert getTreeSize(str(entryDir)) == (9, 2)
+
+
+def test_cached_runs_indexed(workdir, rundir):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstores = [FileDataStore('indextest', 'r1', {'value': value}) for value in range(3)]
+    for dstore in dstores[:2]:
+        dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+
+    cacheIndex = CacheIndex(dstores[0].cacheLocationRoot)
+    assert sorted(entry['cacheKey'] for entry in cacheIndex.getEntries()) == \
+           sorted(dstore.cacheKey for dstore in dstores[:2])
+    assert FileDataStore.existsMany('indextest', 'r1', [dstore.inputs for dstore in dstores]) == [True, True, False]
+
+    os.makedirs(str(workdir / 'out'))
+    assert dstores[1].read_cache(str(workdir / 'out'))
+    entries = cacheIndex.getEntries()
+    assert entries[-1]['cacheKey'] == dstores[1].cacheKey
+    assert entries[-1]['accessCount'] == 1
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_datastore
+----------------------------------
+
+Tests for `simtool.datastore` FileDataStore.
+"""
+
+import os
+import stat
+import json
+import pickle
+import threading
+import time
+
+import numpy
+import pytest
+
+from simtool.cacheindex import CacheIndex, getTreeSize
+from simtool import datastore
+from simtool.datastore import FileDataStore
+
+
+def _readEntry(dstore, outdir):
+    os.makedirs(str(outdir))
+    assert dstore.read_cache(str(outdir))
+    with open(os.path.join(str(outdir), 'greeting.txt')) as fp:
+        greeting = fp.read()
+    with open(os.path.join(str(outdir), 'outputs', 'report.txt')) as fp:
+        report = fp.read()
+    return greeting, report
+
+
+def test_default_link_mode_is_copy():
+    assert FileDataStore.LINKMODE == 'copy'
+
+
+@pytest.mark.parametrize('blobStore', [False, True])
+@pytest.mark.parametrize('linkMode', ['copy', 'reflink', 'hardlink'])
+def test_write_cache_link_modes(workdir, rundir, monkeypatch, linkMode, blobStore):
+    monkeypatch.setattr(FileDataStore, 'BLOBSTORE', blobStore)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    sim2lFile = workdir / 'sim2l' / 'greeting.txt'
+    reportFile = runDir / 'outputs' / 'report.txt'
+
+    dstore = FileDataStore('linktest', 'r1', {'linkMode': linkMode}, linkMode=linkMode)
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    assert _readEntry(dstore, workdir / 'out') == ('hello\n', 'report\n')
+
+# files reached through the symbolic link are copied, the sim2L is not changed
+    sim2lStat = os.stat(str(sim2lFile))
+    assert sim2lStat.st_nlink == 1
+    assert stat.S_IMODE(sim2lStat.st_mode) == 0o640
+    entryGreeting = os.path.join(dstore.rdir, 'greeting.txt')
+    assert not os.path.islink(entryGreeting)
+    assert not os.path.samefile(entryGreeting, str(sim2lFile))
+
+    entryReport = os.path.join(dstore.rdir, 'outputs', 'report.txt')
+    if linkMode == 'hardlink' and not blobStore:
+        assert os.path.samefile(entryReport, str(reportFile))
+    else:
+# the cache entry owns its files, changing the run directory does not change it
+        assert not os.path.samefile(entryReport, str(reportFile))
+        assert os.stat(str(reportFile)).st_nlink == 1
+        reportFile.write_text('changed\n')
+        assert _readEntry(dstore, workdir / 'out2') == ('hello\n', 'report\n')
+
+
+def test_write_cache_unknown_link_mode():
+    with pytest.raises(ValueError):
+        FileDataStore('linktest', 'r1', {}, linkMode='symlink')
+
+
+def test_cache_key():
+    inputs = {'value': 2, 'label': 'run', 'values': [1, 2, 3]}
+    key = FileDataStore.getCacheKey(inputs)
+    assert len(key) == 64
+    assert FileDataStore.getCacheKey({'values': [1, 2, 3], 'label': 'run', 'value': 2}) == key
+    assert FileDataStore.getCacheKey(dict(inputs, values=numpy.array([1, 2, 3]))) == key
+    assert FileDataStore.getCacheKey(dict(inputs, value=3)) != key
+
+
+def test_joblib_cache_table_migrated(workdir, rundir):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    inputs = {'value': 2}
+    dstore = FileDataStore('migratetest', 'r1', inputs)
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+
+# entry as named by the joblib table of earlier versions
+    oldName = 'a' * 32
+    os.rename(dstore.rdir, os.path.join(dstore.cachedir, oldName))
+    tableDir = os.path.join(dstore.cachetabdir, 'cachedRun', 'abcdef')
+    os.makedirs(tableDir)
+    with open(os.path.join(tableDir, 'metadata.json'), 'w') as fp:
+        json.dump({'input_args': {'*': repr([inputs])}}, fp)
+    with open(os.path.join(tableDir, 'output.pkl'), 'wb') as fp:
+        pickle.dump(oldName, fp)
+
+    dstore = FileDataStore('migratetest', 'r1', inputs)
+    assert dstore.exists()
+    assert not os.path.exists(dstore.cachetabdir)
+    assert _readEntry(dstore, workdir / 'out') == ('hello\n', 'report\n')
+
+
+class _Marker:
+    def __reduce__(self):
+        return (open, ('unpickled', 'w'))
+
+
+def test_joblib_cache_table_kept_until_migrated(workdir, rundir):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    inputs = {'value': 3}
+    dstore = FileDataStore('migratetest', 'r1', inputs)
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    oldName = 'b' * 32
+    os.rename(dstore.rdir, os.path.join(dstore.cachedir, oldName))
+    for tableName, inputs, output in [('good', inputs, oldName), ('code', {'value': 4}, _Marker()),
+                                      ('path', {'value': 5}, os.path.join('..', oldName))]:
+        tableDir = os.path.join(dstore.cachetabdir, 'cachedRun', tableName)
+        os.makedirs(tableDir)
+        with open(os.path.join(tableDir, 'metadata.json'), 'w') as fp:
+            json.dump({'input_args': {'*': repr([inputs])}}, fp)
+        with open(os.path.join(tableDir, 'output.pkl'), 'wb') as fp:
+            pickle.dump(output, fp)
+
+# entries that cannot be migrated stay in the table, their pickles are not run
+    assert dstore.exists()
+    assert sorted(os.listdir(os.path.join(dstore.cachetabdir, 'cachedRun'))) == ['code', 'path']
+    assert not os.path.exists(str(workdir / 'unpickled'))
+    assert not FileDataStore('migratetest', 'r1', {'value': 4}).exists()
+    assert _readEntry(dstore, workdir / 'out') == ('hello\n', 'report\n')
+
+
+def _writeEntries(rundir, count, simToolName='evicttest'):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstores = []
+    for value in range(count):
+        dstore = FileDataStore(simToolName, 'r1', {'value': value})
+        dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+        dstores.append(dstore)
+    return dstores
+
+
+def _getEntrySizes(dstores):
+    entrySizes = {}
+    for entry in CacheIndex(dstores[0].cacheLocationRoot).getEntries():
+        entrySizes[entry['cacheKey']] = entry['size']
+    return [entrySizes[dstore.cacheKey] for dstore in dstores]
+
+
+@pytest.fixture
+def evictable(monkeypatch):
+    """Cache entries can be evicted as soon as they are written."""
+    monkeypatch.setattr(FileDataStore, 'EVICTIONMINAGE', -1)
+
+
+def test_enforce_quota_lru(workdir, rundir, evictable):
+    dstores = _writeEntries(rundir, 3)
+    os.makedirs(str(workdir / 'out'))
+    assert dstores[0].read_cache(str(workdir / 'out'))
+    entrySizes = _getEntrySizes(dstores)
+    assert entrySizes[0] == getTreeSize(dstores[0].rdir)[0]
+
+    quota = entrySizes[0] + entrySizes[2]
+    assert FileDataStore.enforceQuota(quota=quota) == (1, entrySizes[1])
+    assert [dstore.exists() for dstore in dstores] == [True, False, True]
+    assert not os.path.exists(dstores[1].rdir + '.lock')
+    assert FileDataStore.enforceQuota(quota=quota) == (0, 0)
+    assert FileDataStore.enforceQuota(simToolQuota=0) == (2, quota)
+    assert os.listdir(dstores[0].cachedir) == []
+
+
+def test_enforce_quota_keeps_recent_entries(workdir, rundir):
+    dstores = _writeEntries(rundir, 2)
+    assert FileDataStore.enforceQuota(quota=0) == (0, 0)
+    assert [dstore.exists() for dstore in dstores] == [True, True]
+
+
+def test_entry_read_in_other_thread_not_evicted(workdir, rundir, evictable):
+    dstore, = _writeEntries(rundir, 1)
+    reading = threading.Event()
+    evicted = threading.Event()
+    def readEntry():
+        with dstore._FileDataStore__readLock():
+            reading.set()
+            evicted.wait(10)
+
+    reader = threading.Thread(target=readEntry)
+    reader.start()
+    try:
+        reading.wait(10)
+        assert FileDataStore.enforceQuota(quota=0) == (0, 0)
+        assert dstore.exists()
+    finally:
+        evicted.set()
+        reader.join()
+    assert FileDataStore.enforceQuota(quota=0)[0] == 1
+    assert not dstore.exists()
+
+
+def test_tree_size_counts_files_once(tmp_path):
+    (tmp_path / 'data').write_bytes(b'x' * 100)
+    os.link(str(tmp_path / 'data'), str(tmp_path / 'link'))
+    (tmp_path / 'other').write_bytes(b'y' * 10)
+    assert getTreeSize(str(tmp_path)) == (110, 3)
+
+
+def test_blobs_counted_once(workdir, rundir, evictable, monkeypatch):
+    monkeypatch.setattr(FileDataStore, 'BLOBSTORE', True)
+    dstores = _writeEntries(rundir, 2)
+    blobSize = getTreeSize(dstores[0].blobdir)[0]
+    assert blobSize == len('{}') + len('hello\n') + len('report\n')
+    entrySizes = _getEntrySizes(dstores)
+    assert entrySizes[0] == getTreeSize(dstores[0].rdir)[0]
+# entries only hold the marker and manifest, the files are blobs
+    assert sorted(os.listdir(dstores[0].rdir)) == sorted([FileDataStore.BLOBMANIFEST, FileDataStore.COMPLETEMARKER,
+                                                          'greeting.txt', 'outputs', 'run.ipynb'])
+    assert entrySizes[0] == sum(os.path.getsize(os.path.join(dstores[0].rdir, fileName))
+                                for fileName in [FileDataStore.BLOBMANIFEST, FileDataStore.COMPLETEMARKER])
+
+# the blobs are freed with the last entry using them
+    assert FileDataStore.enforceQuota(quota=entrySizes[1] + blobSize) == (1, entrySizes[0])
+    assert FileDataStore.enforceQuota(quota=0) == (1, entrySizes[1] + blobSize)
+    assert getTreeSize(dstores[0].blobdir)[0] == 0
+
+
+def test_failed_write_not_published(workdir, rundir):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstore = FileDataStore('publishtest', 'r1', {'value': 1})
+    with pytest.raises(OSError):
+        dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles + ['missing.txt'])
+    assert not dstore.exists()
+    assert os.listdir(dstore.cachedir) == []
+
+
+def test_incomplete_entry(workdir, rundir, monkeypatch):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstore = FileDataStore('publishtest', 'r1', {'value': 1})
+# entry left without a marker by a failed write, or written by an earlier version
+    os.makedirs(os.path.join(dstore.rdir, 'outputs'))
+    with open(os.path.join(dstore.rdir, 'greeting.txt'), 'w') as fp:
+        fp.write('partial\n')
+    assert not dstore.exists()
+    assert not dstore.read_cache(str(workdir))
+    monkeypatch.setattr(FileDataStore, 'LEGACYENTRYAGE', -1)
+    assert dstore.exists()
+    monkeypatch.undo()
+
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    assert os.path.exists(os.path.join(dstore.rdir, FileDataStore.COMPLETEMARKER))
+    assert _readEntry(dstore, workdir / 'out') == ('hello\n', 'report\n')
+    assert [fileName for fileName in os.listdir(dstore.cachedir) if fileName.startswith('.')] == []
+
+
+def test_identical_entry_kept(workdir, rundir):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstore = FileDataStore('publishtest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    with open(os.path.join(dstore.rdir, FileDataStore.COMPLETEMARKER)) as fp:
+        published = fp.read()
+
+    (runDir / 'outputs' / 'report.txt').write_text('second\n')
+    FileDataStore('publishtest', 'r1', {'value': 1}).write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    with open(os.path.join(dstore.rdir, FileDataStore.COMPLETEMARKER)) as fp:
+        assert fp.read() == published
+    assert _readEntry(dstore, workdir / 'out') == ('hello\n', 'report\n')
+    assert [fileName for fileName in os.listdir(dstore.cachedir) if fileName.startswith('.')] == []
+
+
+def test_run_lock_threads(workdir, monkeypatch):
+    monkeypatch.setattr(FileDataStore, 'RUNLOCKPOLL', 0.01)
+    first = FileDataStore('locktest', 'r1', {'value': 1})
+    second = FileDataStore('locktest', 'r1', {'value': 1})
+    assert first.lockRun(1)
+    assert os.path.exists(first.rdir + '.running')
+
+# identical runs in other threads of the process wait
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(second.lockRun(0.05)))
+    waiter.start()
+    waiter.join()
+    assert results == [False]
+
+    waiter = threading.Thread(target=lambda: results.append(second.lockRun(10)))
+    waiter.start()
+    time.sleep(0.05)
+    assert waiter.is_alive()
+    first.unlockRun()
+    waiter.join()
+    assert results == [False, True]
+    second.unlockRun()
+    assert not os.path.exists(first.rdir + '.running')
+    assert datastore._runLocks == {}
+
+
+def test_blob_store_shares_files(workdir, rundir, monkeypatch):
+    monkeypatch.setattr(FileDataStore, 'BLOBSTORE', True)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    first, second = _writeEntries(rundir, 2, simToolName='blobtest')
+    for fileName in ['greeting.txt', os.path.join('outputs', 'report.txt'), 'run.ipynb']:
+        assert os.path.samefile(os.path.join(first.rdir, fileName), os.path.join(second.rdir, fileName))
+    with open(os.path.join(first.rdir, FileDataStore.BLOBMANIFEST)) as fp:
+        blobs = json.load(fp)['blobs']
+    assert sorted(blobs) == sorted(['greeting.txt', os.path.join('outputs', 'report.txt'), 'run.ipynb'])
+# blobs are named by content and mode
+    assert blobs['greeting.txt'].endswith('.644')
+    assert blobs[os.path.join('outputs', 'report.txt')].endswith('.604')
+    assert os.stat(os.path.join(first.rdir, 'greeting.txt')).st_nlink == 3
+
+# a file with other content is a new blob
+    (runDir / 'outputs' / 'report.txt').write_text('other\n')
+    third = FileDataStore('blobtest', 'r1', {'value': 3})
+    third.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    assert os.path.samefile(os.path.join(first.rdir, 'greeting.txt'), os.path.join(third.rdir, 'greeting.txt'))
+    assert not os.path.samefile(os.path.join(first.rdir, 'outputs', 'report.txt'),
+                                os.path.join(third.rdir, 'outputs', 'report.txt'))
+    assert _readEntry(third, workdir / 'out') == ('hello\n', 'other\n')
+    assert _readEntry(first, workdir / 'out2') == ('hello\n', 'report\n')
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'zstd'])
+def test_compression(workdir, rundir, monkeypatch, compression):
+    monkeypatch.setattr(FileDataStore, 'COMPRESSION', compression)
+    monkeypatch.setattr(FileDataStore, 'COMPRESSIONTHRESHOLD', 1024)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    report = 'report\n' * 1000
+    (runDir / 'outputs' / 'report.txt').write_text(report)
+
+    dstore = FileDataStore('compresstest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    if compression == 'zstd' and datastore.zstandard is None:
+        compression = 'gzip'
+    compressedReport = os.path.join('outputs', 'report.txt' + FileDataStore.COMPRESSIONSUFFIXES[compression])
+    with open(os.path.join(dstore.rdir, FileDataStore.COMPRESSIONMANIFEST)) as fp:
+        assert json.load(fp)['files'] == {compressedReport: compression}
+    assert os.path.getsize(os.path.join(dstore.rdir, compressedReport)) < len(report)
+# small files are stored as is
+    assert os.path.exists(os.path.join(dstore.rdir, 'greeting.txt'))
+    assert not os.path.exists(os.path.join(dstore.rdir, 'outputs', 'report.txt'))
+
+    assert _readEntry(dstore, workdir / 'out') == ('hello\n', report)
+    assert stat.S_IMODE(os.stat(str(workdir / 'out' / 'outputs' / 'report.txt')).st_mode) & 0o600 == 0o600
+
+# decompressed when first read
+    monkeypatch.setattr(FileDataStore, 'DECOMPRESSONREAD', True)
+    outDir = workdir / 'out2'
+    outDir.mkdir()
+    assert dstore.read_cache(str(outDir))
+    assert not os.path.exists(str(outDir / 'outputs' / 'report.txt'))
+    assert os.path.exists(os.path.join(str(outDir), compressedReport))
+    assert FileDataStore.readFile(str(outDir / 'outputs' / 'report.txt')) == report.encode()
+    assert not os.path.exists(os.path.join(str(outDir), compressedReport))
+
+
+def test_lazy_read(workdir, rundir, monkeypatch):
+    monkeypatch.setattr(FileDataStore, 'LAZYREAD', True)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstore = FileDataStore('lazytest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+
+    outDir = workdir / 'out'
+    outDir.mkdir()
+    assert dstore.read_cache(str(outDir))
+    assert os.listdir(str(outDir)) == [FileDataStore.CACHEENTRYLINK]
+    reportPath = FileDataStore.resolvePath(str(outDir), os.path.join('outputs', 'report.txt'))
+    assert os.path.samefile(reportPath, os.path.join(dstore.rdir, 'outputs', 'report.txt'))
+    assert FileDataStore.readFile(reportPath) == b'report\n'
+# files added to the run directory are found there
+    (outDir / 'notes.txt').write_text('notes\n')
+    assert FileDataStore.resolvePath(str(outDir), 'notes.txt') == str(outDir / 'notes.txt')
+
+    assert FileDataStore.materialize(str(outDir))
+    assert sorted(os.listdir(str(outDir))) == ['greeting.txt', 'notes.txt', 'outputs', 'run.ipynb']
+    assert FileDataStore.resolvePath(str(outDir), 'greeting.txt') == str(outDir / 'greeting.txt')
+    assert (outDir / 'outputs' / 'report.txt').read_text() == 'report\n'
+    assert not FileDataStore.materialize(str(outDir))
+
+
+def test_partial_read(workdir, rundir, monkeypatch):
+    monkeypatch.setattr(FileDataStore, 'PARTIALREAD', True)
+    monkeypatch.setattr(FileDataStore, 'COMPRESSION', 'gzip')
+    monkeypatch.setattr(FileDataStore, 'COMPRESSIONTHRESHOLD', 1024)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    report = 'report\n' * 1000
+    (runDir / 'outputs' / 'report.txt').write_text(report)
+    dstore = FileDataStore('partialtest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+
+    outDir = workdir / 'out'
+    outDir.mkdir()
+    assert dstore.read_cache(str(outDir))
+# only notebooks are retrieved
+    assert sorted(os.listdir(str(outDir))) == sorted([datastore.PENDINGFILES, 'run.ipynb'])
+    greetingPath = FileDataStore.resolvePath(str(outDir), 'greeting.txt')
+    assert greetingPath == str(outDir / 'greeting.txt')
+    assert (outDir / 'greeting.txt').read_text() == 'hello\n'
+    assert not os.path.exists(str(outDir / 'outputs'))
+    assert FileDataStore.resolvePath(str(outDir), 'missing.txt') == str(outDir / 'missing.txt')
+
+    assert FileDataStore.materialize(str(outDir))
+    assert sorted(os.listdir(str(outDir))) == ['greeting.txt', 'outputs', 'run.ipynb']
+    assert (outDir / 'outputs' / 'report.txt').read_text() == report
+    assert not FileDataStore.materialize(str(outDir))
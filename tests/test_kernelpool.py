@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_kernelpool
+----------------------------------
+
+Tests for `simtool.kernelpool`.
+"""
+
+import time
+
+import pytest
+
+import simtool
+from simtool import kernelpool
+
+
+def _waitForIdle(pool, count, timeout=120):
+    deadline = time.time() + timeout
+    while pool.getIdleCount() < count and time.time() < deadline:
+        time.sleep(0.2)
+    return pool.getIdleCount()
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """Kernel pool of this process, replaced by a pool of two kernels."""
+    monkeypatch.setattr(kernelpool.KernelPool, 'POOLSIZE', 2)
+    monkeypatch.setattr(kernelpool, '_kernelPool', None)
+    pool = kernelpool.getKernelPool()
+    yield pool
+    _waitForIdle(pool, 2)
+    pool.shutdown()
+
+
+def test_start_fills_pool(pool):
+    assert pool.getIdleCount() == 0
+    pool.start()
+    assert _waitForIdle(pool, 2) == 2
+
+    kernel = pool.acquire('python3')
+    assert pool.getIdleCount() == 1
+    assert kernel['km'].is_alive()
+    pool.release(kernel)
+    assert pool.getIdleCount() == 2
+
+
+def test_engine_starts_pool(pool, cachetest):
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 4
+
+    r = simtool.Run(cachetest, inputs, venue='noSubmit', engine='kernelpool')
+    assert r.read('doubled') == 8
+# the pool was filled on first use, not only by the kernel returned by the run
+    assert _waitForIdle(pool, 2) == 2
+
+    inputs['value'].value = 7
+    r = simtool.Run(cachetest, inputs, venue='noSubmit', engine='kernelpool')
+    assert r.read('doubled') == 14
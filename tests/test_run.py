@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_run
+----------------------------------
+
+Tests of running the cachetest sim2L with `simtool.Run`.
+"""
+
+import os
+import time
+import hashlib
+import concurrent.futures
+
+import pytest
+
+import simtool
+from simtool.datastore import FileDataStore, WSDataStore, TieredDataStore
+from simtool.run import RunBase, LocalRun, ScriptRun, BackgroundRun
+
+
+def test_cached_run(cachetest):
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 21
+
+    r = simtool.Run(cachetest, inputs, venue='noSubmit')
+    assert not r.cached
+    assert r.read('doubled') == 42
+    assert r.read('greeting') == 'Hello from the cachetest sim2L\n'
+
+    r = simtool.Run(cachetest, inputs, venue='noSubmit')
+    assert r.cached
+    assert r.read('doubled') == 42
+    assert r.read('greeting') == 'Hello from the cachetest sim2L\n'
+    assert r.read('report') == 'run 42'
+    assert os.path.exists(r.outname)
+
+
+def test_sweep(cachetest):
+    inputsList = []
+    for value in [1, 2, 3]:
+        inputs = simtool.getSimToolInputs(cachetest)
+        inputs['value'].value = value
+        inputsList.append(inputs)
+    first = simtool.Run(cachetest, inputsList[0], venue='noSubmit')
+    assert not first.cached
+
+    runs = simtool.Run.sweep(cachetest, inputsList, maxWorkers=2, venue='noSubmit')
+    assert [r.read('doubled') for r in runs] == [2, 4, 6]
+# results already cached are read without a worker
+    assert [r.cached for r in runs] == [True, False, False]
+    assert RunBase.areCached(cachetest, inputsList) == [True, True, True]
+
+
+def test_background_run(cachetest):
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 5
+
+    handle = simtool.Run(cachetest, inputs, venue='noSubmit', wait=False)
+    assert isinstance(handle, BackgroundRun)
+    assert handle.wait(timeout=300)
+    assert handle.status() == 'finished'
+    r = handle.result()
+    assert r.read('doubled') == 10
+    assert r.outdir == handle.outdir
+    assert not handle.cancel()
+
+
+def test_background_run_cancel(cachetest):
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 6
+
+    handle = simtool.Run(cachetest, inputs, venue='noSubmit', wait=False)
+    assert handle.cancel()
+    assert handle.status() == 'cancelled'
+    with pytest.raises(concurrent.futures.CancelledError):
+        handle.result()
+
+
+def _findLeftovers(root):
+    leftovers = []
+    for rootDir, dirNames, fileNames in os.walk(root):
+        leftovers.extend(name for name in dirNames + fileNames
+                         if name.startswith('.staging.') or name.endswith('.running'))
+    return leftovers
+
+
+def test_background_run_cancel_cleans_up(cachetest, workdir, monkeypatch):
+# the run process is forked, it stops while publishing its cache entry
+    def publish(dstore, stagingdir):
+        time.sleep(300)
+    monkeypatch.setattr(FileDataStore, '_FileDataStore__publish', publish)
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 7
+
+    handle = simtool.Run(cachetest, inputs, venue='noSubmit', wait=False)
+    deadline = time.time() + 120
+    while not any(name.startswith('.staging.') for name in _findLeftovers(str(workdir / 'data'))):
+        assert time.time() < deadline
+        time.sleep(0.1)
+    started = time.time()
+    assert handle.cancel()
+    assert time.time() - started < BackgroundRun.CANCELTIMEOUT
+    assert _findLeftovers(str(workdir / 'data')) == []
+
+
+def test_script_run(cachetest, monkeypatch):
+    chdirs = []
+    chdir = os.chdir
+    def recordChdir(path):
+        chdirs.append(path)
+        chdir(path)
+    monkeypatch.setattr(os, 'chdir', recordChdir)
+
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 8
+    cwd = os.getcwd()
+    r = simtool.Run(cachetest, inputs, venue='script')
+    assert r.read('doubled') == 16
+    assert r.read('report') == 'run 16'
+# the script runs in the run directory, the working directory of the process is not changed
+    assert chdirs == []
+    assert os.getcwd() == cwd
+
+    r = simtool.Run(cachetest, inputs, venue='script')
+    assert r.cached
+    assert r.read('doubled') == 16
+
+
+@pytest.mark.parametrize('venue', ['noSubmit', 'script'])
+def test_parameter_files(cachetest, monkeypatch, venue):
+    monkeypatch.setattr(RunBase, 'PARAMETERFILETHRESHOLD', 1)
+    if venue == 'script':
+# notebook that cannot be converted, ScriptRun executes it with papermill
+        def compileNotebook(notebookPath):
+            raise ValueError("cannot convert")
+        monkeypatch.setattr(simtool.run, 'compileNotebook', compileNotebook)
+
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['values'].value = list(range(100))
+    r = simtool.Run(cachetest, inputs, venue=venue, cache=False)
+    assert r.read('total') == sum(range(100))
+    parameterFile = os.path.join(r.outdir, RunBase.PARAMETERFILERUNPREFIX, 'values.json')
+    assert os.path.exists(parameterFile)
+
+
+def test_cached_run_file_inputs(cachetest, workdir, monkeypatch):
+    hashed = []
+    getFileChecksum = simtool.utils._getFileChecksum
+    def recordChecksum(filePath, algorithm):
+        hashed.append((filePath, algorithm))
+        return getFileChecksum(filePath, algorithm)
+    monkeypatch.setattr(simtool.utils, '_getFileChecksum', recordChecksum)
+    labelPaths = []
+    for name, label in [('first', 'first label'), ('second', 'second label')]:
+        (workdir / name).mkdir()
+        (workdir / name / 'label.txt').write_text(label)
+        labelPaths.append(str(workdir / name / 'label.txt'))
+
+# files with the same name and different content are cached separately
+    runs = []
+    for labelPath in labelPaths:
+        inputs = simtool.getSimToolInputs(cachetest)
+        inputs['label'].file = labelPath
+        runs.append(simtool.Run(cachetest, inputs, venue='noSubmit'))
+    assert [r.cached for r in runs] == [False, False]
+    assert runs[0].dstore.rdir != runs[1].dstore.rdir
+    assert (labelPaths[0], 'blake2b') in hashed
+    assert (labelPaths[1], 'blake2b') in hashed
+
+    r = simtool.Run(cachetest, inputs, venue='noSubmit')
+    assert r.cached
+    assert r.dstore.rdir == runs[1].dstore.rdir
+    assert RunBase.areCached(cachetest, [inputs]) == [True]
+
+
+def test_legacy_key_looked_up_when_different(cachetest, workdir, monkeypatch):
+    made = []
+    class RecordingDataStore(FileDataStore):
+        def __init__(self, simtoolName, simtoolRevision, inputs, cacheLocationRoot=None):
+            made.append(inputs)
+            FileDataStore.__init__(self, simtoolName, simtoolRevision, inputs, cacheLocationRoot)
+    monkeypatch.setattr(RunBase, 'DSHANDLER', RecordingDataStore)
+    inputs = simtool.getSimToolInputs(cachetest)
+    RunBase.getDataStore(cachetest, inputs)
+    assert RunBase.areCached(cachetest, [inputs]) == [False]
+    assert len(made) == 1
+
+    (workdir / 'label.txt').write_text('label')
+    inputs['label'].file = str(workdir / 'label.txt')
+    RunBase.getDataStore(cachetest, inputs)
+    assert [hashableInputs['label']['checksum'] for hashableInputs in made[1:]] == \
+           ['blake2b:' + hashlib.blake2b(b'label').hexdigest(), hashlib.md5(b'label').hexdigest()]
+
+
+def _assertNotLocked(r):
+    assert not r.runLocked
+    assert r.dstore.runLock is None
+    assert not os.path.exists(r.dstore.rdir + '.running')
+    assert simtool.datastore._runLocks == {}
+
+
+def test_run_lock_released(cachetest):
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 9
+
+    r = LocalRun(cachetest, inputs, None, True)
+    assert not r.cached
+    _assertNotLocked(r)
+    r = ScriptRun(cachetest, inputs, None, True)
+    assert r.cached
+    _assertNotLocked(r)
+
+
+def test_run_lock_released_on_failure(cachetest, monkeypatch):
+    def executeNotebook(*args, **kwargs):
+        raise RuntimeError("kernel died")
+    monkeypatch.setattr(simtool.run.pm, 'execute_notebook', executeNotebook)
+
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 10
+    with pytest.raises(RuntimeError):
+        LocalRun(cachetest, inputs, None, True)
+    assert simtool.datastore._runLocks == {}
+    dstore = RunBase.getDataStore(cachetest, inputs)
+    assert not os.path.exists(dstore.rdir + '.running')
+
+
+def test_identical_runs_in_threads(cachetest):
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 11
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        runs = list(executor.map(lambda runName: simtool.Run(cachetest, inputs, runName=runName, venue='noSubmit'),
+                                 ['first', 'second']))
+    assert sorted(r.cached for r in runs) == [False, True]
+    assert [r.read('doubled') for r in runs] == [22, 22]
+    for r in runs:
+        _assertNotLocked(r)
+
+
+@pytest.mark.parametrize('readMode', ['LAZYREAD', 'PARTIALREAD'])
+def test_cached_run_read_modes(cachetest, monkeypatch, readMode):
+    monkeypatch.setattr(FileDataStore, readMode, True)
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 12
+    simtool.Run(cachetest, inputs, venue='noSubmit')
+
+    r = simtool.Run(cachetest, inputs, venue='noSubmit')
+    assert r.cached
+    assert r.read('doubled') == 24
+    assert r.read('greeting') == 'Hello from the cachetest sim2L\n'
+    assert r.read('report') == 'run 24'
+    assert os.path.exists(r.outname)
+
+    r.materialize()
+    assert r.outname == os.path.join(r.outdir, 'cachetest.ipynb')
+    assert os.path.exists(os.path.join(r.outdir, 'outputs', 'report.txt'))
+    assert r.read('report') == 'run 24'
+
+
+def test_cached_run_web_service(cachetest, cacheserver, monkeypatch):
+    monkeypatch.setattr(RunBase, 'DSHANDLER', WSDataStore)
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 13
+
+    r = simtool.Run(cachetest, inputs, venue='noSubmit')
+    assert not r.cached
+    r = simtool.Run(cachetest, inputs, venue='noSubmit')
+    assert r.cached
+    assert r.read('doubled') == 26
+    assert r.read('greeting') == 'Hello from the cachetest sim2L\n'
+    assert r.read('report') == 'run 26'
+
+
+def test_cached_run_tiered(cachetest, cacheserver, monkeypatch):
+    monkeypatch.setattr(RunBase, 'DSHANDLER', TieredDataStore)
+    inputs = simtool.getSimToolInputs(cachetest)
+    inputs['value'].value = 14
+
+    r = simtool.Run(cachetest, inputs, venue='noSubmit')
+    assert not r.cached
+    assert TieredDataStore.waitForPushes(timeout=60)
+    assert WSDataStore(r.dstore.simtoolName, r.dstore.simtoolRevision, r.dstore.inputs).exists()
+    r = simtool.Run(cachetest, inputs, venue='noSubmit')
+    assert r.cached
+    assert r.read('doubled') == 28
+    assert r.read('report') == 'run 28'
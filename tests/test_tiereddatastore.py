@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_tiereddatastore
+----------------------------------
+
+Tests for `simtool.datastore` TieredDataStore, a FileDataStore in front of
+the stand-in cache server of `simtool.cacheserver`.
+"""
+
+import os
+import threading
+
+import pytest
+
+from simtool.datastore import FileDataStore, WSDataStore, TieredDataStore
+
+
+def _readEntry(outdir):
+    with open(os.path.join(str(outdir), 'greeting.txt')) as fp:
+        greeting = fp.read()
+    with open(os.path.join(str(outdir), 'outputs', 'report.txt')) as fp:
+        report = fp.read()
+    return greeting, report
+
+
+@pytest.fixture
+def remoteRequests(cacheserver, monkeypatch):
+    """Number of WSDataStore objects made by TieredDataStore."""
+    made = []
+    init = WSDataStore.__init__
+    def recordInit(dstore, *args, **kwargs):
+        made.append(args)
+        init(dstore, *args, **kwargs)
+    monkeypatch.setattr(WSDataStore, '__init__', recordInit)
+    return made
+
+
+def test_write_pushed(workdir, rundir, remoteRequests):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstore = TieredDataStore('tieredtest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    assert TieredDataStore.waitForPushes(timeout=60)
+
+    assert FileDataStore('tieredtest', 'r1', {'value': 1}).exists()
+    assert WSDataStore('tieredtest', 'r1', {'value': 1}).exists()
+
+# results cached locally are read without the web service
+    del remoteRequests[:]
+    dstore = TieredDataStore('tieredtest', 'r1', {'value': 1})
+    os.makedirs(str(workdir / 'out'))
+    assert dstore.exists()
+    assert dstore.read_cache(str(workdir / 'out'))
+    assert _readEntry(workdir / 'out') == ('hello\n', 'report\n')
+    assert remoteRequests == []
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_local_entry_pushed(workdir, rundir, remoteRequests, monkeypatch, compression):
+    monkeypatch.setattr(FileDataStore, 'COMPRESSION', compression)
+    monkeypatch.setattr(FileDataStore, 'COMPRESSIONTHRESHOLD', 0)
+    monkeypatch.setattr(FileDataStore, 'DECOMPRESSONREAD', True)
+    runChanged = threading.Event()
+    exists = WSDataStore.exists
+    def existsAfterChange(dstore):
+        runChanged.wait(60)
+        return exists(dstore)
+    monkeypatch.setattr(WSDataStore, 'exists', existsAfterChange)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    TieredDataStore('tieredtest', 'r1', {'value': 1}).write_cache(str(runDir), prerunFiles, savedOutputFiles)
+
+# the run directory is changed before the push starts
+    (runDir / 'outputs' / 'report.txt').write_text('changed\n')
+    os.unlink(str(runDir / 'run.ipynb'))
+    runChanged.set()
+    assert TieredDataStore.waitForPushes(timeout=60)
+
+    os.makedirs(str(workdir / 'out'))
+    assert WSDataStore('tieredtest', 'r1', {'value': 1}).read_cache(str(workdir / 'out'), partial=False)
+    assert _readEntry(workdir / 'out') == ('hello\n', 'report\n')
+    assert sorted(os.listdir(str(workdir / 'out'))) == ['greeting.txt', 'outputs', 'run.ipynb']
+
+
+def test_remote_hit_cached_locally(workdir, rundir, remoteRequests):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    WSDataStore('tieredtest', 'r1', {'value': 1}).write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    assert TieredDataStore.existsMany('tieredtest', 'r1', [{'value': 0}, {'value': 1}]) == [False, True]
+
+    dstore = TieredDataStore('tieredtest', 'r1', {'value': 1})
+    os.makedirs(str(workdir / 'out'))
+    assert dstore.read_cache(str(workdir / 'out'))
+    assert _readEntry(workdir / 'out') == ('hello\n', 'report\n')
+    assert FileDataStore('tieredtest', 'r1', {'value': 1}).exists()
+    assert [fileName for fileName in os.listdir(dstore.local.cachedir) if fileName.startswith('.remote')] == []
+
+    os.makedirs(str(workdir / 'empty'))
+    assert not TieredDataStore('tieredtest', 'r1', {'value': 2}).read_cache(str(workdir / 'empty'))
+    assert os.listdir(str(workdir / 'empty')) == []
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_utils
+----------------------------------
+
+Tests for reading sim2L definitions with `simtool.utils`.
+"""
+
+import os
+import json
+import hashlib
+
+import pytest
+import yaml
+
+import simtool
+from simtool import utils
+
+
+@pytest.fixture
+def notebookLoads(monkeypatch):
+    """Paths of the notebooks read and parsed by utils."""
+    loads = []
+    loadNotebookNode = utils.load_notebook_node
+    def recordLoad(path):
+        loads.append(path)
+        return loadNotebookNode(path)
+    monkeypatch.setattr(utils, 'load_notebook_node', recordLoad)
+    return loads
+
+
+def _touch(path, offset):
+    pathStat = os.stat(path)
+    os.utime(path, ns=(pathStat.st_atime_ns, pathStat.st_mtime_ns + offset))
+
+
+def test_notebook_parsed_once(cachetest, notebookLoads):
+    nbPath = cachetest['notebookPath']
+    inputs = simtool.getSimToolInputs(cachetest)
+    outputs = simtool.getSimToolOutputs(cachetest)
+    assert utils._get_extra_files(nbPath) == ['greeting.txt']
+    assert utils._getSimToolDescription(nbPath) == 'Sim2L for testing runs and the results cache'
+    assert notebookLoads == [os.path.realpath(nbPath)]
+    assert sorted(inputs.keys()) == ['label', 'value', 'values']
+    assert sorted(outputs.keys()) == ['doubled', 'greeting', 'report', 'total']
+
+# the definitions returned are copies of the shared parse results
+    inputs['value'].value = 7
+    utils._get_extra_files(nbPath).append('other.txt')
+    assert simtool.getSimToolInputs(cachetest)['value'].value == 2
+    assert utils._get_extra_files(nbPath) == ['greeting.txt']
+    assert len(notebookLoads) == 1
+
+
+def test_changed_notebook_parsed_again(cachetest, notebookLoads):
+    nbPath = cachetest['notebookPath']
+    simtool.getSimToolInputs(cachetest)
+
+    with open(nbPath) as fp:
+        nb = json.load(fp)
+    for cell in nb['cells']:
+        if 'DESCRIPTION' in cell['metadata'].get('tags', []):
+            cell['source'] = 'DESCRIPTION = "Changed description"'
+    with open(nbPath, 'w') as fp:
+        json.dump(nb, fp)
+    _touch(nbPath, 1000)
+
+    assert utils._getSimToolDescription(nbPath) == 'Changed description'
+    assert len(notebookLoads) == 2
+
+
+def test_manifest_used_in_place_of_notebook(cachetest, notebookLoads):
+    nbPath = cachetest['notebookPath']
+    manifestPath = utils.writeSimToolManifest(nbPath)
+    assert manifestPath == os.path.join(os.path.dirname(os.path.realpath(nbPath)), 'cachetest.manifest.json')
+    with open(manifestPath) as fp:
+        manifest = json.load(fp)
+    assert manifest['version'] == utils.SIMTOOLMANIFESTVERSION
+    assert manifest['extraFiles'] == ['greeting.txt']
+
+    utils._readSimToolNotebook.cache_clear()
+    del notebookLoads[:]
+    assert sorted(simtool.getSimToolInputs(cachetest).keys()) == ['label', 'value', 'values']
+    assert utils._getSimToolDescription(nbPath) == 'Sim2L for testing runs and the results cache'
+    assert notebookLoads == []
+
+
+def test_stale_manifest_ignored(cachetest, notebookLoads):
+    nbPath = cachetest['notebookPath']
+    manifestPath = utils.writeSimToolManifest(nbPath)
+    with open(manifestPath) as fp:
+        manifest = json.load(fp)
+    manifest['description'] = 'Description from the manifest'
+    with open(manifestPath, 'w') as fp:
+        json.dump(manifest, fp)
+    assert utils._getSimToolDescription(nbPath) == 'Description from the manifest'
+
+# a notebook changed after the manifest was written is read
+    nbStat = os.stat(nbPath)
+    os.utime(manifestPath, ns=(nbStat.st_atime_ns, nbStat.st_mtime_ns - 1000))
+    assert utils._getSimToolDescription(nbPath) == 'Sim2L for testing runs and the results cache'
+
+
+def test_manifest_other_version_ignored(cachetest, notebookLoads):
+    nbPath = cachetest['notebookPath']
+    manifestPath = utils.writeSimToolManifest(nbPath)
+    with open(manifestPath) as fp:
+        manifest = json.load(fp)
+    manifest['version'] = utils.SIMTOOLMANIFESTVERSION + 1
+    manifest['description'] = 'Description from the manifest'
+    with open(manifestPath, 'w') as fp:
+        json.dump(manifest, fp)
+
+    assert utils._getSimToolDescription(nbPath) == 'Sim2L for testing runs and the results cache'
+
+
+def _breakInputs(nbPath):
+    with open(nbPath) as fp:
+        nb = json.load(fp)
+    for cell in nb['cells']:
+        if ''.join(cell['source']).startswith('%%yaml INPUTS'):
+            cell['source'] = '%%yaml INPUTS\n\nvalue: [unclosed\n'
+    with open(nbPath, 'w') as fp:
+        json.dump(nb, fp)
+    _touch(nbPath, 1000)
+
+
+def test_definitions_read_independently(cachetest):
+    nbPath = cachetest['notebookPath']
+    _breakInputs(nbPath)
+    with pytest.raises(yaml.YAMLError):
+        simtool.getSimToolInputs(cachetest)
+    with pytest.raises(yaml.YAMLError):
+        simtool.getSimToolInputs(cachetest)
+    assert sorted(simtool.getSimToolOutputs(cachetest).keys()) == ['doubled', 'greeting', 'report', 'total']
+    assert utils._get_extra_files(nbPath) == ['greeting.txt']
+    assert utils._getSimToolDescription(nbPath) == 'Sim2L for testing runs and the results cache'
+    with pytest.raises(ValueError):
+        utils.writeSimToolManifest(nbPath)
+
+
+def _installSimTool(appsRoot, simToolName, revision, state='installed', description=None):
+    with open(os.path.join(os.path.dirname(__file__), 'notebooks', 'cachetest', 'cachetest.ipynb')) as fp:
+        nb = json.load(fp)
+    nb['metadata']['simTool_info'] = {'name': simToolName, 'revision': revision, 'state': state}
+    if description:
+        for cell in nb['cells']:
+            if 'DESCRIPTION' in cell['metadata'].get('tags', []):
+                cell['source'] = 'DESCRIPTION = "%s"' % (description)
+    simToolDir = os.path.join(str(appsRoot), simToolName, 'r%d' % (revision), 'simtool')
+    os.makedirs(simToolDir)
+    nbPath = os.path.join(simToolDir, '%s.ipynb' % (simToolName))
+    with open(nbPath, 'w') as fp:
+        json.dump(nb, fp)
+    return nbPath
+
+
+@pytest.fixture
+def appsroot(workdir, monkeypatch):
+    """Empty APPSROOT for installing sim2Ls."""
+    appsRoot = workdir / 'apps'
+    appsRoot.mkdir()
+    monkeypatch.setattr(utils, 'APPSROOT', str(appsRoot))
+    return appsRoot
+
+
+@pytest.fixture
+def catalogReads(monkeypatch):
+    """Paths of the notebooks read to make catalog entries."""
+    reads = []
+    getSimToolNotebookMetaData = utils._getSimToolNotebookMetaData
+    def recordRead(nbPath):
+        reads.append(nbPath)
+        return getSimToolNotebookMetaData(nbPath)
+    monkeypatch.setattr(utils, '_getSimToolNotebookMetaData', recordRead)
+    return reads
+
+
+def test_catalog(appsroot, catalogReads):
+    _installSimTool(appsroot, 'alpha', 1)
+    _installSimTool(appsroot, 'alpha', 2, state='published', description='Alpha two')
+    _installSimTool(appsroot, 'beta', 3, state='dev')
+
+    expected = {'alpha': {'installed': {'r1': 'Sim2L for testing runs and the results cache'},
+                          'published': {'r2': 'Alpha two'}}}
+    assert simtool.findInstalledSimToolNotebooks(returnString=False) == expected
+    assert len(catalogReads) == 3
+    with open(utils.SIMTOOLCATALOGPATH) as fp:
+        catalog = json.load(fp)
+    assert catalog['appsRoot'] == str(appsroot)
+    assert catalog['simToolNames'] == ['alpha', 'beta']
+
+# unchanged revisions are taken from the catalog
+    assert simtool.findInstalledSimToolNotebooks(returnString=False) == expected
+    assert simtool.findInstalledSimToolNotebooks('alpha', returnString=False) == expected
+    assert len(catalogReads) == 3
+
+
+def test_catalog_lists_broken_inputs(appsroot):
+    _breakInputs(_installSimTool(appsroot, 'alpha', 1, state='published'))
+    assert simtool.findInstalledSimToolNotebooks(returnString=False) == \
+           {'alpha': {'published': {'r1': 'Sim2L for testing runs and the results cache'}}}
+    assert utils._getSimToolNotebookMetaData(str(appsroot / 'alpha' / 'r1' / 'simtool' / 'alpha.ipynb')) == \
+           {'name': 'alpha', 'revision': 'r1', 'state': 'published'}
+
+
+def test_catalog_revisions_normalized(appsroot):
+    _installSimTool(appsroot, 'alpha', 1, state='published')
+    _installSimTool(appsroot, 'alpha', 10)
+    os.rename(str(appsroot / 'alpha' / 'r1'), str(appsroot / 'alpha' / 'r01'))
+    assert simtool.findInstalledSimToolNotebooks(returnString=False) == \
+           {'alpha': {'installed': {'r10': 'Sim2L for testing runs and the results cache'},
+                      'published': {'r1': 'Sim2L for testing runs and the results cache'}}}
+
+
+def test_catalog_refreshed(appsroot, catalogReads):
+    _installSimTool(appsroot, 'alpha', 1)
+    simtool.findInstalledSimToolNotebooks(returnString=False)
+
+    nbPath = _installSimTool(appsroot, 'alpha', 2)
+    _installSimTool(appsroot, 'gamma', 1)
+    installed = simtool.findInstalledSimToolNotebooks(returnString=False)
+    assert sorted(installed) == ['alpha', 'gamma']
+    assert sorted(installed['alpha']['installed']) == ['r1', 'r2']
+    assert len(catalogReads) == 3
+
+# a changed notebook is read again
+    with open(nbPath) as fp:
+        nb = json.load(fp)
+    nb['metadata']['simTool_info']['state'] = 'published'
+    with open(nbPath, 'w') as fp:
+        json.dump(nb, fp)
+    _touch(nbPath, 1000)
+    installed = simtool.findInstalledSimToolNotebooks('alpha', returnString=False)
+    assert sorted(installed['alpha']) == ['installed', 'published']
+    assert catalogReads[-1] == nbPath
+    assert len(catalogReads) == 4
+
+
+@pytest.fixture
+def simtools(appsroot, workdir):
+    """Names of sim2Ls found in each of the places searched."""
+    _installSimTool(appsroot, 'linked', 1)
+    _installSimTool(appsroot, 'linked', 2, state='published')
+    os.symlink('r2', str(appsroot / 'linked' / 'current'))
+    _installSimTool(appsroot, 'current', 4)
+    os.symlink('r4', str(appsroot / 'current' / 'current'))
+    (workdir / 'simtool').mkdir()
+    os.symlink(str(appsroot / 'linked' / 'r1' / 'simtool' / 'linked.ipynb'),
+               str(workdir / 'simtool' / 'linked.ipynb'))
+    with open(os.path.join(os.path.dirname(__file__), 'notebooks', 'cachetest', 'cachetest.ipynb')) as fp:
+        (workdir / 'simtool' / 'local.ipynb').write_text(fp.read())
+    return ['linked', ('linked', 'r2'), ('linked', 'r9'), 'current', 'local', 'missing',
+            os.path.join('simtool', 'local.ipynb'), 'linked']
+
+
+def test_resolve_simtools(simtools, monkeypatch):
+    expected = [simtool.searchForSimTool(*((simTool,) if isinstance(simTool, str) else simTool))
+                for simTool in simtools]
+    assert [simToolLocation['simToolRevision'] for simToolLocation in expected[:6]] == \
+           ['r1', 'r2', None, 'r4', None, None]
+    assert [simToolLocation['published'] for simToolLocation in expected[:6]] == \
+           [False, True, None, False, False, None]
+
+# sim2Ls given by name are resolved from one listing of the directories
+    monkeypatch.setattr(utils, 'SIMTOOLRESOLVERTTL', 0)
+    def searchForSimTool(simToolName, simToolRevision=None):
+        assert simToolName == os.path.join('simtool', 'local.ipynb')
+        return utils._searchForSimTool(simToolName, simToolRevision)
+    monkeypatch.setattr(utils, 'searchForSimTool', searchForSimTool)
+    listed = []
+    listdir = os.listdir
+    def recordListdir(path):
+        listed.append(path)
+        return listdir(path)
+    monkeypatch.setattr(os, 'listdir', recordListdir)
+    assert simtool.resolveSimTools(simtools) == expected
+    assert len(listed) == len(set(listed))
+
+
+def test_resolve_simtools_reuses_lookups(simtools, monkeypatch):
+    first = simtool.resolveSimTools(simtools)
+    def scanSimTools(simToolNames):
+        raise AssertionError("sim2Ls scanned again")
+    monkeypatch.setattr(utils, '_ScannedSimToolDirectories', scanSimTools)
+    names = [simTool for simTool in simtools if simTool != 'missing' and simTool != ('linked', 'r9')]
+    assert simtool.resolveSimTools(names) == [simToolLocation for simTool, simToolLocation in zip(simtools, first)
+                                              if simTool in names]
+
+
+def test_lookups_follow_the_same_rules(simtools, monkeypatch):
+    monkeypatch.setattr(utils, 'SIMTOOLRESOLVERTTL', 0)
+    selected = []
+    selectSimTool = utils._selectSimTool
+    def recordSelect(simToolDirectories, simToolName, simToolRevision=None):
+        selected.append((type(simToolDirectories).__name__, simToolName, simToolRevision))
+        return selectSimTool(simToolDirectories, simToolName, simToolRevision)
+    monkeypatch.setattr(utils, '_selectSimTool', recordSelect)
+
+    assert simtool.searchForSimTool('current', 'r4') == simtool.resolveSimTools([('current', 'r4')])[0]
+    assert selected == [('_SimToolDirectories', 'current', 'r4'), ('_ScannedSimToolDirectories', 'current', 'r4')]
+
+
+def test_missing_simtool_not_kept(simtools, appsroot):
+    assert simtool.searchForSimTool('later')['notebookPath'] is None
+    assert simtool.resolveSimTools(['later'])[0]['notebookPath'] is None
+    nbPath = _installSimTool(appsroot, 'later', 1, state='published')
+    os.symlink('r1', str(appsroot / 'later' / 'current'))
+    assert simtool.searchForSimTool('later')['notebookPath'] == nbPath
+    assert simtool.resolveSimTools(['later'])[0]['notebookPath'] == nbPath
+
+
+@pytest.fixture
+def fileReads(monkeypatch):
+    """Number of files hashed to make checksums."""
+    reads = []
+    new = utils.hashlib.new
+    def recordNew(algorithm):
+        reads.append(algorithm)
+        return new(algorithm)
+    monkeypatch.setattr(utils.hashlib, 'new', recordNew)
+    return reads
+
+
+def test_file_checksums_kept(workdir, fileReads):
+    inputPath = workdir / 'input.txt'
+    inputPath.write_text('first\n')
+    inputs = {'label': 'text', 'data': 'file://' + str(inputPath)}
+    inputsCacheDict = utils._get_inputs_cache_dict(inputs)
+    assert inputsCacheDict == {'label': 'text',
+                               'data': {'checksum': 'blake2b:' + hashlib.blake2b(b'first\n').hexdigest(),
+                                        'fileSize': 6}}
+    assert os.path.exists(utils.FILECHECKSUMCACHEPATH)
+    assert utils._get_inputs_cache_dict(inputs) == inputsCacheDict
+    assert fileReads == ['blake2b']
+
+# a changed file is hashed again
+    inputPath.write_text('second\n')
+    _touch(str(inputPath), 1000)
+    assert utils._get_inputs_cache_dict(inputs)['data']['checksum'] == \
+           'blake2b:' + hashlib.blake2b(b'second\n').hexdigest()
+    assert fileReads == ['blake2b'] * 2
+
+# cache keys of earlier versions use unprefixed MD5 checksums
+    assert utils._get_inputs_cache_dict(inputs, legacy=True)['data']['checksum'] == \
+           hashlib.md5(b'second\n').hexdigest()
+
+
+def test_file_checksums_in_parallel(workdir, monkeypatch):
+    monkeypatch.setattr(utils, 'FILECHECKSUMCACHEPATH', None)
+    inputs = {}
+    for index in range(3):
+        (workdir / ('input%d.txt' % index)).write_text('input %d\n' % index)
+        inputs['data%d' % index] = 'file://' + str(workdir / ('input%d.txt' % index))
+    inputs['missing'] = 'file://' + str(workdir / 'missing.txt')
+
+    inputsCacheDict = utils._get_inputs_cache_dict(inputs)
+    assert list(inputsCacheDict) == list(inputs)
+    for index in range(3):
+        assert inputsCacheDict['data%d' % index]['checksum'] == \
+               'blake2b:' + hashlib.blake2b(('input %d\n' % index).encode()).hexdigest()
+    assert inputsCacheDict['missing'] == {'checksum': '', 'fileSize': 0}
+    assert not os.path.exists(str(workdir / 'checksums.sqlite'))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_wsdatastore
+----------------------------------
+
+Tests for `simtool.datastore` WSDataStore with the stand-in cache server
+of `simtool.cacheserver`.
+"""
+
+import os
+import asyncio
+import threading
+import collections
+
+import pytest
+
+from simtool import datastore
+from simtool.datastore import WSDataStore
+from simtool.cacheserver import CacheStore, CacheRequestHandler
+
+
+def _readEntry(outdir):
+    with open(os.path.join(str(outdir), 'greeting.txt')) as fp:
+        greeting = fp.read()
+    with open(os.path.join(str(outdir), 'outputs', 'report.txt')) as fp:
+        report = fp.read()
+    return greeting, report
+
+
+@pytest.mark.parametrize('chunkedUpload', [False, True])
+def test_round_trip(workdir, rundir, cacheserver, monkeypatch, chunkedUpload):
+    monkeypatch.setattr(WSDataStore, 'CHUNKEDUPLOAD', chunkedUpload)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstore = WSDataStore('wstest', 'r1', {'value': 1})
+    assert dstore.getSimToolSquidId()
+    assert not dstore.exists()
+    assert not dstore.read_cache(str(workdir / 'empty'))
+
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    dstore = WSDataStore('wstest', 'r1', {'value': 1})
+    assert dstore.exists()
+    assert dstore.read_cache(str(workdir / 'out'))
+    assert _readEntry(workdir / 'out') == ('hello\n', 'report\n')
+    assert sorted(os.listdir(str(workdir / 'out'))) == ['greeting.txt', 'outputs', 'run.ipynb']
+    assert not WSDataStore('wstest', 'r1', {'value': 2}).exists()
+
+
+def test_concurrent_download(workdir, rundir, cacheserver, monkeypatch):
+    monkeypatch.setattr(WSDataStore, 'DOWNLOADCHUNKSIZE', 1000)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    content = os.urandom(10000)
+    for index in range(10):
+        (runDir / 'outputs' / ('data%d.bin' % index)).write_bytes(content + bytes([index]))
+    dstore = WSDataStore('wstest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles + ['outputs'])
+
+    assert dstore.read_cache(str(workdir / 'out'))
+    for index in range(10):
+        assert (workdir / 'out' / 'outputs' / ('data%d.bin' % index)).read_bytes() == content + bytes([index])
+    assert [fileName for fileName in os.listdir(str(workdir / 'out' / 'outputs')) if fileName.count('.') > 1] == []
+
+
+def test_partial_read(workdir, rundir, cacheserver, monkeypatch):
+    monkeypatch.setattr(WSDataStore, 'PARTIALREAD', True)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstore = WSDataStore('wstest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+
+    outDir = workdir / 'out'
+    assert dstore.read_cache(str(outDir))
+    assert sorted(os.listdir(str(outDir))) == sorted([datastore.PENDINGFILES, 'run.ipynb'])
+    greetingPath = WSDataStore.resolvePath(str(outDir), 'greeting.txt')
+    assert open(greetingPath).read() == 'hello\n'
+    assert WSDataStore.materialize(str(outDir))
+    assert _readEntry(outDir) == ('hello\n', 'report\n')
+    assert sorted(os.listdir(str(outDir))) == ['greeting.txt', 'outputs', 'run.ipynb']
+
+
+@pytest.fixture
+def chunks(cacheserver, monkeypatch):
+    """Offsets and sizes of the chunks received by the cache server."""
+    received = []
+    putChunk = CacheStore.putChunk
+    def recordChunk(store, squidid, name, checksum, size, offset, content):
+        received.append((name, offset, len(content)))
+        return putChunk(store, squidid, name, checksum, size, offset, content)
+    monkeypatch.setattr(CacheStore, 'putChunk', recordChunk)
+    return received
+
+
+def test_chunked_upload(workdir, rundir, chunks, monkeypatch):
+    monkeypatch.setattr(WSDataStore, 'UPLOADCHUNKSIZE', 1000)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    content = os.urandom(3500)
+    (runDir / 'outputs' / 'data.bin').write_bytes(content)
+    dstore = WSDataStore('wstest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles + [os.path.join('outputs', 'data.bin')])
+
+    assert [(offset, size) for name, offset, size in chunks if name == 'outputs_._data.bin'] == \
+           [(0, 1000), (1000, 1000), (2000, 1000), (3000, 500)]
+    assert dstore.read_cache(str(workdir / 'out'))
+    assert (workdir / 'out' / 'outputs' / 'data.bin').read_bytes() == content
+
+
+def test_chunked_upload_resumed(workdir, rundir, chunks, monkeypatch):
+    monkeypatch.setattr(WSDataStore, 'UPLOADCHUNKSIZE', 1000)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    content = os.urandom(3500)
+    (runDir / 'outputs' / 'data.bin').write_bytes(content)
+
+# the connection fails after half of the second chunk has been received
+    putChunk = CacheStore.putChunk
+    interrupted = []
+    def interruptChunk(store, squidid, name, checksum, size, offset, content):
+        if name == 'outputs_._data.bin' and offset == 1000 and not interrupted:
+            interrupted.append(offset)
+            putChunk(store, squidid, name, checksum, size, offset, content[:400])
+            raise RuntimeError("connection lost")
+        return putChunk(store, squidid, name, checksum, size, offset, content)
+    monkeypatch.setattr(CacheStore, 'putChunk', interruptChunk)
+
+    dstore = WSDataStore('wstest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles + [os.path.join('outputs', 'data.bin')])
+    assert interrupted == [1000]
+    assert [(offset, size) for name, offset, size in chunks if name == 'outputs_._data.bin'] == \
+           [(0, 1000), (1000, 400), (1400, 1000), (2400, 1000), (3400, 100)]
+    assert dstore.read_cache(str(workdir / 'out'))
+    assert (workdir / 'out' / 'outputs' / 'data.bin').read_bytes() == content
+
+
+def test_held_files_skipped(workdir, rundir, chunks):
+    runDir, prerunFiles, savedOutputFiles = rundir
+    WSDataStore('wstest', 'r1', {'value': 1}).write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    assert sorted(name for name, offset, size in chunks) == ['greeting.txt', 'outputs_._report.txt', 'run.ipynb']
+
+    (runDir / 'outputs' / 'report.txt').write_text('second\n')
+    dstore = WSDataStore('wstest', 'r1', {'value': 2})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    assert sorted(name for name, offset, size in chunks) == ['greeting.txt', 'outputs_._report.txt',
+                                                             'outputs_._report.txt', 'run.ipynb']
+    assert dstore.read_cache(str(workdir / 'out'))
+    assert _readEntry(workdir / 'out') == ('hello\n', 'second\n')
+
+
+@pytest.mark.parametrize('failure', [ValueError, RuntimeError])
+def test_multipart_fallback(workdir, rundir, chunks, monkeypatch, failure):
+# the web service answers 400 to a ValueError and closes the connection on a RuntimeError
+    def getUploadStatus(store, squidid, name, checksum):
+        raise failure("chunked uploads are not supported")
+    monkeypatch.setattr(CacheStore, 'getUploadStatus', getUploadStatus)
+
+    runDir, prerunFiles, savedOutputFiles = rundir
+    dstore = WSDataStore('wstest', 'r1', {'value': 1})
+    dstore.write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    assert chunks == []
+    assert dstore.read_cache(str(workdir / 'out'))
+    assert _readEntry(workdir / 'out') == ('hello\n', 'report\n')
+
+
+@pytest.fixture
+def endpoints(cacheserver, monkeypatch):
+    """Endpoints of the GET requests received by the cache server."""
+    received = []
+    doGET = CacheRequestHandler.do_GET
+    def recordGET(handler):
+        received.append(handler.path.split('?')[0].strip('/'))
+        return doGET(handler)
+    monkeypatch.setattr(CacheRequestHandler, 'do_GET', recordGET)
+    monkeypatch.setattr(datastore, '_squidIds', collections.OrderedDict())
+    return received
+
+
+def test_lookup_many(workdir, rundir, endpoints, monkeypatch):
+    monkeypatch.setattr(WSDataStore, 'LOOKUPBATCHSIZE', 2)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    WSDataStore('wstest', 'r1', {'value': 1}).write_cache(str(runDir), prerunFiles, savedOutputFiles)
+    inputsList = [{'value': value} for value in range(5)]
+
+    del endpoints[:]
+    lookups = WSDataStore.lookupMany('wstest', 'r1', inputsList)
+    assert endpoints == ['squidids'] * 3
+    assert [cached for squidid, cached in lookups] == [False, True, False, False, False]
+    assert [squidid for squidid, cached in lookups] == \
+           [CacheStore.getSquidId('wstest', 'r1', inputs) for inputs in inputsList]
+    assert WSDataStore.existsMany('wstest', 'r1', inputsList) == [False, True, False, False, False]
+
+# squidids found by the batch requests are not requested again
+    del endpoints[:]
+    dstore = WSDataStore('wstest', 'r1', {'value': 1})
+    assert dstore.read_cache(str(workdir / 'out'))
+    assert 'squidid' not in endpoints
+
+
+def test_lookup_many_without_batch_requests(workdir, rundir, endpoints, monkeypatch):
+    doGET = CacheRequestHandler.do_GET
+    def doGETWithoutBatch(handler):
+        if handler.path.strip('/') == 'squidids':
+            handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+            handler.send_error(404)
+        else:
+            doGET(handler)
+    monkeypatch.setattr(CacheRequestHandler, 'do_GET', doGETWithoutBatch)
+    runDir, prerunFiles, savedOutputFiles = rundir
+    WSDataStore('wstest', 'r1', {'value': 1}).write_cache(str(runDir), prerunFiles, savedOutputFiles)
+
+    assert WSDataStore.existsMany('wstest', 'r1', [{'value': 0}, {'value': 1}]) == [False, True]
+
+
+def test_squidid_requested_when_used(workdir, rundir, endpoints, monkeypatch):
+    threads = []
+    requestSquidId = WSDataStore._WSDataStore__requestSquidId
+    def recordRequest(dstore):
+        threads.append(threading.current_thread().name)
+        return requestSquidId(dstore)
+    monkeypatch.setattr(WSDataStore, '_WSDataStore__requestSquidId', recordRequest)
+    runDir, prerunFiles, savedOutputFiles = rundir
+
+    async def useDataStores():
+        dstore = WSDataStore('wstest', 'r1', {'value': 1})
+        assert endpoints == []
+        assert not await dstore.aexists()
+        await dstore.awrite_cache(str(runDir), prerunFiles, savedOutputFiles)
+        assert await WSDataStore('wstest', 'r1', {'value': 1}).aread_cache(str(workdir / 'out'))
+        return dstore
+    dstore = asyncio.run(useDataStores())
+# the squidid is requested once for each data store, never by the event loop thread
+    assert endpoints.count('squidid') == 2
+    assert len(threads) == 2
+    assert all(thread.startswith('simtool-datastore') for thread in threads)
+    assert dstore.rdir == CacheStore.getSquidId('wstest', 'r1', {'value': 1})
+    assert _readEntry(workdir / 'out') == ('hello\n', 'report\n')